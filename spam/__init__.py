@@ -8,7 +8,9 @@ the results.
 __version__ = "1.0b"
 __authors__ = "Jason M. Swails and Guanglei Cui"
 __all__ = ['main', 'checkprogs', 'dx', 'traj', 'namdpdb', 'xyzpeaks',
-           'namdcalc', 'spaminfo', 'spamstats', 'progressbar']
+           'namdcalc', 'spaminfo', 'spamstats', 'statscache', 'progressbar',
+           'siteresults', 'energyarchive', 'benchmarks', 'trimsys',
+           'workqueue', 'namdtune', 'fakenamd']
 
 # Bring the necessary chemistry package components into spam namespace
 import sys as _sys
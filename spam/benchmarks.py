@@ -0,0 +1,261 @@
+"""
+This module contains micro-benchmarks of the file parsers, grid I/O and
+statistics used in a SPAM calculation. It builds synthetic NAMD pair
+interaction outputs, SPAM info files, XYZ peak files and DX grids of a chosen
+size, times the routines that process them, and writes the timings to a JSON
+file so they can be compared between revisions.
+"""
+from __future__ import division
+import os
+import json
+import numpy as np
+from timeit import default_timer
+from spam.exceptions import InputError
+
+# The energy terms NAMD prints in its ETITLE: lines
+NAMD_KEYS = ('TS', 'BOND', 'ANGLE', 'DIHED', 'IMPRP', 'ELECT', 'VDW',
+             'BOUNDARY', 'MISC', 'KINETIC', 'TOTAL', 'TEMP', 'POTENTIAL',
+             'TOTAL3', 'TEMPAVG', 'PRESSURE', 'GPRESSURE', 'VOLUME',
+             'PRESSAVG', 'GPRESSAVG')
+
+def write_namd_output(fname, nframes, rng=np.random):
+   """
+   Writes a NAMD pair interaction output file with nframes frames. The TOTAL
+   energies look like those of a water molecule in a hydration site
+   """
+   from spam.namdcalc import TS_PER_FRAME
+   outfile = open(fname, 'w')
+   outfile.write('Info: SYNTHETIC NAMD PAIR INTERACTION OUTPUT\n')
+   etitle = 'ETITLE:      ' + ''.join(['%15s' % key for key in NAMD_KEYS])
+   data = rng.normal(0, 1, (nframes, len(NAMD_KEYS)))
+   data[:,NAMD_KEYS.index('TOTAL')] = rng.normal(-20, 2, nframes)
+   for i in range(nframes):
+      outfile.write('%s\n\n' % etitle)
+      outfile.write('ENERGY: %7d' % ((i + 1) * TS_PER_FRAME) +
+                    ''.join(['%15.4f' % val for val in data[i,1:]]) + '\n\n')
+   outfile.close()
+
+def write_spam_info(fname, npeaks, nframes, omit_fraction=0.3, rng=np.random):
+   """
+   Writes a SPAM info file for npeaks sites over nframes frames, omitting
+   about omit_fraction of the frames of every site
+   """
+   outfile = open(fname, 'w')
+   outfile.write('# There are %d density peaks and %d frames\n\n' %
+                 (npeaks, nframes))
+   for i in range(npeaks):
+      omitted = np.flatnonzero(rng.random_sample(nframes) < omit_fraction)
+      outfile.write('# Peak %d has %d omitted frames\n' % (i, len(omitted)))
+      for j in range(0, len(omitted), 10):
+         outfile.write(' '.join(['%d' % fr for fr in omitted[j:j+10]]) + '\n')
+      outfile.write('\n')
+   outfile.close()
+
+def write_xyz_peaks(fname, npeaks, rng=np.random):
+   """ Writes an XYZ file with npeaks peaks """
+   outfile = open(fname, 'w')
+   outfile.write('%d\n\n' % npeaks)
+   for x, y, z in rng.uniform(-20, 20, (npeaks, 3)):
+      outfile.write('C %f %f %f %f\n' % (x, y, z, rng.uniform(1, 10)))
+   outfile.close()
+
+def make_grid(npoints, rng=np.random):
+   """ Returns a ThreeDGrid with npoints points along each dimension """
+   from spam.dx import ThreeDGrid
+   grid = ThreeDGrid((npoints, npoints, npoints), origin=(-10, -10, -10),
+                     resolution=(0.5, 0.5, 0.5), description='"benchmark"')
+   grid[:,:,:] = rng.random_sample((npoints, npoints, npoints))
+   return grid
+
+def time_call(func, repeat=3, setup=None):
+   """
+   Returns the wall times of repeat calls to func. If setup is given, it is
+   called (untimed) before every call and its return value is passed to func
+   """
+   times = []
+   for i in range(repeat):
+      args = ()
+      if setup is not None:
+         args = (setup(),)
+      start = default_timer()
+      func(*args)
+      times.append(default_timer() - start)
+   return times
+
+def run_benchmarks(workdir, frames=10000, sites=100, gridpoints=50,
+                   sample_size=-1, subsamples=20, repeat=3, only=None):
+   """
+   Builds the synthetic files in workdir and times every benchmark whose name
+   contains only (all of them if only is None). Returns a list of dicts with
+   the name, problem size, and timings of every benchmark
+   """
+   from spam import dx, namdcalc, spaminfo, spamstats, xyzpeaks
+   if frames < 1 or sites < 1 or gridpoints < 1 or repeat < 1:
+      raise InputError('Benchmark sizes and repeat count must be positive!')
+
+   rng = np.random.RandomState(10)
+   namdfile = os.path.join(workdir, 'bench_namd.out')
+   infofile = os.path.join(workdir, 'bench_spam.info')
+   xyzfile = os.path.join(workdir, 'bench_peaks.xyz')
+   dxfile = os.path.join(workdir, 'bench_grid.dx')
+   write_namd_output(namdfile, frames, rng)
+   write_spam_info(infofile, sites, frames, rng=rng)
+   write_xyz_peaks(xyzfile, sites, rng)
+   grid = make_grid(gridpoints, rng)
+   dxout = open(dxfile, 'w')
+   grid.write_dx(dxout)
+   dxout.close()
+   info = spaminfo.SpamInfo(infofile)
+   # Parsing once also writes the sidecar used by the sidecar benchmark
+   energies = namdcalc.NamdPairOutput(namdfile, sidecar=True).data['TOTAL']
+
+   def write_grid():
+      dxout = open(dxfile, 'w')
+      grid.write_dx(dxout)
+      dxout.close()
+
+   def filter_site(namdout):
+      namdout.filter_output_file(info, 0)
+
+   def statistics(**kwargs):
+      return lambda: spamstats.calc_g_wat(energies, sample_size, subsamples,
+                                          seed=0, **kwargs)
+
+   # (name, size, function, setup)
+   benchmarks = [
+      ('parse_output_file', {'frames' : frames},
+       lambda: namdcalc.NamdPairOutput(namdfile, sidecar=False), None),
+      ('parse_output_file.TOTAL', {'frames' : frames},
+       lambda: namdcalc.NamdPairOutput(namdfile, ['TOTAL'], False), None),
+      ('parse_output_file.sidecar', {'frames' : frames},
+       lambda: namdcalc.NamdPairOutput(namdfile, ['TOTAL'], True), None),
+      ('filter_output_file', {'frames' : frames}, filter_site,
+       lambda: namdcalc.NamdPairOutput(namdfile, sidecar=False)),
+      ('parse_spam_info', {'frames' : frames, 'sites' : sites},
+       lambda: spaminfo.SpamInfo(infofile), None),
+      ('read_dx', {'points' : gridpoints ** 3},
+       lambda: dx.read_dx(dxfile), None),
+      ('write_dx', {'points' : gridpoints ** 3}, write_grid, None),
+      ('read_xyz_peaks', {'sites' : sites},
+       lambda: xyzpeaks.read_xyz_peaks(xyzfile), None),
+   ]
+   size = {'frames' : frames, 'sample_size' : sample_size,
+           'subsamples' : subsamples}
+   for estimator in spamstats.ESTIMATORS:
+      benchmarks.append(('calc_g_wat.looped.%s' % estimator, size,
+                         statistics(estimator=estimator), None))
+   # Batched subsamples are only evaluated analytically
+   benchmarks.append(('calc_g_wat.batched.analytic', size,
+                      statistics(estimator='analytic', batched=True), None))
+   benchmarks.append(('calc_g_wat.jackknife', size,
+                      statistics(error_method='jackknife'), None))
+
+   results = []
+   for name, size, func, setup in benchmarks:
+      if only is not None and only not in name: continue
+      times = time_call(func, repeat, setup)
+      results.append({'name' : name, 'size' : size, 'times' : times,
+                      'best' : min(times), 'mean' : sum(times) / len(times)})
+   return results
+
+def _revision():
+   """ Returns the git revision of the source tree, or None if unknown """
+   from subprocess import Popen, PIPE
+   try:
+      process = Popen(['git', 'rev-parse', 'HEAD'], stdout=PIPE, stderr=PIPE,
+                      cwd=os.path.dirname(os.path.abspath(__file__)))
+      out, err = process.communicate()
+   except OSError:
+      return None
+   if process.returncode: return None
+   return out.strip()
+
+def write_results(results, dest, label=None):
+   """ Writes the benchmark results to dest (file name or open file) as JSON """
+   import platform, time
+   if label is None: label = _revision()
+   report = {'label' : label, 'time' : time.strftime('%Y-%m-%d %H:%M:%S'),
+             'python' : platform.python_version(), 'numpy' : np.__version__,
+             'results' : results}
+   if hasattr(dest, 'write'):
+      outfile = dest
+   else:
+      outfile = open(dest, 'w')
+   json.dump(report, outfile, indent=2, sort_keys=True)
+   outfile.write('\n')
+   if outfile is not dest: outfile.close()
+
+def compare_results(old, new, output):
+   """
+   Writes the ratio of the best times of every benchmark in the new results to
+   those in the old results (both are loaded JSON reports)
+   """
+   oldtimes = dict([(res['name'], res['best']) for res in old['results']])
+   output.write('# Comparing [%s] to [%s]\n' % (new['label'], old['label']))
+   output.write('# %-30s %12s %12s %8s\n' % ('Benchmark', 'Old (s)',
+                                              'New (s)', 'New/Old'))
+   for res in new['results']:
+      if res['name'] not in oldtimes: continue
+      oldtime = oldtimes[res['name']]
+      ratio = res['best'] / oldtime if oldtime > 0 else float('inf')
+      output.write('  %-30s %12.5f %12.5f %8.3f\n' % (res['name'], oldtime,
+                                                      res['best'], ratio))
+
+def test(args):
+   """ Runs the benchmarks """
+   from optparse import OptionParser, OptionGroup
+   import shutil, sys, tempfile
+
+   parser = OptionParser()
+   group = OptionGroup(parser, 'Benchmark Sizes',
+                       'Sizes of the synthetic data to benchmark with')
+   group.add_option('-f', '--frames', dest='frames', type='int', default=10000,
+                    metavar='INT', help='Number of frames. (Default %default)')
+   group.add_option('-s', '--sites', dest='sites', type='int', default=100,
+                    metavar='INT', help='Number of sites. (Default %default)')
+   group.add_option('-g', '--grid-points', dest='gridpoints', type='int',
+                    default=50, metavar='INT', help='Number of grid points ' +
+                    'along each dimension. (Default %default)')
+   group.add_option('--sample-size', dest='sample_size', type='int',
+                    default=-1, metavar='INT', help='Size of each subsample ' +
+                    'for calc_g_wat. (Default %default)')
+   group.add_option('--subsamples', dest='subsamples', type='int', default=20,
+                    metavar='INT', help='Number of subsamples for ' +
+                    'calc_g_wat. (Default %default)')
+   parser.add_option_group(group)
+   group = OptionGroup(parser, 'Benchmark Options', 'How to run and report')
+   group.add_option('-r', '--repeat', dest='repeat', type='int', default=3,
+                    metavar='INT', help='Number of times to run each ' +
+                    'benchmark. (Default %default)')
+   group.add_option('--only', dest='only', default=None, metavar='STRING',
+                    help='Only run benchmarks whose names contain STRING')
+   group.add_option('-o', '--output', dest='output', default=None,
+                    metavar='FILE', help='JSON file to write the results to. ' +
+                    '(Default is stdout)')
+   group.add_option('-l', '--label', dest='label', default=None,
+                    metavar='STRING', help='Label for these results. ' +
+                    '(Default is the git revision)')
+   group.add_option('-c', '--compare', dest='compare', default=None,
+                    metavar='FILE', help='Earlier JSON results to compare to')
+   parser.add_option_group(group)
+
+   opt, arg = parser.parse_args(args)
+
+   workdir = tempfile.mkdtemp(prefix='spam_bench')
+   try:
+      results = run_benchmarks(workdir, opt.frames, opt.sites, opt.gridpoints,
+                               opt.sample_size, opt.subsamples, opt.repeat,
+                               opt.only)
+   finally:
+      shutil.rmtree(workdir)
+
+   if opt.output is None:
+      write_results(results, sys.stdout, opt.label)
+   else:
+      write_results(results, opt.output, opt.label)
+
+   if opt.compare is not None:
+      old = json.load(open(opt.compare, 'r'))
+      new = json.load(open(opt.output, 'r')) if opt.output else \
+            {'label' : opt.label or _revision(), 'results' : results}
+      compare_results(old, new, sys.stdout)
@@ -284,7 +284,7 @@ def read_dx(fname):
          elif len(last_data) == 1:
             x = float(last_data[0])
             return_obj[xpt][ypt][zpt] = x
-         elif len(rematch.groups()) == 2:
+         elif len(last_data) == 2:
             x, y = float(last_data[0]), float(last_data[1])
             return_obj[xpt][ypt][zpt] = x
             xpt, ypt, zpt = increment(xpt, ypt, zpt, return_obj.shape)
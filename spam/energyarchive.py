@@ -0,0 +1,325 @@
+"""
+This module contains an indexed archive of the NAMD energies of every site. It
+replaces the thousands of small per-site output files with a single zip file
+holding one uncompressed .npy member per site, so any site can be read (or
+memory-mapped) directly by its number.
+"""
+from __future__ import division
+import os
+import struct
+import zipfile
+import zlib
+from io import BytesIO
+import numpy as np
+from numpy.lib import format as npformat
+from spam.exceptions import FileExists, InputError, NoFileExists
+
+overwrite = False
+
+class EnergyArchive(object):
+   """
+   Zip archive with the energies of each site stored as a one-record .npy
+   member (one subarray field per energy term) and, optionally, its NAMD log
+   """
+
+   def __init__(self, fname, mode='r'):
+      """
+      Opens the archive fname for reading ('r'), writing a new one ('w') or
+      adding to an existing one ('a'). An archive opened for adding that was
+      never closed is rebuilt first (see recover), and the sites recovered
+      from it are kept in the recovered attribute
+      """
+      global overwrite
+      if mode not in ('r', 'w', 'a'):
+         raise InputError("Bad archive mode %s" % mode)
+      if mode == 'r' and not os.path.exists(fname):
+         raise NoFileExists("Cannot find energy archive %s" % fname)
+      if mode == 'w' and not overwrite and os.path.exists(fname):
+         raise FileExists("%s exists. Not overwriting" % fname)
+      if mode == 'a' and not os.path.exists(fname):
+         mode = 'w'
+      self.fname = fname
+      self.mode = mode
+      self.recovered = None
+      # zipfile would quietly start a new archive after the end of a file
+      # whose index it cannot read, hiding the sites that are already in it
+      if mode == 'a':
+         try:
+            zipfile.ZipFile(fname, 'r', allowZip64=True).close()
+         except zipfile.BadZipfile:
+            self.recovered = recover(fname)
+      try:
+         self.zip = zipfile.ZipFile(fname, mode, zipfile.ZIP_STORED,
+                                    allowZip64=True)
+      except zipfile.BadZipfile:
+         # The index is only written when the archive is closed
+         raise InputError("%s is not a complete energy archive! It may not "
+                          "have been closed properly, in which case "
+                          "energyarchive.recover can rebuild it" % fname)
+
+   @staticmethod
+   def _energy_name(site):
+      return 'site%06d.npy' % site
+
+   @staticmethod
+   def _log_name(site):
+      return 'site%06d.log' % site
+
+   def close(self):
+      """ Closes the archive (writing its index if it was being written) """
+      self.zip.close()
+
+   def sites(self):
+      """ Sorted list of the sites in the archive """
+      return sorted([int(name[4:10]) for name in self.zip.namelist()
+                     if name.endswith('.npy')])
+
+   def has_site(self, site):
+      """ Whether the archive has energies for site """
+      try:
+         self.zip.getinfo(self._energy_name(site))
+      except KeyError:
+         return False
+      return True
+
+   def fingerprint(self, site):
+      """ Checksum and size of the energies of site, to tell if they changed """
+      info = self._getinfo(site)
+      return '%08x:%d' % (info.CRC & 0xffffffff, info.file_size)
+
+   def add_site(self, site, data, log=None):
+      """
+      Stores the dict of energies of site, plus its NAMD log (compressed) if
+      given
+      """
+      if self.mode == 'r':
+         raise InputError("Energy archive %s is read-only!" % self.fname)
+      if self.has_site(site):
+         raise FileExists("Site %d is already in %s" % (site, self.fname))
+      nframes = len(data.values()[0])
+      table = np.zeros(1, dtype=[(key, np.float64, (nframes,))
+                                 for key in data])
+      for key in data:
+         table[key][0] = data[key]
+      buf = BytesIO()
+      np.save(buf, table)
+      self.zip.writestr(self._energy_name(site), buf.getvalue())
+      if log is not None:
+         self.zip.writestr(zipfile.ZipInfo(self._log_name(site)), log,
+                           zipfile.ZIP_DEFLATED)
+      # Get the site onto disk now, so recover can find it even if we never
+      # get to close the archive
+      self.zip.fp.flush()
+
+   def read_site(self, site, keys=None, mmap=True):
+      """
+      Returns the dict of energies of site, restricted to the terms in keys if
+      given. With mmap, the energies are read-only arrays mapped straight from
+      the archive file
+      """
+      info = self._getinfo(site)
+      if mmap and info.compress_type == zipfile.ZIP_STORED:
+         table = self._map_member(info)
+      else:
+         table = np.load(BytesIO(self.zip.read(info.filename)))
+      if keys is None:
+         keys = table.dtype.names
+      data = {}
+      for key in keys:
+         if key not in table.dtype.names:
+            raise InputError("No %s energies for site %d in %s!" % (key, site,
+                             self.fname))
+         data[key] = table[key][0]
+      return data
+
+   def read_log(self, site):
+      """ Returns the NAMD log of site, or None if it was not stored """
+      try:
+         return self.zip.read(self._log_name(site))
+      except KeyError:
+         return None
+
+   def _getinfo(self, site):
+      try:
+         return self.zip.getinfo(self._energy_name(site))
+      except KeyError:
+         raise InputError("No energies for site %d in %s!" % (site, self.fname))
+
+   def _map_member(self, info):
+      """ Memory-maps the array in the uncompressed member described by info """
+      archive = open(self.fname, 'rb')
+      try:
+         # Skip the local file header, which has its own name and extra field
+         archive.seek(info.header_offset)
+         header = archive.read(30)
+         namelen, extralen = struct.unpack('<HH', header[26:30])
+         archive.seek(info.header_offset + 30 + namelen + extralen)
+         version = npformat.read_magic(archive)
+         if version == (1, 0):
+            shape, fortran, dtype = npformat.read_array_header_1_0(archive)
+         else:
+            shape, fortran, dtype = npformat.read_array_header_2_0(archive)
+         offset = archive.tell()
+      finally:
+         archive.close()
+      return np.memmap(self.fname, dtype=dtype, mode='r', offset=offset,
+                       shape=shape)
+
+def _scan_members(archive):
+   """
+   Returns the (ZipInfo, data offset) of every complete member of the open zip
+   file archive, found by walking its local headers from the start. This does
+   not need the central directory, so it works on archives that were never
+   closed
+   """
+   archive.seek(0, 2)
+   size = archive.tell()
+   archive.seek(0)
+   members = []
+   while True:
+      header = archive.read(30)
+      if len(header) < 30 or header[:4] != zipfile.stringFileHeader:
+         break
+      (flags, method, mtime, mdate, crc, csize, usize, namelen,
+       extralen) = struct.unpack('<4x5H3L2H', header)[1:]
+      name = archive.read(namelen)
+      extra = archive.read(extralen)
+      # Sizes only written after the data cannot be trusted in a broken file
+      if flags & 0x08 or len(name) < namelen or len(extra) < extralen:
+         break
+      # Zip64 sizes are in the extra field
+      while len(extra) >= 4:
+         tag, length = struct.unpack('<HH', extra[:4])
+         if tag == 1 and length >= 16:
+            usize, csize = struct.unpack('<QQ', extra[4:20])
+         extra = extra[4+length:]
+      start = archive.tell()
+      if start + csize > size:
+         break
+      name = name.decode('utf-8' if flags & 0x800 else 'cp437')
+      info = zipfile.ZipInfo(name, ((mdate >> 9) + 1980, (mdate >> 5) & 0xf,
+                                    mdate & 0x1f, mtime >> 11,
+                                    (mtime >> 5) & 0x3f, (mtime & 0x1f) * 2))
+      info.compress_type = method
+      info.CRC, info.compress_size, info.file_size = crc, csize, usize
+      members.append((info, start))
+      archive.seek(start + csize)
+   return members
+
+def recover(fname):
+   """
+   Rebuilds the energy archive fname after whatever wrote it was killed before
+   closing it. Every member that was written completely is kept, and anything
+   after the first damaged member is dropped. Returns the sorted list of sites
+   that were recovered
+   """
+   if not os.path.exists(fname):
+      raise NoFileExists("Cannot find energy archive %s" % fname)
+   archive = open(fname, 'rb')
+   try:
+      members = _scan_members(archive)
+      if not members:
+         raise InputError("%s has no energy archive members to recover!" %
+                          fname)
+      tmpname = fname + '.tmp'
+      newzip = zipfile.ZipFile(tmpname, 'w', zipfile.ZIP_STORED,
+                               allowZip64=True)
+      try:
+         for info, start in members:
+            archive.seek(start)
+            data = archive.read(info.compress_size)
+            if info.compress_type == zipfile.ZIP_DEFLATED:
+               data = zlib.decompress(data, -15)
+            elif info.compress_type != zipfile.ZIP_STORED:
+               break
+            if zlib.crc32(data) & 0xffffffff != info.CRC:
+               break
+            newzip.writestr(info, data)
+      finally:
+         newzip.close()
+   finally:
+      archive.close()
+   # Only replace the broken archive once the new one is complete
+   os.rename(tmpname, fname)
+   recovered = EnergyArchive(fname)
+   try:
+      return recovered.sites()
+   finally:
+      recovered.close()
+
+def _write_and_die(fname, nsites, nframes):
+   """ Adds nsites sites to a new archive fname, then dies without closing it """
+   archive = EnergyArchive(fname, 'w')
+   for site in range(nsites):
+      archive.add_site(site, {'TOTAL' : np.arange(nframes) + site,
+                              'VDW' : np.ones(nframes) * site},
+                       'NAMD log of site %d\n' % site)
+   # Start one more site, as if we were killed in the middle of writing it
+   archive.zip.fp.write(zipfile.stringFileHeader + 'truncated')
+   archive.zip.fp.flush()
+   os._exit(0)
+
+def _test_killed_run(fname, nsites=5, nframes=20):
+   """ Checks that a killed run's archive fname can be resumed """
+   from multiprocessing import Process
+   if os.path.exists(fname):
+      os.remove(fname)
+   writer = Process(target=_write_and_die, args=(fname, nsites, nframes))
+   writer.start()
+   writer.join()
+   try:
+      EnergyArchive(fname).close()
+      print 'Reading the unclosed archive did not fail!'
+   except InputError:
+      print 'Reading the unclosed archive fails [True]'
+   archive = EnergyArchive(fname, 'a')
+   print 'Recovered sites %s [%s]' % (archive.recovered,
+                                      archive.recovered == range(nsites))
+   archive.add_site(nsites, {'TOTAL' : np.zeros(nframes),
+                             'VDW' : np.zeros(nframes)})
+   archive.close()
+   archive = EnergyArchive(fname)
+   print 'Resumed archive has every site [%s]' % (archive.sites() ==
+                                                 range(nsites + 1))
+   print 'Recovered energies are intact [%s]' % all([
+         np.array_equal(archive.read_site(i)['TOTAL'], np.arange(nframes) + i)
+         and archive.read_log(i) == 'NAMD log of site %d\n' % i
+         for i in range(nsites)])
+   archive.close()
+
+def test(args):
+   """ Summarizes an energy archive """
+   from optparse import OptionParser
+
+   parser = OptionParser(usage='%prog [options] archive')
+   parser.add_option('-s', '--site', dest='site', type='int', default=None,
+                     metavar='INT', help='Print the TOTAL energies of this site')
+   parser.add_option('-r', '--recover', dest='recover', default=False,
+                     action='store_true', help='Rebuild an archive that was ' +
+                     'never closed first')
+   parser.add_option('-k', '--killed-run', dest='killed', default=False,
+                     action='store_true', help='Write the archive in a ' +
+                     'process that is killed before closing it, then check ' +
+                     'that adding to it recovers every site')
+   opt, arg = parser.parse_args(args)
+
+   if len(arg) != 1:
+      parser.print_help()
+      return
+
+   if opt.killed:
+      _test_killed_run(arg[0])
+      return
+
+   if opt.recover:
+      print 'Recovered %d sites' % len(recover(arg[0]))
+   archive = EnergyArchive(arg[0])
+   sites = archive.sites()
+   print 'Energy archive [%s] has %d sites' % (arg[0], len(sites))
+   for site in sites:
+      data = archive.read_site(site, ['TOTAL'])
+      print '   Site %6d: %8d frames, <TOTAL> = %.4f' % (site,
+            len(data['TOTAL']), data['TOTAL'].mean())
+   if opt.site is not None:
+      for val in archive.read_site(opt.site, ['TOTAL'])['TOTAL']: print val
+   archive.close()
@@ -0,0 +1,151 @@
+"""
+This module contains a stand-in for NAMD that the test drivers of workqueue and
+namdtune run in place of the real program, so the code that writes NAMD inputs,
+runs NAMD and collects its energies can be exercised without it. It reads the
+NAMD input written by namdcalc.write_input, checks that the files it names are
+there, and prints ETITLE:/ENERGY: records for the frames the input asks for.
+The energies are a simple function of the labeled residue, the frame and the
+nonbonded settings (see site_energies), so callers can check what they got.
+
+A few environment variables change what it does:
+   FAKENAMD_DELAY  Seconds to spend on each frame (scaled by the cube of the
+                   pair list distance over 14 Angstroms, like the real cost)
+   FAKENAMD_HANG   RESIDUE:FILE -- hang on the labeled residue RESIDUE (from
+                   1) unless FILE exists, creating FILE first, so only the
+                   first run of that residue hangs
+   FAKENAMD_FAIL   Exit with an error after printing the energies
+"""
+from __future__ import division
+import os
+import re
+import sys
+import time
+import numpy as np
+
+# Energy terms printed in every ENERGY: record, in NAMD's order
+ENERGY_KEYS = ('TS', 'BOND', 'ANGLE', 'DIHED', 'IMPRP', 'ELECT', 'VDW',
+               'BOUNDARY', 'MISC', 'KINETIC', 'TOTAL', 'TEMP', 'POTENTIAL',
+               'TOTAL3', 'TEMPAVG')
+# How much (kcal/mol) ELECT drifts for every Angstrom**2 the cutoff is below
+# 12 Angstroms, and for every Angstrom the PME grid spacing is above 1
+CUTOFF_DRIFT = 0.002
+PMEGRID_DRIFT = 0.05
+# Seconds to hang for with FAKENAMD_HANG
+HANG_TIME = 86400.0
+
+def site_energies(residue, frames, cutoff=12.0, pmegrid=1.0):
+   """
+   Returns the dict of ELECT, VDW and TOTAL energies the stand-in prints for
+   the labeled residue (numbered from 1) on the given frames (from 0)
+   """
+   frames = np.asarray(frames, dtype=np.float64)
+   drift = CUTOFF_DRIFT * (12.0 - cutoff) ** 2 + PMEGRID_DRIFT * (pmegrid - 1)
+   elect = -15.0 + 2.0 * np.sin(0.37 * frames + residue) + drift
+   vdw = 1.0 + 0.5 * np.cos(0.23 * frames + 2 * residue)
+   return {'ELECT' : elect, 'VDW' : vdw, 'TOTAL' : elect + vdw}
+
+def _setting(inp, name, default=None):
+   """ Value of the NAMD keyword name in the input inp """
+   rematch = re.search(r'^%s[\s=]+(\S+)' % name, inp, re.M)
+   if rematch is None:
+      if default is None:
+         raise ValueError('No %s in the NAMD input!' % name)
+      return default
+   return rematch.group(1)
+
+def labeled_residue(lines):
+   """
+   Number of the residue labeled for the pair interaction in the lines of a
+   PDB file (e.g., an open file)
+   """
+   for line in lines:
+      if line[:6] in ('ATOM  ', 'HETATM') and float(line[54:60]) == 2.0:
+         return int(line[22:26])
+   raise ValueError('No residue is labeled in the PDB file!')
+
+def input_frames(inp):
+   """ Frames (from 0) that a NAMD input from namdcalc.write_input runs on """
+   from spam.namdcalc import dcd_frame_count
+   total = dcd_frame_count(_setting(inp, 'coorfile open dcd'))
+   rematch = re.search(r'foreach next \{\n(.*?)\n\}', inp, re.S)
+   if rematch is not None:
+      return [int(frame) for frame in rematch.group(1).split()
+              if int(frame) < total]
+   first = int(re.search(r'\$i < (\d+)\}', inp).group(1))
+   num = int(re.search(r'set frames_left (-?\d+)', inp).group(1))
+   last = total if num < 0 else min(total, first + num)
+   return range(first, last)
+
+def run(args, output=sys.stdout):
+   """
+   Runs like NAMD would on the command line args (e.g., ['+p2', 'input']),
+   printing to output. Returns the exit status
+   """
+   inp = open(args[-1], 'r').read()
+   for name in ('parmfile', 'ambercoor', 'pairInteractionFile'):
+      fname = _setting(inp, name)
+      if not os.path.exists(fname):
+         output.write('FATAL ERROR: Unable to open %s file %s\n' %
+                      (name, fname))
+         return 1
+   residue = labeled_residue(open(_setting(inp, 'pairInteractionFile'), 'r'))
+   cutoff = float(_setting(inp, 'cutoff'))
+   pairlistdist = float(_setting(inp, 'pairlistdist'))
+   pmegrid = 1.0
+   if _setting(inp, 'PME', 'off').lower() in ('on', 'yes'):
+      pmegrid = float(_setting(inp, 'PMEGridSpacing'))
+   frames = input_frames(inp)
+
+   hang = os.getenv('FAKENAMD_HANG')
+   if hang is not None:
+      hangres, marker = hang.split(':', 1)
+      if int(hangres) == residue and not os.path.exists(marker):
+         open(marker, 'w').close()
+         time.sleep(HANG_TIME)
+   delay = float(os.getenv('FAKENAMD_DELAY', '0'))
+   delay *= (pairlistdist / 14.0) ** 3
+
+   energies = site_energies(residue, frames, cutoff, pmegrid)
+   etitle = 'ETITLE:      ' + ''.join(['%15s' % key for key in ENERGY_KEYS])
+   output.write('Info: NAMD STAND-IN FOR SPAM TESTS\n')
+   for i, frame in enumerate(frames):
+      if delay > 0: time.sleep(delay)
+      values = np.zeros(len(ENERGY_KEYS) - 1)
+      for key in energies:
+         values[ENERGY_KEYS.index(key) - 1] = energies[key][i]
+      output.write('%s\n\n' % etitle)
+      output.write('ENERGY: %7d' % ((frame + 1) * 1000) +
+                   ''.join(['%15.4f' % val for val in values]) + '\n\n')
+      output.flush()
+   # NAMD writes the final coordinates, velocities and cell at the end
+   outname = _setting(inp, 'outputname')
+   for suffix in ('.coor', '.vel', '.xsc'):
+      open(outname + suffix, 'w').close()
+   if os.getenv('FAKENAMD_FAIL'):
+      output.write('FATAL ERROR: FAKENAMD_FAIL is set\n')
+      return 1
+   output.write('WallClock: 0.000000  CPUTime: 0.000000\n')
+   return 0
+
+def write_executable(fname):
+   """
+   Writes a script fname that runs the stand-in with this Python interpreter,
+   and returns its absolute path (e.g., to set checkprogs.NAMD_NAME to)
+   """
+   package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+   script = open(fname, 'w')
+   script.write('#!%s\n' % sys.executable)
+   script.write('import sys\n')
+   script.write('sys.path.insert(0, %r)\n' % package)
+   script.write('from spam import fakenamd\n')
+   script.write('sys.exit(fakenamd.run(sys.argv[1:]))\n')
+   script.close()
+   os.chmod(fname, 0755)
+   return os.path.abspath(fname)
+
+def test(args):
+   """ Runs the stand-in on a NAMD input file """
+   if len(args) < 1:
+      print 'Usage: fakenamd.test([+pN,] namd_input)'
+      return
+   sys.exit(run(args))
@@ -261,10 +261,11 @@ class TrajReorderFrame(ActionFrame):
 class SpamCalcFrame(ActionFrame):
    """ Frame for controlling the spam calculation """
    widget_keys = ['Number of Subsamples', 'Size of Subsample',
-                  'Number of Processors for NAMD', 'Clean Temporary Files']
-   widget_types = [NumEntry, NumEntry, NumEntry, ButtonEntry]
-   vartypes = [IntVar, IntVar, IntVar, StringVar]
-   defaults = [1, -1, 0, '']
+                  'Number of Processors for NAMD',
+                  'Number of Processes for Statistics', 'Clean Temporary Files']
+   widget_types = [NumEntry, NumEntry, NumEntry, NumEntry, ButtonEntry]
+   vartypes = [IntVar, IntVar, IntVar, IntVar, StringVar]
+   defaults = [1, -1, 0, 1, '']
    help = [ #1
             'Number of different random subsamples to take from the full '
             'distribution of energies.  Multiple subsamples will give an '
@@ -277,6 +278,9 @@ class SpamCalcFrame(ActionFrame):
             'Number of processors to use for NAMD calculations. < 1 means use '
             'all available processors.',
             #4
+            'Number of processes to spread the sites over when computing the '
+            'SPAM statistics. < 1 means use all available processors.',
+            #5
             'Get rid of all temporary files with the defined filename prefix '
             '(typically _SPAM_)'
           ]
@@ -292,9 +296,9 @@ class SpamCalcFrame(ActionFrame):
 
    def cmd(self):
       """ This runs NAMD and collects the SPAM statistics """
-      import math
       from spam.gui.spam_windows import TextWindow
-      from spam.main import run_namd, spam_energies
+      from spam.main import completed_sites, run_namd, spam_energies
+      from spam.namdcalc import dcd_frame_count
       from spam.xyzpeaks import read_xyz_peaks
       if global_spam_files['namd'] is None or not \
                   exists(global_spam_files['namd']):
@@ -321,18 +325,13 @@ class SpamCalcFrame(ActionFrame):
          return
 
       # Determine if we need to run NAMD by checking if the necessary output
-      # files are there.  This allows us to play with the sampling of the
-      # final energies without having to take hours to recalculate the energies
-      # each time.
-      need_energies = False
+      # files are there and complete.  This allows us to play with the sampling
+      # of the final energies without having to take hours to recalculate the
+      # energies each time, and to pick up where an unfinished run stopped.
       peaks = read_xyz_peaks(global_spam_files['xyz'])
-      numdigits = int(math.log10(len(peaks)))
-      for i in range(len(peaks)):
-         if not exists('%s.%s.out' % (global_spam_files['namdout'], 
-                                  str(i).zfill(numdigits))
-                      ):
-            need_energies = True
-            break
+      done = completed_sites(global_spam_files['namdout'], len(peaks),
+                             dcd_frame_count(global_spam_files['traj']))
+      need_energies = len(done) < len(peaks)
       
       # Extract the variables
       try:
@@ -340,6 +339,7 @@ class SpamCalcFrame(ActionFrame):
          samplesize = self.variables[1].get()
          nproc = self.variables[2].get()
          nproc = max(nproc, 0)
+         jobs = self.variables[3].get()
       except ValueError:
          showwarning('Bad Data Types', 'Could not convert all input variables '
                      'to the appropriate data types. Please check this.',
@@ -367,7 +367,8 @@ class SpamCalcFrame(ActionFrame):
             run_namd(global_spam_files['pdb'], global_spam_files['traj'],
                      self.master.parm, global_spam_files['incrd'],
                      global_spam_files['namdout'],
-                     global_spam_files['xyz'], self.messages, progress)
+                     global_spam_files['xyz'], self.messages, progress,
+                     resume=True)
          except (BaseSpamError, BaseSpamWarning), err:
             showwarning('SPAM Failed!', '%s: %s' % (type(err).__name__, err),
                         parent=self)
@@ -387,7 +388,7 @@ class SpamCalcFrame(ActionFrame):
       try:
          spam_energies(global_spam_files['namdout'], 
                        global_spam_files['spaminfo'], samplesize, 
-                       subsamples, self.results_window)
+                       subsamples, self.results_window, jobs=jobs)
       except (BaseSpamError, BaseSpamWarning), err:
          showwarning('SPAM Failed!', '%s : %s' % (type(err).__name__, err),
                      parent=self)
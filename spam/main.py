@@ -11,15 +11,20 @@ with a 'write' attribute) and the topology file is an AmberParm object
 from __future__ import division
 import os
 import sys
+import threading
 from spam import AmberMask
 from spam import AmberParm
-from spam import (checkprogs, dx, namdcalc, namdpdb, spaminfo,
-                  spamstats, traj, xyzpeaks)
+from spam import (checkprogs, dx, energyarchive, namdcalc, namdpdb, namdtune,
+                  spaminfo, siteresults, spamstats, statscache, traj, trimsys,
+                  workqueue, xyzpeaks)
 from spam.exceptions import *
 
 # Filename prefix
 FN_PRE = '_SPAM_'
 
+# Processors to give each NAMD job when run_namd picks the number of jobs
+CORES_PER_NAMD_JOB = 4
+
 def setup_peaks_file(trajins, 
                      gridmask, 
                      center,
@@ -110,8 +115,54 @@ def reorder_trajectory(trajin,
             dummycrd=dummycrd)
 
 def run_namd(pdbname, inptraj, top, inpcrd, namd_output, peakfile, logfile,
-             progress):
-   """ Runs NAMD over a trajectory to generate energies """
+             progress, stream=False, namd_log='keep', archive=None,
+             namd_jobs=1, namd_chunks=1, info=None, periodic=True,
+             resume=False, queue=None, queue_key='', pmegrid=1.0,
+             nonbonded=None, min_frames=0, min_occupancy=0.0,
+             included_only=False, queue_lease=workqueue.LEASE_TIMEOUT):
+   """
+   Runs NAMD over a trajectory to generate energies. If stream is True, the
+   energies of each site are read straight from NAMD's output and stored in
+   binary, and namd_log says what to do with the rest of the NAMD output (see
+   namdcalc.run_namd)
+
+   If archive is given, the energies (and NAMD log, unless it is discarded) of
+   every site are collected in that energy archive (see spam.energyarchive),
+   and the PDB, input and output files of each site are deleted once it is
+   done
+
+   namd_jobs sites are run at the same time, and the processors NAMD may use
+   (namdcalc.get_num_procs) are split evenly between them. If namd_jobs < 1,
+   one job is run for every CORES_PER_NAMD_JOB processors. The frames of each
+   site are split into namd_chunks chunks that are run at the same time on the
+   processors of its job (see namdcalc.run_namd). When several NAMD instances
+   run at once, each job is pinned to its own set of processors, if there are
+   enough of them (see namdcalc.split_cpus)
+
+   If info (a SPAM info file) is given and included_only is True, NAMD is only
+   run on the frames each site includes. The energies record which frames they
+   belong to, so they are filtered just like full ones later on. Sites with
+   fewer than min_frames included frames, or included in less than the
+   fraction min_occupancy of the frames, are not run at all (see
+   SpamInfo.pruned_sites), which needs info too. If periodic is False, the
+   system is not treated as periodic by NAMD
+
+   If resume is True, sites whose energies are already complete (see
+   completed_sites) are skipped, and the leftover files of the others are
+   replaced. Sites left in their own output files are added to the archive,
+   and an archive a killed run never closed is rebuilt from the sites that
+   made it to disk (see energyarchive.recover)
+
+   If queue (HOST:PORT) is given, NAMD is not run here. Instead, the sites are
+   served from that address to NAMD workers (see spam.workqueue), which may be
+   on other hosts, and their energies are stored as if stream were True and
+   namd_log were 'discard'. Serving anywhere but this host needs queue_key
+   (see workqueue.Coordinator). A site is handed out again if its energies are
+   not back within queue_lease seconds
+
+   pmegrid and nonbonded (e.g., from tune_namd_settings) are passed on to
+   namdcalc.write_input
+   """
    import math
    if not os.path.exists(pdbname):
       raise NoFileExists("Cannot find template PDB file %s!" % pdbname)
@@ -126,36 +177,445 @@ def run_namd(pdbname, inptraj, top, inpcrd, namd_output, peakfile, logfile,
    # Format our numbers to have the correct number of leading zeroes when
    # necessary, but always the fewest leading zeroes possible.
    numdigits = int(math.log10(len(peaklist)))
+   infoobj = None
+   if info is not None:
+      infoobj = spaminfo.SpamInfo(info)
+      if infoobj.peaks != len(peaklist):
+         raise SpamInfoError("Found %d peaks in %s, but %d in %s!" %
+                             (len(peaklist), peakfile, infoobj.peaks, info))
+   pruned = set()
+   if min_frames > 0 or min_occupancy > 0:
+      if infoobj is None:
+         raise InputError("Need a SPAM info file to prune sites by their "
+                          "included frames!")
+      pruned = set(infoobj.pruned_sites(min_frames, min_occupancy))
+   # Split our processors between the NAMD jobs
+   namd_jobs, cores = _namd_job_cores(namd_jobs, len(peaklist))
+   # Processors not used by a running job. Each thread of the pool checks out
+   # one set at a time, so there is always one free
+   free_cpus = None
+   if namd_jobs > 1 or namd_chunks > 1:
+      free_cpus = namdcalc.split_cpus(namd_jobs, cores)
+   energy_archive = None
+   if archive is not None:
+      energy_archive = energyarchive.EnergyArchive(archive,
+                                                   'a' if resume else 'w')
+      if energy_archive.recovered is not None:
+         logfile.write("Recovered %d sites from the unclosed energy archive "
+                       "%s\n" % (len(energy_archive.recovered), archive))
+   done = set()
+   if resume:
+      done = completed_sites(namd_output, len(peaklist),
+                             namdcalc.dcd_frame_count(inptraj), infoobj,
+                             energy_archive, included_only)
+   # The PDB template, archive, log and progress bar are shared by every job
+   lock = threading.Lock()
+
+   def site_frames(i):
+      """ Frames NAMD should do for site i (None for all of them) """
+      # A site with no included frames gets all of them, which filter to none
+      if (included_only and infoobj is not None and
+            infoobj.num_included_frames(i) > 0):
+         return infoobj.included_frame_indices(i)
+      return None
+
+   def run_site(i):
+      """ Runs NAMD for a single site """
+      tmppdbname = '%s.%s' % (pdbname, str(i).zfill(numdigits))
+      tmpoutname = '%s.%s' % (namd_output, str(i).zfill(numdigits))
+      tmpinpname = FN_PRE + 'namd_input.%s' % (str(i).zfill(numdigits))
+      if i in pruned:
+         with lock: progress.update()
+         return
+      if i in done:
+         with lock:
+            if energy_archive is not None and not energy_archive.has_site(i):
+               _archive_site(energy_archive, i, tmpoutname + '.out', True,
+                             [tmppdbname, tmpinpname])
+            progress.update()
+         return
+      if resume:
+         _remove_site_files(tmpoutname, [tmppdbname, tmpinpname])
+      with lock:
+         # Generate a PDB file then unlabel the residue
+         pdbtemplate.label_residue(firstwat + i)
+         pdbtemplate.write_to_pdb(tmppdbname)
+         pdbtemplate.unlabel()
+         logfile.write("NAMD: Calculating site %%%dd\n" % numdigits % (i+1))
+         cpus = free_cpus.pop() if free_cpus else None
+      frames = site_frames(i)
+      try:
+         namdcalc.run_namd(tmppdbname, inptraj, top, incrd_name=inpcrd,
+                           input_name=tmpinpname, namd_output=tmpoutname,
+                           stream=stream, log=namd_log, nproc=cores,
+                           chunks=namd_chunks, frames=frames,
+                           periodic=periodic, cpus=cpus, pmegrid=pmegrid,
+                           nonbonded=nonbonded)
+      finally:
+         if cpus is not None:
+            with lock: free_cpus.append(cpus)
+      with lock:
+         if energy_archive is not None:
+            _archive_site(energy_archive, i, tmpoutname + '.out', stream,
+                          [tmppdbname, tmpinpname])
+         progress.update()
+
+   def serve_sites():
+      """ Hands the sites out to NAMD workers """
+      import numpy as np
+      nframes = namdcalc.dcd_frame_count(inptraj)
+      jobs = {}
+      for i in range(len(peaklist)):
+         if i in done or i in pruned:
+            run_site(i)
+            continue
+         tmpoutname = '%s.%s' % (namd_output, str(i).zfill(numdigits))
+         if resume:
+            _remove_site_files(tmpoutname, [])
+         elif not overwrite:
+            for fname in (tmpoutname + '.out',
+                          namdcalc.sidecar_name(tmpoutname + '.out')):
+               if os.path.exists(fname):
+                  raise FileExists("%s exists. Not overwriting" % fname)
+         frames = site_frames(i)
+         jobs[i] = workqueue.make_job(i, pdbtemplate, firstwat + i, inptraj,
+                                      top, inpcrd, nframes if frames is None
+                                      else len(frames), frames, periodic,
+                                      pmegrid, nonbonded)
+
+      def store_result(i, data):
+         data = dict([(key, np.array(data[key])) for key in data])
+         outname = '%s.%s.out' % (namd_output, str(i).zfill(numdigits))
+         with lock:
+            if energy_archive is not None:
+               energy_archive.add_site(i, data)
+            else:
+               namdcalc.write_sidecar(outname, data)
+
+      host, port = workqueue.parse_address(queue)
+      coordinator = workqueue.Coordinator(jobs, store_result, host, port,
+                                          queue_key, logfile, progress,
+                                          queue_lease)
+      logfile.write("Serving %d sites to NAMD workers on port %d\n" %
+                    (len(jobs), coordinator.address[1]))
+      failed = coordinator.run()
+      if failed:
+         raise SpamNamdError("NAMD failed on %d sites: %s" % (len(failed),
+               ', '.join(['%d (%s)' % (i + 1, failed[i])
+                          for i in sorted(failed)])))
+
    # Loop over every peak we have
    logfile.write("Beginning NAMD calculations on %d sites\n" % len(peaklist))
+   if resume:
+      logfile.write("Resuming: %d sites are already done\n" % len(done))
+   if pruned:
+      logfile.write("Skipping %d sites with too few included frames: %s\n" %
+                    (len(pruned), ' '.join(['%d' % (i + 1)
+                                            for i in sorted(pruned)])))
+   if namd_jobs > 1 and queue is None:
+      logfile.write("Running %d NAMD jobs at once with %d processors each\n" %
+                    (namd_jobs, cores))
+   if free_cpus:
+      logfile.write("Pinning NAMD jobs to processors %s\n" % ' | '.join(
+                    [','.join(['%d' % cpu for cpu in cpus])
+                     for cpus in free_cpus]))
    progress.initialize(len(peaklist))
-   for i in range(len(peaklist)):
-      # Generate a PDB file then unlabel the residue
+   pool = None
+   try:
+      if queue is not None:
+         serve_sites()
+      elif namd_jobs == 1:
+         for i in range(len(peaklist)):
+            run_site(i)
+      else:
+         # Threads are enough here, since all of the work is done by NAMD
+         from multiprocessing.pool import ThreadPool
+         pool = ThreadPool(namd_jobs)
+         for i in pool.imap_unordered(run_site, range(len(peaklist))):
+            pass
+         pool.close()
+   except:
+      if pool is not None: pool.terminate()
+      raise
+   finally:
+      if pool is not None: pool.join()
+      # The archive index is only written when it is closed. Sites are on
+      # disk as soon as they are added, though, so energyarchive.recover can
+      # rebuild the index if we never get here
+      if energy_archive is not None: energy_archive.close()
+
+def completed_sites(namd_output, nsites, nframes, infoobj=None, archive=None,
+                    included_only=False):
+   """
+   Returns the set of sites (out of nsites) whose energies are complete, i.e.
+   have one frame for each of the nframes frames of the trajectory (or, if
+   included_only is True, for each frame the site includes in the SpamInfo
+   infoobj, as run_namd runs them). The energies of a site may be in the open
+   EnergyArchive archive or in its NAMD output file (or sidecar) from
+   run_namd. The records are counted first, so only sites with the right
+   number of them are read to check that they are the expected frames (see
+   namdcalc.timestep_frames). Energies that do not say which frames they are
+   only count as complete if they cover the whole trajectory
+   """
+   import numpy as np
+   done = set()
+   for i in range(nsites):
+      expected = None
+      if (included_only and infoobj is not None and
+            infoobj.num_included_frames(i) > 0):
+         expected = infoobj.included_frame_indices(i)
+      nexpected = nframes if expected is None else len(expected)
+      fname = namdcalc.site_output_name(namd_output, i, nsites)
+      if archive is not None and archive.has_site(i):
+         data = archive.read_site(i)
+         count = len(data.values()[0])
+         if count != nexpected: continue
+         frames = namdcalc.timestep_frames(data.get('TS'))
+      else:
+         count = namdcalc.output_frame_count(fname)
+         if count != nexpected: continue
+         frames = namdcalc.NamdPairOutput(fname, []).frames
+      if expected is None:
+         expected = np.arange(nframes)
+         if frames is None:
+            frames = expected
+      if frames is not None and np.array_equal(frames, expected):
+         done.add(i)
+   return done
+
+def _remove_site_files(namd_output, tmpfiles):
+   """
+   Removes what an earlier, unfinished run_namd left behind for the site whose
+   NAMD output is named namd_output, along with the files in tmpfiles
+   """
+   import glob
+   outname = namd_output + '.out'
+   fnames = tmpfiles + [outname, outname + '.gz', namdcalc.sidecar_name(outname)]
+   # Chunked runs (see namdcalc.run_namd)
+   for fname in tmpfiles + [namd_output]:
+      fnames.extend(glob.glob(fname + '.chunk*'))
+   for fname in fnames:
+      if os.path.exists(fname): os.remove(fname)
+
+def trim_namd_system(pdbname, inptraj, top, inpcrd, peakfile, cpptraj, margin,
+                     report, logfile, resume=False, allow_mismatch=False):
+   """
+   Writes a trimmed copy of the system (in the same periodic box) holding only
+   the residues near the sites (see spam.trimsys), and a report to report
+   comparing its energies to the full system on sample frames. Returns the
+   PDB, trajectory, topology (AmberParm) and dummy inpcrd of the trimmed
+   system. If the energies differ by more than trimsys.VALIDATION_TOLERANCE,
+   the trimmed system is deleted and SpamNamdError is raised, unless
+   allow_mismatch is True. If resume is True, a trimmed system that was
+   already written (and so passed that check) is used as it is
+   """
+   trim_pdb = FN_PRE + 'trimmed.pdb'
+   trim_traj = FN_PRE + 'trimmed.dcd'
+   trim_prmtop = FN_PRE + 'trimmed.prmtop'
+   trim_crd = FN_PRE + 'trimmed.inpcrd'
+   if resume and all([os.path.exists(fname) for fname in
+                      (trim_pdb, trim_traj, trim_prmtop, trim_crd)]):
+      logfile.write("Using the trimmed system in %s\n" % trim_prmtop)
+      return trim_pdb, trim_traj, AmberParm(trim_prmtop), trim_crd
+   firstwat = top.parm_data['RESIDUE_LABEL'].index('WAT')
+   npeaks = len(xyzpeaks.read_xyz_peaks(peakfile))
+   logfile.write("Trimming the system to %.1f Angstroms around the sites\n" %
+                 (trimsys.CUTOFF + margin))
+   residues = trimsys.trim_system(inptraj, top, peakfile, firstwat, cpptraj,
+                                  trim_prmtop, trim_traj, trim_pdb, trim_crd,
+                                  margin=margin, logfile=logfile)
+   logfile.write("Kept %d of %d residues\n" % (len(residues),
+                 len(top.parm_data['RESIDUE_LABEL'])))
+   trim_top = AmberParm(trim_prmtop)
+   if not trim_top.valid:
+      raise InputError("cpptraj wrote a bad trimmed topology %s!" % trim_prmtop)
+   worst = trimsys.validate_trimmed(pdbname, inptraj, top, inpcrd, trim_pdb,
+                                    trim_traj, trim_top, trim_crd, npeaks,
+                                    report)
+   logfile.write("Largest difference between trimmed and full energies is "
+                 "%.4f kcal/mol (see %s)\n" % (worst, report))
+   if worst > trimsys.VALIDATION_TOLERANCE:
+      if not allow_mismatch:
+         # Do not let a resumed run pick up the trimmed system
+         for fname in (trim_pdb, trim_traj, trim_prmtop, trim_crd):
+            if os.path.exists(fname): os.remove(fname)
+         raise SpamNamdError("Trimmed energies differ from the full ones by "
+                             "%.4f kcal/mol, above the %.2f kcal/mol "
+                             "tolerance! Use a larger --trim-margin (or "
+                             "--trim-allow-mismatch)" % (worst,
+                             trimsys.VALIDATION_TOLERANCE))
+      logfile.write("WARNING: This is above the %.2f kcal/mol tolerance, but "
+                    "--trim-allow-mismatch was given\n" %
+                    trimsys.VALIDATION_TOLERANCE)
+   return trim_pdb, trim_traj, trim_top, trim_crd
+
+def tune_namd_settings(pdbname, inptraj, top, inpcrd, logfile, periodic=True,
+                       namd_jobs=1, nsites=1, resume=False, cutoffs=False):
+   """
+   Picks the PME grid spacing and pair list distance NAMD runs fastest with
+   on this system while giving the same energies (see spam.namdtune), using
+   the first site and the processors each of namd_jobs jobs will get. If
+   cutoffs is True, shorter cutoffs are tried as well, checked on up to
+   namdtune.TUNE_SITES sites spread over all of them. The choice is saved,
+   and if resume is True, a saved choice is used as it is. Returns the
+   pmegrid and nonbonded settings for run_namd
+   """
+   import numpy as np
+   tunefile = FN_PRE + 'namd_tuning.json'
+   if resume and os.path.exists(tunefile):
+      logfile.write("Using the NAMD settings in %s\n" % tunefile)
+      return namdtune.read_settings(tunefile)
+   namd_jobs, cores = _namd_job_cores(namd_jobs, nsites)
+   pdbtemplate = namdpdb.read_pdb(pdbname)
+   firstwat = top.parm_data['RESIDUE_LABEL'].index('WAT')
+   if cutoffs:
+      sites = np.unique(np.linspace(0, nsites - 1, min(nsites,
+                        namdtune.TUNE_SITES)).astype(int))
+      tmppdbnames = [FN_PRE + 'tune.%d.pdb' % i for i in sites]
+   else:
+      sites = [0]
+      tmppdbnames = [FN_PRE + 'tune.pdb']
+   for i, tmppdbname in zip(sites, tmppdbnames):
       pdbtemplate.label_residue(firstwat + i)
-      tmppdbname = '%s.%s' % (pdbname, str(i).zfill(numdigits))
-      tmpoutname = '%s.%s' % (namd_output, str(i).zfill(numdigits))
       pdbtemplate.write_to_pdb(tmppdbname)
       pdbtemplate.unlabel()
-      logfile.write("NAMD: Calculating site %%%dd\n" % numdigits % (i+1))
-      namdcalc.run_namd(tmppdbname, inptraj, top, incrd_name=inpcrd,
-                 input_name=FN_PRE+'namd_input.%s' % (str(i).zfill(numdigits)),
-                 namd_output=tmpoutname)
-      progress.update()
+   logfile.write("Tuning NAMD settings on %d processors and %d sites\n" %
+                 (cores, len(sites)))
+   try:
+      best, results = namdtune.autotune(tmppdbnames, inptraj, top, inpcrd,
+                                        periodic, cores, logfile=logfile,
+                                        cutoffs=cutoffs)
+   finally:
+      for tmppdbname in tmppdbnames:
+         if os.path.exists(tmppdbname): os.remove(tmppdbname)
+   namdtune.write_settings(tunefile, best, results)
+   logfile.write("Using PMEGridSpacing %.2f, cutoff %g, switchdist %g and "
+                 "pairlistdist %g (see %s)\n" % (best['pmegrid'],
+                 best['nonbonded']['cutoff'], best['nonbonded']['switchdist'],
+                 best['nonbonded']['pairlistdist'], tunefile))
+   return best['pmegrid'], best['nonbonded']
 
-def spam_energies(namd_output, info, sample_size, num_subsamples, output):
+def _namd_job_cores(namd_jobs, nsites):
+   """
+   Returns the number of NAMD jobs to run at once on nsites sites and the
+   number of processors each one gets (see run_namd)
+   """
+   nproc = namdcalc.get_num_procs()
+   if namd_jobs < 1:
+      namd_jobs = max(1, nproc // CORES_PER_NAMD_JOB)
+   namd_jobs = max(1, min(namd_jobs, nproc, nsites))
+   return namd_jobs, nproc // namd_jobs
+
+def _archive_site(energy_archive, site, outname, stream, tmpfiles):
+   """
+   Adds the energies and log of a site from its NAMD output outname to the
+   energy archive, then deletes that output and the other files in tmpfiles
+   """
+   # A streamed run has already stored its energies in binary
+   namdout = namdcalc.NamdPairOutput(outname, sidecar=stream)
+   log = None
+   if os.path.exists(outname):
+      log = open(outname, 'r').read()
+   elif os.path.exists(outname + '.gz'):
+      import gzip
+      log = gzip.open(outname + '.gz', 'rb').read()
+   energy_archive.add_site(site, namdout.data, log)
+   for fname in tmpfiles + [outname, outname + '.gz',
+                            namdcalc.sidecar_name(outname)]:
+      if os.path.exists(fname): os.remove(fname)
+
+def spam_energies(namd_output, info, sample_size, num_subsamples, output,
+                  batched=False, estimator='grid', jobs=1, seed=None,
+                  tolerance=0, max_subsamples=0, error_method='bootstrap',
+                  temperatures=None, stats_cache=None,
+                  stats_cache_size=statscache.MAX_ENTRIES, binary_output=None,
+                  peakfile=None, archive=None, min_frames=0, min_occupancy=0.0):
    """ 
    This method calculates all of the SPAM energies and generates an output file
-   with all of the statistics.
+   with all of the statistics. If batched is True, the subsamples for each site
+   are evaluated all at once rather than one KDE at a time, which needs the
+   analytic estimator. estimator selects how the free energy is obtained from
+   each KDE (see spamstats.calc_g_wat).
+
+   The NAMD output of the sites is parsed, and their statistics computed, by a
+   pool of jobs processes (jobs < 1 means use every processor; see
+   namdcalc.iter_site_energies). Each site draws its subsamples from its own random stream seeded
+   with (seed, site number), so the output is identical for any number of jobs.
+   If seed is None, a random one is picked.
+
+   If tolerance > 0, the number of subsamples is chosen adaptively for each
+   site: batches of num_subsamples are added until the standard errors of <G>
+   and <H> fall below tolerance or max_subsamples are reached. The number of
+   subsamples used for each site is then added as a column of the output.
+
+   error_method is either 'bootstrap' (the subsampling above) or 'jackknife',
+   which estimates the uncertainties from a delete-d jackknife over
+   num_subsamples contiguous blocks of frames instead (see
+   spamstats.calc_g_wat). tolerance does not apply to the jackknife.
+
+   temperatures is an optional list of additional temperatures (K). <G>, its
+   standard deviation and -T<S> at each of them are evaluated from the same
+   KDEs as the default temperature and added as columns of the output.
+
+   If stats_cache is the name of a file, the statistics of every site are
+   stored there (keeping at most stats_cache_size sites), and sites whose NAMD
+   output, excluded frames, parameters and seed are unchanged are read back
+   from it instead of being recomputed. Since the seed is part of that key,
+   bootstrap results are only reused when the same seed is given, and they are
+   not cached at all if seed is None.
+
+   If binary_output is given, the statistics, included frame counts and peak
+   coordinates (read from peakfile, if given) of every site are also written
+   to that file in the binary format of spam.siteresults.
+
+   If archive is given, the energies of every site are read from that energy
+   archive (see run_namd) instead of the individual NAMD output files.
+
+   Sites with fewer than min_frames included frames, or included in less than
+   the fraction min_occupancy of the frames (see SpamInfo.pruned_sites), are
+   not computed. They are flagged as skipped in the output, with NaN for every
+   statistic (in binary_output as well).
    """
-   import math
-   import warnings
    global overwrite
    try:
       sample_size = int(sample_size)
       num_subsamples = int(num_subsamples)
+      jobs = int(jobs)
+      tolerance = float(tolerance)
+      max_subsamples = int(max_subsamples)
+      if temperatures is None: temperatures = []
+      temperatures = [float(temp) for temp in temperatures]
    except TypeError, err:
       raise SpamTypeError(str(err))
 
+   if estimator.lower() not in spamstats.ESTIMATORS:
+      raise InputError("Free energy estimator (%s) must be one of %s!" %
+                       (estimator, ', '.join(spamstats.ESTIMATORS)))
+   estimator = estimator.lower()
+   if error_method.lower() not in spamstats.ERROR_METHODS:
+      raise InputError("Error method (%s) must be one of %s!" %
+                       (error_method, ', '.join(spamstats.ERROR_METHODS)))
+   error_method = error_method.lower()
+   if batched and estimator != 'analytic' and error_method != 'jackknife':
+      raise InputError("Batched subsamples need the analytic free energy "
+                       "estimator, not %s!" % estimator)
+   if error_method == 'jackknife':
+      tolerance = 0
+
+   if jobs < 1:
+      jobs = namdcalc.usable_cpu_count()
+
+   # The jackknife and a single subsample of all the data do not depend on the
+   # seed at all. Anything else drawn from a random seed can never be looked up
+   # again, so do not bother caching it
+   deterministic = (error_method == 'jackknife' or
+                    (tolerance <= 0 and num_subsamples <= 1))
+   if seed is None:
+      from random import randint
+      seed = randint(0, 2**31 - 1)
+      if not deterministic:
+         stats_cache = None
+
    if not hasattr(output, 'write'):
       if not overwrite and os.path.exists(output):
          raise FileExists("%s output file exists. NOT overwriting" % output)
@@ -164,24 +624,193 @@ def spam_energies(namd_output, info, sample_size, num_subsamples, output):
       outfile = output
 
    infoobj = spaminfo.SpamInfo(info)
+   pruned = set(infoobj.pruned_sites(min_frames, min_occupancy))
+
+   if binary_output is not None:
+      if not overwrite and os.path.exists(binary_output):
+         raise FileExists("%s exists. NOT overwriting" % binary_output)
+      coords = None
+      if peakfile is not None:
+         coords = [(pk.x, pk.y, pk.z) for pk in
+                   xyzpeaks.read_xyz_peaks(peakfile)]
+         if len(coords) != infoobj.peaks:
+            raise InputError('%s has %d peaks, but %s has %d!' % (peakfile,
+                             len(coords), info, infoobj.peaks))
 
    # Write the header
-   outfile.write('# SITE %14s %14s %14s %14s %14s\n' % ('<G>', 'Std. Dev. G',
-                 '<H>', 'Std. Dev. H', '-T<S>'))
-   sfx = int(math.log10(infoobj.peaks))
-   # Now loop through every peak and calculate the SPAM energies
-   for i in range(infoobj.peaks):
-      # Some versions of scipy will spit out a deprecation warning, despite
-      # the fact that it is scipy itself that is using a deprecated feature.
-      # So squash that warning here, then get rid of that filter
-      namdout = namdcalc.NamdPairOutput('%s.%s.out' % (namd_output, 
-                                        str(i).zfill(sfx)) )
-      namdout.filter_output_file(infoobj, i)
-      warnings.filterwarnings(action="ignore", category=DeprecationWarning)
-      stats = spamstats.calc_g_wat(namdout.data['TOTAL'],
-                                   sample_size, num_subsamples)
-      warnings.resetwarnings()
-      outfile.write('%6d' % i + (' %14.7f' * 5) % stats + '\n')
+   header = '# SITE %14s %14s %14s %14s %14s' % ('<G>', 'Std. Dev. G', '<H>',
+                                                'Std. Dev. H', '-T<S>')
+   line = '%6d' + ' %14.7f' * 5
+   if tolerance > 0:
+      header += ' %14s' % 'Subsamples'
+      line += ' %14d'
+   for temp in temperatures:
+      header += ' %14s %14s %14s' % ('<G>(%gK)' % temp, 'Std. Dev. G',
+                                     '-T<S>(%gK)' % temp)
+      line += ' %14.7f' * 3
+   outfile.write(header + '\n')
+   # What the statistics of a skipped site are filled in with
+   skipped = (float('nan'),) * 5
+   if tolerance > 0: skipped += (0,)
+   skipped += (float('nan'),) * (3 * len(temperatures))
+   # Options passed on to calc_g_wat for every site
+   options = {'sample_size' : sample_size, 'sample_num' : num_subsamples,
+              'batched' : batched, 'estimator' : estimator,
+              'tolerance' : tolerance, 'max_subsamples' : max_subsamples,
+              'error_method' : error_method, 'temperatures' : temperatures}
+   tasks = [(namdcalc.site_output_name(namd_output, i, infoobj.peaks), i,
+             [int(seed), i], options) for i in range(infoobj.peaks)]
+   # Look up the sites we already have statistics for, leaving the seed out of
+   # the key when it does not matter
+   results = [None for i in range(infoobj.peaks)]
+   cache = None
+   if stats_cache is not None:
+      cache = statscache.StatsCache(stats_cache, int(stats_cache_size))
+      if archive is not None:
+         energy_archive = energyarchive.EnergyArchive(archive)
+      keys = []
+      for fname, i, siteseed, options in tasks:
+         if i in pruned:
+            keys.append(None)
+            continue
+         if deterministic: siteseed = None
+         content = None
+         if archive is not None:
+            content = energy_archive.fingerprint(i)
+         # Streamed NAMD runs may have left only the binary energies
+         elif not os.path.exists(fname):
+            fname = namdcalc.sidecar_name(fname)
+         keys.append(statscache.site_key(fname, infoobj.excluded_frames(i),
+                                         options, siteseed, content))
+         results[i] = cache.get(keys[i])
+      if archive is not None:
+         energy_archive.close()
+   todo = [task for task in tasks
+           if results[task[1]] is None and task[1] not in pruned]
+   # Now load the energies of every other peak and calculate their SPAM
+   # energies, either here or in a pool of worker processes. This goes a chunk
+   # of sites at a time so we never hold the energies of every site at once
+   pool = None
+   if jobs > 1 and len(todo) > 1:
+      from multiprocessing import Pool
+      pool = Pool(min(jobs, len(todo)))
+
+   def compute():
+      """ Yields the statistics of every site in todo, in order """
+      for start in range(0, len(todo), namdcalc.LOAD_CHUNK):
+         chunk = todo[start:start+namdcalc.LOAD_CHUNK]
+         energies = namdcalc.load_site_energies(namd_output, infoobj,
+                                 [task[1] for task in chunk], ['TOTAL'],
+                                 pool=pool, archive=archive)
+         chunk = [(energies[i]['TOTAL'], siteseed, options)
+                  for fname, i, siteseed, options in chunk]
+         if pool is None:
+            for task in chunk:
+               yield _site_statistics(task)
+         else:
+            # imap hands the results back in site order
+            for stats in pool.imap(_site_statistics, chunk):
+               yield stats
+
+   computed = compute()
+   try:
+      for i in range(infoobj.peaks):
+         if i in pruned:
+            results[i] = skipped
+            outfile.write(line % ((i,) + skipped) + ' # Skipped: %d included '
+                          'frames\n' % infoobj.num_included_frames(i))
+            continue
+         stats = results[i]
+         if stats is None:
+            stats = results[i] = computed.next()
+            if cache is not None: cache.put(keys[i], stats)
+         outfile.write(line % ((i,) + stats) + '\n')
+      if pool is not None: pool.close()
+   except:
+      if pool is not None: pool.terminate()
+      raise
+   finally:
+      if pool is not None: pool.join()
+      # Keep whatever we computed, even if something went wrong
+      if cache is not None: cache.save()
+
+   if binary_output is not None:
+      frames = [infoobj.num_included_frames(i) for i in range(infoobj.peaks)]
+      siteresults.write_results(binary_output, siteresults.make_results(
+                                results, frames, coords, tolerance > 0,
+                                temperatures))
+
+def _site_statistics(task):
+   """
+   Returns the SPAM statistics of a single site. task is (filtered TOTAL
+   energies, seed, dict of calc_g_wat keyword arguments) -- see spam_energies
+   """
+   import warnings
+   energies, seed, options = task
+   # Some versions of scipy will spit out a deprecation warning, despite
+   # the fact that it is scipy itself that is using a deprecated feature.
+   # So squash that warning here, then get rid of that filter
+   warnings.filterwarnings(action="ignore", category=DeprecationWarning)
+   stats = spamstats.calc_g_wat(energies, seed=seed, **options)
+   warnings.resetwarnings()
+   return stats
+
+def sampling_analysis(namd_output, info, target_error, output, jobs=1,
+                      archive=None, min_frames=0, min_occupancy=0.0):
+   """
+   Analyzes the correlation in the interaction energies of every site and
+   writes, for each one, its statistical inefficiency, the effective number of
+   uncorrelated frames, the estimated error in <G> from all frames, and the
+   largest trajectory stride that still meets target_error (see
+   spamstats.sampling_analysis). The smallest of those strides is the one the
+   whole trajectory can be thinned by. The NAMD output is parsed by a pool of
+   jobs processes (jobs < 1 means use every processor), or read from the
+   energy archive archive if given. Sites pruned by min_frames and
+   min_occupancy (see spam_energies) are left out.
+   """
+   global overwrite
+   try:
+      target_error = float(target_error)
+      jobs = int(jobs)
+   except (TypeError, ValueError), err:
+      raise SpamTypeError(str(err))
+   if target_error <= 0:
+      raise InputError("Target error (%f) must be positive!" % target_error)
+
+   if not hasattr(output, 'write'):
+      if not overwrite and os.path.exists(output):
+         raise FileExists("%s output file exists. NOT overwriting" % output)
+      outfile = open(output, 'w')
+   else:
+      outfile = output
+
+   infoobj = spaminfo.SpamInfo(info)
+
+   outfile.write('# Target error in <G>: %.4f kcal/mol\n' % target_error)
+   outfile.write('# SITE %10s %14s %14s %14s %10s\n' % ('Frames',
+                 'Stat. Ineff.', 'N Effective', 'Err. <G>', 'Stride'))
+   if jobs < 1:
+      jobs = namdcalc.usable_cpu_count()
+   pruned = set(infoobj.pruned_sites(min_frames, min_occupancy))
+   sites = [i for i in range(infoobj.peaks) if i not in pruned]
+   strides = []
+   for i, energies in namdcalc.iter_site_energies(namd_output, infoobj, sites,
+                                                  jobs=jobs, archive=archive):
+      ineff, neff, dg_err, stride = spamstats.sampling_analysis(
+                                          energies['TOTAL'], target_error)
+      strides.append(stride)
+      outfile.write('%6d %10d %14.4f %14.4f %14.7f %10d\n' % (i,
+                    len(energies['TOTAL']), ineff, neff, dg_err, stride))
+   reachable = [stride for stride in strides if stride > 0]
+   if reachable:
+      outfile.write('# Largest stride meeting the target at every site that '
+                    'can reach it: %d\n' % min(reachable))
+   if len(reachable) < len(strides):
+      outfile.write('# %d sites cannot reach the target with every frame\n' %
+                    (len(strides) - len(reachable)))
+   if pruned:
+      outfile.write('# %d sites were skipped for too few included frames\n' %
+                    len(pruned))
 
 def set_overwrite(owrite=True):
    """ Universally sets all overwrite variables in each module """
@@ -192,6 +821,10 @@ def set_overwrite(owrite=True):
    namdpdb.overwrite = owrite
    traj.overwrite = owrite
    xyzpeaks.overwrite = owrite
+   siteresults.overwrite = owrite
+   energyarchive.overwrite = owrite
+   trimsys.overwrite = owrite
+   namdtune.overwrite = owrite
 
 def main():
    from optparse import OptionParser, OptionGroup
@@ -363,7 +996,119 @@ def main():
    group.add_option('--nproc', dest='nproc', default=0, type='int',
                     metavar='INT', help='Number of processors to use for ' +
                     'NAMD calculations. By default, use as many processors ' +
-                    'as the current host has (including virtual processors)')
+                    'as this process may run on (its CPU affinity), but no ' +
+                    'more than its cgroup CPU quota allows')
+   group.add_option('--namd-jobs', dest='namd_jobs', default=1, type='int',
+                    metavar='INT', help='Number of sites to run NAMD on at ' +
+                    'the same time. The processors from --nproc are split ' +
+                    'evenly between them. Values below 1 run one job for ' +
+                    'every %d processors. (Default %%default)' %
+                    CORES_PER_NAMD_JOB)
+   group.add_option('--namd-chunks', dest='namd_chunks', default=1,
+                    type='int', metavar='INT', help='Number of chunks to ' +
+                    'split the frames of each site into. Each chunk is run ' +
+                    'by its own NAMD instance at the same time, sharing the ' +
+                    'processors of its job. (Default %default)')
+   group.add_option('--no-cpu-pinning', dest='cpu_pinning', default=True,
+                    action='store_false', help='Do not pin concurrent NAMD ' +
+                    'jobs and chunks to their own processors. By default, ' +
+                    'each one is pinned to a disjoint set of processors ' +
+                    '(with taskset) when there are enough of them')
+   group.add_option('--namd-autotune', dest='namd_autotune', default=False,
+                    action='store_true', help='Time short NAMD runs on a few ' +
+                    'frames of the first site with several PME grid ' +
+                    'spacings and pair list distances, and use the fastest ' +
+                    'one whose energies stay within %g kcal/mol of the ' %
+                    namdtune.TUNE_TOLERANCE + 'default settings. The ' +
+                    'choice is saved to %snamd_tuning.json' % FN_PRE)
+   group.add_option('--namd-tune-cutoff', dest='namd_tune_cutoff',
+                    default=False, action='store_true', help='Also try ' +
+                    'shorter cutoffs with --namd-autotune. A shorter cutoff ' +
+                    'changes the energies rather than just the speed, so ' +
+                    'each one is checked on %d sites spread over the system ' %
+                    namdtune.TUNE_SITES + 'instead of only the first')
+   group.add_option('--namd-settings', dest='namd_settings', default=None,
+                    metavar='FILE', help='Use the NAMD settings chosen in ' +
+                    'this file from an earlier --namd-autotune')
+   group.add_option('--namd-included-only', dest='namd_included_only',
+                    default=False, action='store_true', help='Only run NAMD ' +
+                    'on the frames each site includes according to the ' +
+                    '--spam-info file, skipping the frames that would be ' +
+                    'filtered out anyway. (Default %default)')
+   group.add_option('--min-frames', dest='min_frames', default=0, type='int',
+                    metavar='INT', help='Skip the sites that include fewer ' +
+                    'than INT frames according to the --spam-info file. ' +
+                    'NAMD is not run on them, and they are flagged as ' +
+                    'skipped in the SPAM energies. (Default %default)')
+   group.add_option('--min-occupancy', dest='min_occupancy', default=0.0,
+                    type='float', metavar='FLOAT', help='Skip the sites that ' +
+                    'include less than this fraction of the frames, like ' +
+                    '--min-frames. (Default %default)')
+   group.add_option('--stream-namd', dest='stream_namd', default=False,
+                    action='store_true', help='Read the energies straight ' +
+                    'from the output of NAMD and store them in binary ' +
+                    '(<output>.npy) rather than parsing the text output later.')
+   group.add_option('--namd-log', dest='namd_log', default='keep',
+                    metavar='KEEP|GZIP|DISCARD', help='What to do with the ' +
+                    'rest of the NAMD output with --stream-namd: keep it as ' +
+                    'text, compress it with gzip, or throw it away. ' +
+                    '(Default %default)')
+   group.add_option('--energy-archive', dest='archive', metavar='FILE',
+                    default=None, help='Collect the energies (and NAMD logs) ' +
+                    'of every site in this single indexed archive instead of ' +
+                    'leaving PDB, input and output files for each site. ' +
+                    '--spam-energies and --sampling-output then read the ' +
+                    'energies from it.')
+   group.add_option('--resume', dest='resume', default=False,
+                    action='store_true', help='Resume an unfinished ' +
+                    '--run-namd, skipping the sites whose energies are ' +
+                    'complete (one per frame of the trajectory) and ' +
+                    'rerunning the missing or truncated ones.')
+   group.add_option('--namd-queue', dest='namd_queue', default=None,
+                    metavar='HOST:PORT', help='Do not run NAMD here, but ' +
+                    'serve the sites on this address to NAMD workers ' +
+                    'started with --namd-worker (which must see the same ' +
+                    'files at the same paths). Use 127.0.0.1 for workers ' +
+                    'on this host only. Any other HOST, or an empty one to ' +
+                    'listen on every interface, needs a --queue-key.')
+   group.add_option('--namd-worker', dest='namd_worker', default=None,
+                    metavar='HOST:PORT', help='Run as a NAMD worker for the ' +
+                    '--namd-queue at this address until it runs out of ' +
+                    'sites, using --nproc processors for each site. No other ' +
+                    'step is done.')
+   group.add_option('--queue-key', dest='queue_key', default='',
+                    metavar='STRING', help='Key that NAMD workers must ' +
+                    'present to the --namd-queue, and that it needs to ' +
+                    'listen beyond this host. The key is sent as plain ' +
+                    'text, so it is not a secret from anyone who can watch ' +
+                    'the network: only use the queue on a trusted network. ' +
+                    '(Default none)')
+   group.add_option('--queue-lease', dest='queue_lease', type='float',
+                    default=workqueue.LEASE_TIMEOUT, metavar='SECONDS',
+                    help='Seconds a NAMD worker has to finish a site of the ' +
+                    '--namd-queue before the site is handed out again (and ' +
+                    'the worker kills its NAMD run). 0 for no limit. ' +
+                    '(Default %default)')
+   group.add_option('--trim-system', dest='trim_system', default=False,
+                    action='store_true', help='Run NAMD on a trimmed copy ' +
+                    'of the system holding only the residues that come ' +
+                    'within the cutoff (plus --trim-margin) of a site or its ' +
+                    'periodic images. The trimmed energies are first ' +
+                    'compared to the full ones on a few frames, and the run ' +
+                    'stops if they differ by more than %g kcal/mol.' %
+                    trimsys.VALIDATION_TOLERANCE)
+   group.add_option('--trim-margin', dest='trim_margin', type='float',
+                    default=trimsys.TRIM_MARGIN, metavar='FLOAT',
+                    help='Distance (Angstroms) beyond the %g Angstrom cutoff ' %
+                    trimsys.CUTOFF + 'to keep around each site with ' +
+                    '--trim-system. (Default %default)')
+   group.add_option('--trim-report', dest='trim_report', metavar='FILE',
+                    default='spam_trim.txt', help='Report comparing trimmed ' +
+                    'and full energies with --trim-system. (Default %default)')
+   group.add_option('--trim-allow-mismatch', dest='trim_allow_mismatch',
+                    default=False, action='store_true', help='Carry on with ' +
+                    'the trimmed system even if its energies differ from ' +
+                    'the full ones by more than the tolerance.')
    parser.add_option_group(group)
    group = OptionGroup(parser, 'SPAM Energies', 'The options in this section ' +
                  'pertain to parsing NAMD output files and generating the ' +
@@ -373,6 +1118,11 @@ def main():
    group.add_option('--spam-energies', dest='spam_energies', default=False,
                     action='store_true', help='Flag to toggle calculation of ' +
                     'SPAM energies.')
+   group.add_option('--no-namd-sidecars', dest='namd_sidecars', default=True,
+                    action='store_false', help='Do not save (or use) binary ' +
+                    'copies of the energies in each NAMD output file. By ' +
+                    'default, each output file is parsed once and later runs ' +
+                    'read its <output>.npy sidecar until the output changes.')
    group.add_option('--subsamples', dest='num_samples', type='int', default=1,
                     metavar='INT', help='Number of subsamples to take from ' +
                     'the existing data set. Standard deviations and averages ' +
@@ -381,9 +1131,88 @@ def main():
                     metavar='INT', help='How many data points to take at ' +
                     'random, with replacement, from the interaction energy ' +
                     'data set.  (Default is the number of points in the set)')
+   group.add_option('--batched', dest='batched', default=False,
+                    action='store_true', help='Draw all subsamples of a site ' +
+                    'at once and integrate their densities exactly, as ' +
+                    'with the ANALYTIC --estimator, which --batched needs. ' +
+                    'Much faster for many subsamples. Agrees with the ' +
+                    'default grid evaluation to within ~0.005 kcal/mol per ' +
+                    'subsample for sites whose energies spread by 0.5 ' +
+                    'kcal/mol or more, but only to within ~0.3 kcal/mol at ' +
+                    '0.1 kcal/mol, which the default grid does not resolve.')
+   group.add_option('--estimator', dest='estimator', metavar='GRID|ANALYTIC',
+                    default='grid', help='How the free energy is obtained ' +
+                    'from the kernel density estimate of each subsample. ' +
+                    'GRID integrates its Boltzmann factor numerically on a ' +
+                    'grid; ANALYTIC uses the exact closed form of that ' +
+                    'integral, which needs no grid and cannot overflow for ' +
+                    'strongly negative energies. (Default %default)')
+   group.add_option('--error-method', dest='error_method',
+                    metavar='BOOTSTRAP|JACKKNIFE', default='bootstrap',
+                    help='How to estimate the uncertainties. BOOTSTRAP ' +
+                    'refits a KDE to each of --subsamples random subsamples. ' +
+                    'JACKKNIFE splits the frames of each site into ' +
+                    '--subsamples contiguous blocks (one frame per block if ' +
+                    '--subsamples is 1) and leaves out one block at a time, ' +
+                    'using the closed-form KDE free energy. It costs O(N) ' +
+                    'per site for any number of blocks. (Default %default)')
+   group.add_option('--tolerance', dest='tolerance', type='float', default=0,
+                    metavar='FLOAT', help='Target standard error (kcal/mol) ' +
+                    'of <G> and <H> for adaptive subsampling. If > 0, ' +
+                    'batches of --subsamples subsamples are added to each ' +
+                    'site until both standard errors fall below this value ' +
+                    'or --max-subsamples is reached, and the number used is ' +
+                    'reported for each site. (Default %default, i.e. off)')
+   group.add_option('--max-subsamples', dest='max_samples', type='int',
+                    default=0, metavar='INT', help='Most subsamples to take ' +
+                    'of any site with --tolerance. Values below 1 use ' +
+                    '%d.' % spamstats.MAX_SUBSAMPLES)
+   group.add_option('--jobs', dest='jobs', type='int', default=1,
+                    metavar='INT', help='Number of processes to spread the ' +
+                    'sites over when parsing their NAMD output and computing ' +
+                    'the statistics. Values below 1 use every processor ' +
+                    'this process may use. (Default %default)')
+   group.add_option('--seed', dest='seed', type='int', default=None,
+                    metavar='INT', help='Random seed for the subsampling. ' +
+                    'Each site draws from its own stream derived from this ' +
+                    'seed, so results are reproducible for any --jobs. By ' +
+                    'default a random seed is chosen.')
+   group.add_option('--temperatures', dest='temperatures', default=None,
+                    metavar='T1,T2,...', help='Comma-separated list of ' +
+                    'additional temperatures (K) at which to report <G> and ' +
+                    '-T<S> for every site. They are evaluated from the same ' +
+                    'KDEs as the default %g K results.' % spamstats.TEMPERATURE)
+   group.add_option('--stats-cache', dest='stats_cache', metavar='FILE',
+                    default='spam_stats.cache', help='File in which the ' +
+                    'statistics of every site are cached. Sites whose NAMD ' +
+                    'output, excluded frames, statistics options and seed ' +
+                    'have not changed are read from here rather than ' +
+                    'recomputed. Bootstrap results are only cached when ' +
+                    '--seed is given. (Default %default)')
+   group.add_option('--stats-cache-size', dest='stats_cache_size', type='int',
+                    default=statscache.MAX_ENTRIES, metavar='INT',
+                    help='Most sites to keep in the statistics cache. The ' +
+                    'least recently used are dropped first. (Default %default)')
+   group.add_option('--no-stats-cache', dest='no_stats_cache', default=False,
+                    action='store_true', help='Do not read or write the ' +
+                    'statistics cache.')
    group.add_option('--spam-output', dest='spamout', metavar='FILE',
                     default='spam.out', help='Name of the final output file ' +
                     'for SPAM energies. (Default %default)')
+   group.add_option('--spam-binary', dest='spambinary', metavar='FILE',
+                    default=None, help='Also write the statistics, number ' +
+                    'of included frames and peak coordinates of every site ' +
+                    'to this binary (NumPy .npy) file, which can be loaded ' +
+                    'and combined with other runs by spam.siteresults.')
+   group.add_option('--sampling-output', dest='samplingout', metavar='FILE',
+                    default=None, help='If given, analyze the correlation ' +
+                    'in the energies of each site and write its statistical ' +
+                    'inefficiency, effective number of frames, and the ' +
+                    'largest trajectory stride that still reaches ' +
+                    '--target-error to this file. Not done by default.')
+   group.add_option('--target-error', dest='target_error', type='float',
+                    metavar='FLOAT', default=0.1, help='Target error in <G> ' +
+                    '(kcal/mol) for --sampling-output. (Default %default)')
    group.add_option('--clean', dest='clean', default=False, action='store_true',
                     help='Remove external files with the %s prefix' % FN_PRE)
    parser.add_option_group(group)
@@ -399,15 +1228,23 @@ def main():
    # Override default programs
    checkprogs.CPPTRAJ_NAME = opt.cpptraj
    checkprogs.NAMD_NAME = opt.namd
+   namdcalc.USE_SIDECARS = opt.namd_sidecars
 
    # Find the programs we need
-   programs = checkprogs.check_progs(opt.calcgrid or opt.reorder,
+   programs = checkprogs.check_progs(opt.calcgrid or opt.reorder or
+                                     (opt.run_namd and opt.trim_system),
                                      opt.spam_energies)
 
    # Make sure we supplied at least _some_ input trajectories...
    if not arg and (opt.calcgrid or opt.reorder):
       raise InputError("You gave me no trajectories to process! See the help")
 
+   # Check this before the long steps that come ahead of serving the sites
+   if (opt.run_namd and opt.namd_queue is not None and not opt.queue_key and
+         not workqueue.is_loopback(workqueue.parse_address(opt.namd_queue)[0])):
+      raise InputError("--namd-queue %s is reachable from other hosts, so it "
+                       "needs a --queue-key!" % opt.namd_queue)
+
    # Open up the log file unbuffered
    if opt.logfile is None:
       logfile = os.fdopen(sys.stdout.fileno(), 'w', 0)
@@ -418,6 +1255,14 @@ def main():
       logfile = open(opt.logfile, 'w', 0)
       progress = ProgressBar(output=logfile, allowbackspace=False)
 
+   # A NAMD worker only runs the sites it is given
+   if opt.namd_worker is not None:
+      namdcalc.MAXPROCS = opt.nproc
+      host, port = workqueue.parse_address(opt.namd_worker)
+      njobs = workqueue.run_worker(host, port, opt.queue_key, logfile=logfile)
+      logfile.write("Ran NAMD on %d sites\n" % njobs)
+      return
+
    # Create the AmberParm object
    topology = AmberParm(opt.prmtop)
    if not topology.valid:
@@ -443,13 +1288,59 @@ def main():
    # running NAMD
    if opt.run_namd:
       namdcalc.MAXPROCS = opt.nproc
-      run_namd(opt.pdb, opt.traj, topology, opt.inpcrd, opt.namdout,
-               opt.peakfile, logfile, progress)
+      namdcalc.PIN_JOBS = opt.cpu_pinning
+      pdbname, inptraj, namd_top, inpcrd = (opt.pdb, opt.traj, topology,
+                                            opt.inpcrd)
+      if opt.trim_system:
+         pdbname, inptraj, namd_top, inpcrd = trim_namd_system(opt.pdb,
+               opt.traj, topology, opt.inpcrd, opt.peakfile,
+               programs['cpptraj'], opt.trim_margin, opt.trim_report, logfile,
+               opt.resume, opt.trim_allow_mismatch)
+      pmegrid, nonbonded = 1.0, None
+      if opt.namd_autotune:
+         pmegrid, nonbonded = tune_namd_settings(pdbname, inptraj, namd_top,
+               inpcrd, logfile, True, opt.namd_jobs,
+               len(xyzpeaks.read_xyz_peaks(opt.peakfile)), opt.resume,
+               opt.namd_tune_cutoff)
+      elif opt.namd_settings is not None:
+         pmegrid, nonbonded = namdtune.read_settings(opt.namd_settings)
+      run_namd(pdbname, inptraj, namd_top, inpcrd, opt.namdout,
+               opt.peakfile, logfile, progress, opt.stream_namd,
+               opt.namd_log.lower(), opt.archive, opt.namd_jobs,
+               opt.namd_chunks, opt.info if opt.namd_included_only or
+               opt.min_frames > 0 or opt.min_occupancy > 0 else None,
+               True, opt.resume, opt.namd_queue,
+               opt.queue_key, pmegrid, nonbonded, opt.min_frames,
+               opt.min_occupancy, opt.namd_included_only, opt.queue_lease)
 
    # Collecting the statistics
    if opt.spam_energies:
+      temperatures = None
+      if opt.temperatures is not None:
+         try:
+            temperatures = [float(temp) for temp in
+                            opt.temperatures.split(',') if temp.strip()]
+         except ValueError:
+            raise InputError('Bad list of temperatures [ %s ]' %
+                             opt.temperatures)
+      stats_cache = opt.stats_cache
+      if opt.no_stats_cache: stats_cache = None
+      # The peak file is only needed for the coordinates in --spam-binary
+      peakfile = None
+      if opt.spambinary is not None and os.path.exists(opt.peakfile):
+         peakfile = opt.peakfile
       spam_energies(opt.namdout, opt.info, opt.sample_size, opt.num_samples,
-                    opt.spamout)
+                    opt.spamout, opt.batched, opt.estimator, opt.jobs,
+                    opt.seed, opt.tolerance, opt.max_samples,
+                    opt.error_method, temperatures, stats_cache,
+                    opt.stats_cache_size, opt.spambinary, peakfile,
+                    opt.archive, opt.min_frames, opt.min_occupancy)
+
+   # Analyzing the sampling of each site
+   if opt.samplingout is not None:
+      sampling_analysis(opt.namdout, opt.info, opt.target_error,
+                        opt.samplingout, opt.jobs, opt.archive,
+                        opt.min_frames, opt.min_occupancy)
 
    # Remove temporary files
    if opt.clean:
@@ -5,6 +5,7 @@ interaction energy between a desired water molecule and everybody else
 from __future__ import division
 import os
 import re
+import shutil
 import numpy as np
 from spam.exceptions import (VersionWarning, SpamVariableWarning, SpamTypeError,
                              FileExists, InputError, SpamNamdWarning,
@@ -15,29 +16,29 @@ overwrite = False
 
 MAXPROCS = 0
 
+# Whether concurrent NAMD runs are pinned to their own disjoint processors
+PIN_JOBS = True
+
+# Whether NamdPairOutput keeps binary sidecars of the output files it parses
+USE_SIDECARS = True
+
+# Most sites whose energies iter_site_energies holds in memory at once
+LOAD_CHUNK = 256
+
+# What run_namd can do with the NAMD log when it streams the energies
+NAMD_LOGS = ('keep', 'gzip', 'discard')
+
 def get_num_procs():
    """ 
-   This returns the number of processors we should use.  The best way of doing
-   this is to use the multiprocessing module, but this was only introduced in
-   Python 2.6, so we will optionally pull the number of CPUs from the
-   environment variable SPAM_NCPUS or use the multiprocessing module if it's not
-   set
+   This returns the number of processors we should use. MAXPROCS, if set,
+   comes first, then the environment variable SPAM_NCPUS, and otherwise the
+   number of processors this process may actually use (see usable_cpu_count)
    """
    global MAXPROCS
    if MAXPROCS > 0: return MAXPROCS
 
    if os.getenv('SPAM_NCPUS') is None:
-      try:
-         from multiprocessing import cpu_count
-         return cpu_count()
-      except ImportError:
-         pass
-      # I like the multiprocessing module better, but this will parse the
-      # /proc/cpuinfo file and extract the number of processors listed in
-      # there
-      cpure = re.compile(r'processor\s*:\s*(\d+)')
-      rematch = cpure.findall(open('/proc/cpuinfo', 'r').read())
-      return max(1, len(rematch))
+      return usable_cpu_count()
    else:
       try:
          return int(os.getenv('SPAM_NCPUS'))
@@ -49,6 +50,117 @@ def get_num_procs():
    # We should never get here, but if we do, just pretend we want 1 processor
    return 1
 
+def available_cpus():
+   """
+   Returns the sorted list of the processors this process may run on (its
+   affinity mask), or of every processor on the host if that is unknown
+   """
+   if hasattr(os, 'sched_getaffinity'):
+      return sorted(os.sched_getaffinity(0))
+   # Linux lists the affinity mask in /proc, e.g. "Cpus_allowed_list: 0-3,8"
+   try:
+      status = open('/proc/self/status', 'r').read()
+   except IOError:
+      status = ''
+   rematch = re.search(r'^Cpus_allowed_list:\s*(\S+)', status, re.M)
+   if rematch is not None:
+      cpus = []
+      for word in rematch.group(1).split(','):
+         first, sep, last = word.partition('-')
+         cpus.extend(range(int(first), int(last or first) + 1))
+      return cpus
+   try:
+      from multiprocessing import cpu_count
+      return range(cpu_count())
+   except (ImportError, NotImplementedError):
+      pass
+   # I like the multiprocessing module better, but this will parse the
+   # /proc/cpuinfo file and extract the number of processors listed in
+   # there
+   cpure = re.compile(r'processor\s*:\s*(\d+)')
+   try:
+      rematch = cpure.findall(open('/proc/cpuinfo', 'r').read())
+   except IOError:
+      rematch = []
+   return range(max(1, len(rematch)))
+
+def cgroup_cpu_limit():
+   """
+   Returns the number of processors the CPU quota of this process's cgroup
+   allows (rounded up), or None if there is no quota
+   """
+   import math
+   quotas = []
+   # cgroup v2 has "<quota> <period>" (or "max <period>") in cpu.max of the
+   # group of this process, which is the "0::<path>" entry of /proc/self/cgroup,
+   # and of every group above it. Each level caps the ones below, so check them
+   # all the way up to the root
+   group = ''
+   try:
+      for line in open('/proc/self/cgroup', 'r'):
+         if line.startswith('0::'):
+            group = line[3:].strip().rstrip('/')
+   except IOError:
+      pass
+   while True:
+      try:
+         words = open('/sys/fs/cgroup%s/cpu.max' % group, 'r').read().split()
+         if len(words) == 2 and words[0] != 'max':
+            quotas.append((float(words[0]), float(words[1])))
+      except (IOError, ValueError):
+         pass
+      if not group:
+         break
+      group = os.path.dirname(group).rstrip('/')
+   # cgroup v1 has the quota (-1 for none) and period in separate files
+   try:
+      quota = float(open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us').read())
+      period = float(open('/sys/fs/cgroup/cpu/cpu.cfs_period_us').read())
+      if quota > 0:
+         quotas.append((quota, period))
+   except (IOError, ValueError):
+      pass
+   limits = [int(math.ceil(quota / period)) for quota, period in quotas
+             if period > 0]
+   if not limits:
+      return None
+   return max(1, min(limits))
+
+def usable_cpu_count():
+   """
+   Number of processors this process can really use: those in its affinity
+   mask, but no more than its cgroup CPU quota allows
+   """
+   ncpus = len(available_cpus())
+   limit = cgroup_cpu_limit()
+   if limit is not None:
+      ncpus = min(ncpus, limit)
+   return max(1, ncpus)
+
+def split_cpus(njobs, nproc):
+   """
+   Returns njobs disjoint lists of nproc processors each, taken from those this
+   process may run on, or None if there are not enough processors for that
+   (or PIN_JOBS is False)
+   """
+   cpus = available_cpus()
+   if not PIN_JOBS or njobs * nproc > len(cpus) or nproc < 1:
+      return None
+   return [list(cpus[i*nproc:(i+1)*nproc]) for i in range(njobs)]
+
+def pinned_command(command, cpus):
+   """
+   Returns command (a list) prefixed so that it only runs on the processors in
+   cpus, if there are any and taskset is available
+   """
+   from spam.checkprogs import which
+   if not cpus:
+      return command
+   taskset = which('taskset')
+   if taskset is None:
+      return command
+   return [taskset, '-c', ','.join(['%d' % cpu for cpu in cpus])] + command
+
 # This is a sample NAMD input file taken from Guanglei's original SPAM calc.
 # probably a better way of doing this, but this is fine for now
 NAMD_INPUT = """# SHAKE
@@ -56,22 +168,16 @@ rigidBonds all
 useSettle on
 rigidDieOnError off
 
-# PME
-PME=on
-PMEGridSpacing %(gridspace)f
-cellBasisVector1 %(xvec)f 0 0
-cellBasisVector2 0 %(yvec)f 0
-cellBasisVector3 0 0 %(zvec)f
-
+%(boundary)s
 # Basics
 timestep 2
 temperature 0
 
 # Force field parameters 
-cutoff 12
+cutoff %(cutoff)g
 switching on
-switchdist 10
-pairlistdist 14
+switchdist %(switchdist)g
+pairlistdist %(pairlistdist)g
 exclude scaled1-4
 1-4scaling 0.8333333
 scnb 2
@@ -97,30 +203,112 @@ set ts 1000
 
 coorfile open dcd %(inptraj)s
 
-while { ![coorfile read] } {
+%(frame_loop)s
+coorfile close
+"""
+
+# NAMD_INPUT gives frame i (from 0) of the trajectory the time step
+# (i + 1) * TS_PER_FRAME, whichever frames are run (see the frame loops below),
+# so the TS column of the energies records which frames they belong to
+TS_PER_FRAME = 1000
+
+# Nonbonded settings (Angstroms) used in NAMD_INPUT unless others are given
+NONBONDED_DEFAULTS = {'cutoff' : 12.0, 'switchdist' : 10.0,
+                      'pairlistdist' : 14.0}
+
+# Periodic boundaries with PME electrostatics
+PERIODIC_BOUNDARY = """# PME
+PME=on
+PMEGridSpacing %(gridspace)f
+cellBasisVector1 %(xvec)f 0 0
+cellBasisVector2 0 %(yvec)f 0
+cellBasisVector3 0 0 %(zvec)f
+"""
+
+# No periodic boundaries, so the electrostatics are simply cut off
+NONPERIODIC_BOUNDARY = """# No periodic boundaries
+PME=off
+"""
+
+# Only do the frames in our window (to the end of the trajectory if the number
+# of frames is negative), keeping the time step numbering of the whole run
+FRAME_WINDOW_LOOP = """for {set i 0} {$i < %(first_frame)d} {incr i} {
+   coorfile skip
+   incr ts 1000
+}
+set frames_left %(num_frames)d
+
+while { $frames_left != 0 && ![coorfile read] } {
    firstTimestep \\$ts
    run 0
    incr ts 1000
+   incr frames_left -1
 }
+"""
 
-coorfile close
+# Only do the frames in our (sorted) list, skipping over the rest, keeping the
+# time step numbering of the whole run
+FRAME_LIST_LOOP = """set frame 0
+foreach next {
+%(frames)s
+} {
+   while { $frame < $next } {
+      coorfile skip
+      incr ts 1000
+      incr frame
+   }
+   if { [coorfile read] } break
+   firstTimestep \\$ts
+   run 0
+   incr ts 1000
+   incr frame
+}
 """
 
 def write_input(pdbname, inptraj, topology, pmegrid=1.0, incrd_name='dummy.crd',
-                input_name='_SPAM_namd_input', namd_output='_SPAM_namd_output'):
-   """ Sets up and writes a NAMD input file from the given options """
-   global overwrite, NAMD_INPUT
+                input_name='_SPAM_namd_input', namd_output='_SPAM_namd_output',
+                first_frame=0, num_frames=-1, frames=None, periodic=True,
+                nonbonded=None):
+   """
+   Sets up and writes a NAMD input file from the given options. NAMD skips the
+   first first_frame frames of inptraj, then does num_frames of them (all of
+   the rest if num_frames is negative). If frames is given, NAMD only does the
+   frames in that sorted sequence of frame numbers instead. If periodic is
+   False, the system is treated as non-periodic and pmegrid is not used.
+   nonbonded is a dict overriding any of the NONBONDED_DEFAULTS
+   """
+   global overwrite, NAMD_INPUT, FRAME_WINDOW_LOOP, FRAME_LIST_LOOP
    # Make sure topology is an AmberParm
    if not isinstance(topology, AmberParm):
       raise SpamTypeError("namdcalc.write_input expects AmberParm instance!")
 
-   # Make sure we have box information
-   if not topology.ptr('ifbox'):
-      raise InputError("%s is not set up for periodic simulations!" % topology)
-   try:
-      a, b, c = tuple(topology.parm_data['BOX_DIMENSIONS'][1:])
-   except KeyError:
-      raise InputError("%s does not have BOX_DIMENSIONS set!" % topology)
+   if periodic:
+      # Make sure we have box information
+      if not topology.ptr('ifbox'):
+         raise InputError("%s is not set up for periodic simulations!" %
+                          topology)
+      try:
+         a, b, c = tuple(topology.parm_data['BOX_DIMENSIONS'][1:])
+      except KeyError:
+         raise InputError("%s does not have BOX_DIMENSIONS set!" % topology)
+      boundary = PERIODIC_BOUNDARY % {'gridspace' : float(pmegrid),
+                                      'xvec' : a, 'yvec' : b, 'zvec' : c}
+   else:
+      boundary = NONPERIODIC_BOUNDARY
+
+   # Fill in the nonbonded settings we were not given
+   settings = dict(NONBONDED_DEFAULTS)
+   if nonbonded is not None:
+      for key in nonbonded:
+         if key not in NONBONDED_DEFAULTS:
+            raise InputError("Unknown nonbonded setting %s!" % key)
+      settings.update(nonbonded)
+   if not (0 < settings['switchdist'] < settings['cutoff'] <=
+           settings['pairlistdist']):
+      raise InputError("Bad nonbonded settings: need 0 < switchdist (%g) < "
+                       "cutoff (%g) <= pairlistdist (%g)!" %
+                       (settings['switchdist'], settings['cutoff'],
+                        settings['pairlistdist']))
 
    # Set up infile for writing if necessary
    if hasattr(input_name, 'write'):
@@ -130,116 +318,732 @@ def write_input(pdbname, inptraj, topology, pmegrid=1.0, incrd_name='dummy.crd',
          raise FileExists("%s exists. Not overwriting" % input_name)
       infile = open(str(input_name), 'w')
 
+   # Set up the loop over the frames
+   if frames is None:
+      frame_loop = FRAME_WINDOW_LOOP % {'first_frame' : first_frame,
+                                        'num_frames' : num_frames}
+   else:
+      frames = ['%d' % frame for frame in frames]
+      frame_loop = FRAME_LIST_LOOP % {'frames' : '\n'.join(
+            [' '.join(frames[i:i+20]) for i in range(0, len(frames), 20)])}
+
    # Set up a dictionary for substitution into the NAMD string
    
-   options = {'gridspace' : float(pmegrid), 'xvec' : a, 'yvec' : b, 'zvec' : c,
+   options = {'boundary' : boundary,
               'pdb' : str(pdbname), 'prmtop' : topology, 'inpcrd' : incrd_name,
-              'output' : namd_output, 'inptraj' : inptraj}
+              'output' : namd_output, 'inptraj' : inptraj,
+              'frame_loop' : frame_loop}
+   options.update(settings)
 
    infile.write(NAMD_INPUT % options)
 
 def run_namd(pdbname, inptraj, topology, pmegrid=1.0, incrd_name='dummy.crd',
-             input_name='_SPAM_namd_input', namd_output='_SPAM_namd_output'):
-   from subprocess import Popen
+             input_name='_SPAM_namd_input', namd_output='_SPAM_namd_output',
+             stream=False, log='keep', nproc=None, chunks=1, first_frame=0,
+             num_frames=-1, frames=None, periodic=True, cpus=None,
+             nonbonded=None):
+   """
+   Runs NAMD to get the pair interaction energies of every frame of inptraj,
+   writing its output to <namd_output>.out. If stream is True, the output of
+   NAMD is read through a pipe instead, and the energies are written straight
+   to the binary sidecar of <namd_output>.out (see NamdPairOutput), which is
+   what gets loaded later. log (one of NAMD_LOGS) then says whether the rest
+   of the NAMD log is kept in <namd_output>.out, compressed to
+   <namd_output>.out.gz, or discarded. NAMD runs on nproc processors
+   (get_num_procs() if None)
+
+   Only the frames in the window given by first_frame and num_frames, or in
+   the sorted sequence frames, are done (see write_input). If chunks > 1, the
+   frames are split into that many pieces that are run by their own NAMD
+   instances at the same time (sharing the nproc processors), and their outputs
+   are merged in frame order. periodic and nonbonded are passed on to
+   write_input
+
+   If cpus (a list of processor numbers) is given, NAMD is pinned to those
+   processors (see pinned_command), which are split between the chunks
+   """
+   from subprocess import Popen, PIPE, STDOUT
    from spam.checkprogs import check_progs
 
    global overwrite
 
+   if log not in NAMD_LOGS:
+      raise InputError("NAMD log option (%s) must be one of %s!" %
+                       (log, ', '.join(NAMD_LOGS)))
+
    programs = check_progs()
    namd = programs['namd']
 
+   if frames is not None and len(frames) == 0:
+      raise InputError("No frames to run NAMD on for %s!" % pdbname)
+
+   if nproc is None:
+      nproc = get_num_procs()
+   if chunks > 1:
+      return _run_namd_chunks(pdbname, inptraj, topology, pmegrid, incrd_name,
+                              input_name, namd_output, stream, log, nproc,
+                              chunks, frames, periodic, cpus, nonbonded)
+
    # Write the input file
    write_input(pdbname, inptraj, topology, pmegrid, incrd_name, input_name,
-               namd_output)
+               namd_output, first_frame, num_frames, frames, periodic,
+               nonbonded)
+
+   nproc = '+p%d' % nproc
+
+   outname = '%s.out' % namd_output
+   if not overwrite and os.path.exists(outname):
+      raise FileExists("%s exists. Not overwriting" % outname)
+   if not stream:
+      outfile = open(outname, 'w')
+      process = Popen(pinned_command([namd, nproc, input_name], cpus),
+                      stdout=outfile, stderr=outfile)
+
+      if process.wait():
+         raise SpamNamdWarning("NAMD exited with non-zero status!")
+      return
 
-   nproc = '+p%d' % get_num_procs()
+   sidename = sidecar_name(outname)
+   if not overwrite and os.path.exists(sidename):
+      raise FileExists("%s exists. Not overwriting" % sidename)
+   # An old text output would be parsed instead of the sidecar, so get rid of
+   # it if we are not replacing it
+   if log != 'keep' and os.path.exists(outname):
+      os.remove(outname)
+   if log == 'keep':
+      logfile = open(outname, 'w')
+   elif log == 'gzip':
+      import gzip
+      if not overwrite and os.path.exists(outname + '.gz'):
+         raise FileExists("%s.gz exists. Not overwriting" % outname)
+      logfile = gzip.open(outname + '.gz', 'wb')
+   else:
+      logfile = None
 
-   if not overwrite and os.path.exists('%s.out' % namd_output):
-      raise FileExists("%s exists. Not overwriting" % ("%s.out" % namd_output))
-   outfile = open("%s.out" % namd_output, 'w')
-   process = Popen([namd, nproc, input_name], stdout=outfile, stderr=outfile)
+   try:
+      nframes = dcd_frame_count(inptraj) - first_frame
+      if num_frames >= 0:
+         nframes = min(nframes, num_frames)
+   except InputError:
+      nframes = 0
+   if frames is not None:
+      nframes = len(frames)
+   process = Popen(pinned_command([namd, nproc, input_name], cpus),
+                   stdout=PIPE, stderr=STDOUT)
+   try:
+      data, tail = _stream_energies(process.stdout, logfile, nframes)
+   finally:
+      if logfile is not None: logfile.close()
 
    if process.wait():
+      if logfile is None:
+         raise SpamNamdWarning("NAMD exited with non-zero status! The end " +
+                               "of its output was:\n" + ''.join(tail))
       raise SpamNamdWarning("NAMD exited with non-zero status!")
+   if data is None:
+      raise SpamNamdError("NAMD printed no energies for %s!" % outname)
+
+   # The sidecar only needs to match a text output we kept
+   stamp = None
+   if log == 'keep':
+      stamp = _file_stamp(outname)
+   write_sidecar(outname, data, stamp)
+
+def _run_namd_chunks(pdbname, inptraj, topology, pmegrid, incrd_name,
+                     input_name, namd_output, stream, log, nproc, chunks,
+                     frames=None, periodic=True, cpus=None, nonbonded=None):
+   """
+   Runs NAMD on chunks windows of the frames of inptraj (or of the sequence
+   frames, if given) at once, then merges the outputs of the chunks into the
+   files run_namd would have written. Each chunk is pinned to its own share of
+   the processors in cpus, if given
+   """
+   from multiprocessing.pool import ThreadPool
+   global overwrite
+
+   outname = '%s.out' % namd_output
+   if not overwrite and os.path.exists(outname):
+      raise FileExists("%s exists. Not overwriting" % outname)
+   if frames is None:
+      nframes = dcd_frame_count(inptraj)
+   else:
+      nframes = len(frames)
+   chunks = max(1, min(chunks, nframes, nproc))
+   bounds = [nframes * i // chunks for i in range(chunks + 1)]
+   inpnames = ['%s.chunk%d' % (input_name, i) for i in range(chunks)]
+   outnames = ['%s.chunk%d' % (namd_output, i) for i in range(chunks)]
+
+   def run_chunk(i):
+      if frames is None:
+         window = {'first_frame' : bounds[i],
+                   'num_frames' : bounds[i+1] - bounds[i]}
+      else:
+         window = {'frames' : frames[bounds[i]:bounds[i+1]]}
+      chunk_cpus = None
+      if cpus:
+         chunk_cpus = cpus[len(cpus) * i // chunks:len(cpus) * (i + 1) // chunks]
+      run_namd(pdbname, inptraj, topology, pmegrid, incrd_name, inpnames[i],
+               outnames[i], stream, log, nproc // chunks, periodic=periodic,
+               cpus=chunk_cpus or None, nonbonded=nonbonded, **window)
+
+   pool = ThreadPool(chunks)
+   try:
+      pool.map(run_chunk, range(chunks))
+      pool.close()
+   except:
+      pool.terminate()
+      raise
+   finally:
+      pool.join()
+
+   chunknames = ['%s.out' % name for name in outnames]
+   # The (text) NAMD logs are simply concatenated, which keeps the frames in
+   # order. So are the compressed ones, since gzip streams can be concatenated
+   merged = 0
+   if not stream or log == 'keep':
+      merged = _merge_chunk_files(chunknames, outname)
+   elif log == 'gzip':
+      if not overwrite and os.path.exists(outname + '.gz'):
+         raise FileExists("%s.gz exists. Not overwriting" % outname)
+      _merge_chunk_files(['%s.gz' % name for name in chunknames],
+                         outname + '.gz', binary=True)
+   if stream:
+      reader = NamdPairOutput()
+      pieces = [reader._load_sidecar(name, None) for name in chunknames]
+      if None in pieces:
+         raise SpamNamdError("Missing NAMD energies for a chunk of %s!" %
+                             outname)
+      data = {}
+      for key in pieces[0]:
+         data[key] = np.concatenate([piece[key] for piece in pieces])
+      merged = len(data[key])
+      stamp = None
+      if log == 'keep':
+         stamp = _file_stamp(outname)
+      write_sidecar(outname, data, stamp)
+   if merged != nframes:
+      raise SpamNamdError("NAMD did %d of the %d frames it was given from %s!" %
+                          (merged, nframes, inptraj))
+
+   for name in inpnames + chunknames:
+      for fname in (name, name + '.gz', sidecar_name(name)):
+         if os.path.exists(fname): os.remove(fname)
+
+def _merge_chunk_files(fnames, outname, binary=False):
+   """
+   Concatenates the files in fnames into outname, returning the number of
+   ENERGY: records in them (unless they are binary)
+   """
+   mode = 'b' if binary else ''
+   nrecords = 0
+   outfile = open(outname, 'w' + mode)
+   try:
+      for fname in fnames:
+         infile = open(fname, 'r' + mode)
+         try:
+            if binary:
+               shutil.copyfileobj(infile, outfile)
+               continue
+            for line in infile:
+               if line[:7] == 'ENERGY:': nrecords += 1
+               outfile.write(line)
+         finally:
+            infile.close()
+   finally:
+      outfile.close()
+   return nrecords
+
+def _stream_energies(stream, logfile=None, nframes=0):
+   """
+   Reads NAMD output from stream, copying it to logfile (if not None), and
+   returns the dict of energies of every term in it along with the last lines
+   of the output. nframes is the expected number of frames, used to size the
+   arrays up front (they grow if there are more)
+   """
+   from collections import deque
+   tail = deque(maxlen=20)
+   key_list = None
+   energies = None
+   frame = 0
+   # NAMD prints the ENERGY: record of every frame two lines after its ETITLE:
+   countdown = 0
+   for line in iter(stream.readline, ''):
+      if logfile is not None:
+         logfile.write(line)
+      tail.append(line)
+      countdown -= 1
+      if line[:7] == 'ETITLE:':
+         if key_list is None:
+            key_list = line.split()[1:]
+            energies = np.zeros((max(nframes, 1), len(key_list)))
+         countdown = 2
+      elif countdown == 0 and line[:7] == 'ENERGY:':
+         values = np.fromstring(line[7:], sep=' ')
+         if len(values) != len(key_list):
+            raise SpamNamdError("Corrupt ENERGY: record from NAMD: %s" % line)
+         if frame == len(energies):
+            energies = np.concatenate((energies, np.zeros_like(energies)))
+         energies[frame] = values
+         frame += 1
+   if key_list is None:
+      return None, tail
+   data = {}
+   for i, key in enumerate(key_list):
+      data[key] = energies[:frame,i].copy()
+   return data, tail
+
+def _dcd_layout(fname):
+   """
+   Returns the byte order, header size, number of atoms and whether there is a
+   unit cell record in every frame of the DCD trajectory fname
+   """
+   import struct
+   if not os.path.exists(fname):
+      raise NoFileExists("Cannot find trajectory %s!" % fname)
+   dcd = open(fname, 'rb')
+   try:
+      header = dcd.read(92)
+      if len(header) < 92 or header[4:8] != b'CORD':
+         raise InputError("%s is not a DCD file!" % fname)
+      # Find the byte order from the length of the first record (84)
+      for endian in '<>':
+         if struct.unpack(endian + 'i', header[:4])[0] == 84: break
+      else:
+         raise InputError("%s is not a DCD file!" % fname)
+      icntrl = struct.unpack(endian + '20i', header[8:88])
+      if icntrl[8] != 0:
+         raise InputError("DCD files with fixed atoms (%s) are not supported!" %
+                          fname)
+      # Title record, then the number of atoms
+      reclen = struct.unpack(endian + 'i', dcd.read(4))[0]
+      dcd.seek(reclen + 4, 1)
+      natom = struct.unpack(endian + '3i', dcd.read(12))[1]
+   finally:
+      dcd.close()
+   return endian, 92 + reclen + 8 + 12, natom, bool(icntrl[10])
+
+def dcd_frame_count(fname):
+   """
+   Returns the number of frames in a DCD trajectory, worked out from the size
+   of its header, frames and file (the frame count in the header is not always
+   kept up to date)
+   """
+   endian, headsize, natom, cell = _dcd_layout(fname)
+   # Each frame has X, Y, Z records (plus a unit cell record if there is one)
+   framesize = 3 * (4 * natom + 8)
+   if cell:
+      framesize += 56
+   return (os.path.getsize(fname) - headsize) // framesize
+
+def read_dcd(fname):
+   """
+   Returns the frames of a DCD trajectory memory-mapped as a structured array
+   whose x, y and z fields hold the coordinates of every atom
+   """
+   endian, headsize, natom, cell = _dcd_layout(fname)
+   fields = []
+   if cell:
+      fields.extend([('cell_head', endian + 'i4'), ('cell', endian + 'f8', 6),
+                     ('cell_tail', endian + 'i4')])
+   for axis in 'xyz':
+      fields.extend([(axis + '_head', endian + 'i4'),
+                     (axis, endian + 'f4', natom),
+                     (axis + '_tail', endian + 'i4')])
+   nframes = dcd_frame_count(fname)
+   return np.memmap(fname, dtype=np.dtype(fields), mode='r', offset=headsize,
+                    shape=(nframes,))
+
+def output_frame_count(fname):
+   """
+   Returns the number of frames of energies in the NAMD output file fname (or
+   in its sidecar, if that is up to date or the output was not kept), or 0 if
+   there are none. The ENERGY: records are only counted, not parsed, and a
+   record cut off by a killed run is not counted
+   """
+   stamp = None
+   if os.path.exists(fname):
+      stamp = _file_stamp(fname)
+   data = NamdPairOutput()._load_sidecar(fname, stamp)
+   if data is not None:
+      return len(data.values()[0])
+   if stamp is None:
+      return 0
+   nrecords = 0
+   outfile = open(fname, 'rb')
+   try:
+      # Keep the end of the last block so records split between blocks are
+      # found, but never counted twice (the tail is shorter than the pattern)
+      block = b''
+      chunk = outfile.read(1 << 20)
+      while chunk:
+         block = block[-7:] + chunk
+         nrecords += block.count(b'\nENERGY:')
+         chunk = outfile.read(1 << 20)
+   finally:
+      outfile.close()
+   last = block.rfind(b'\nENERGY:')
+   if last >= 0 and block.find(b'\n', last + 1) < 0:
+      nrecords -= 1
+   return nrecords
+
+def sidecar_name(fname):
+   """ Name of the binary sidecar NamdPairOutput keeps for output file fname """
+   return fname + '.npy'
+
+def write_sidecar(fname, data, stamp=None):
+   """
+   Stores the dict of energies data as the binary sidecar of the NAMD output
+   file fname, where NamdPairOutput and output_frame_count will find them.
+   stamp is the (size, modification time) of the output the energies came
+   from, or None if they stand on their own (e.g., the output was not kept)
+   """
+   if stamp is None:
+      stamp = (-1.0, -1.0)
+   NamdPairOutput()._write_sidecar(fname, stamp, data, quiet=False)
+
+def timestep_frames(timesteps):
+   """
+   Returns the frames (from 0) of the trajectory that NAMD energies with the
+   time steps timesteps (their TS column) belong to, or None if timesteps is
+   None or was not numbered by NAMD_INPUT (e.g., output from another input)
+   """
+   if timesteps is None:
+      return None
+   timesteps = np.asarray(timesteps)
+   frames = np.rint(timesteps / TS_PER_FRAME).astype(np.intp) - 1
+   if (len(frames) > 0 and (frames[0] < 0 or np.any(frames[1:] <= frames[:-1])
+         or np.any(timesteps != (frames + 1) * TS_PER_FRAME))):
+      return None
+   return frames
+
+def _file_stamp(fname):
+   """ (size, modification time) of fname, used to tell if it changed """
+   stats = os.stat(fname)
+   return (float(stats.st_size), stats.st_mtime)
 
 class NamdPairOutput(object):
    """ Parses a NAMD output file with PairInteraction turned on """
-   def __init__(self, output_file = None):
-      """ Constructor for NamdPairOutput object """
+
+   # NAMD prints the ENERGY: record of every frame two lines after its ETITLE:
+   _etitlere = re.compile(r'^ETITLE:([^\n]*)', re.M)
+   _energyre = re.compile(r'^ETITLE:[^\n]*\n[^\n]*\nENERGY:([^\n]*)', re.M)
+
+   def __init__(self, output_file = None, keys = None, sidecar = None):
+      """
+      Constructor for NamdPairOutput object. If keys is given, only those
+      energy terms are kept (see parse_output_file)
+      """
       if output_file is not None and not isinstance(output_file, str):
          raise SpamTypeError('NamdPairOutput requires string output file name!')
 
       self.data = {}
+      self.output_file_name = None
+      # Frames of the trajectory the energies belong to (see timestep_frames)
+      self.frames = None
 
       if output_file is not None:
-         self.parse_output_file(output_file)
-
-   def _get_file_info(self, infile):
-      """ Read through input file and get the number of frames analyzed """
-      # Get the energy keys
-      key_list = []
-      for line in infile:
-         if line[:7] == 'ETITLE:': 
-            key_list = line.split()[1:]
-            nframes = 1
-            break
-      # Look for each ETITLE: line and count them to determine # of frames
-      for line in infile:
-         if line[:7] == 'ETITLE:':
-            nframes += 1
-      # Rewind the file back to the beginning
-      infile.seek(0)
-      if len(key_list) == 0:
-         raise SpamNamdError("Bad NAMD output file %s!" % self.output_file_name)
-      return nframes, key_list
-
-   def parse_output_file(self, fname=None):
+         self.parse_output_file(output_file, keys, sidecar)
+
+   def parse_output_file(self, fname=None, keys=None, sidecar=None):
       """ 
       Parses the output file and puts the data into the data dict keyed by the
-      title of that energy contribution
+      title of that energy contribution. If keys is given, only those energy
+      terms (e.g., ['TOTAL']) are kept. The file is read once, and all of its
+      energies are converted to numbers at once
+
+      If sidecar is True (default USE_SIDECARS), every energy term is also
+      saved in a binary sidecar file next to the output file (see
+      sidecar_name) the first time it is parsed. As long as the size and
+      modification time of the output file do not change, later parses
+      memory-map the sidecar instead of reading the text. Arrays loaded that
+      way are read-only
+
+      The frames of the trajectory the energies belong to are kept in frames,
+      even if the TS column is not one of the keys
       """
       if fname is None and self.output_file_name is None:
          raise SpamNamdWarning("I have no file to parse!")
-      if fname is not None:
-         if not os.path.exists(fname):
+      if fname is None:
+         fname = self.output_file_name
+      if not os.path.exists(fname):
+         # run_namd may have streamed the energies straight to the sidecar
+         data = None
+         if os.path.exists(sidecar_name(fname)):
+            data = self._load_sidecar(fname, None)
+         if data is None:
             raise NoFileExists("Could not find NAMD output file %s" % fname)
-         infile = open(fname, 'r')
          self.output_file_name = fname
-      nframes, key_list = self._get_file_info(infile)
-      for key in key_list:
-         self.data[key] = np.ndarray(nframes)
-      rawline = infile.readline()
-      frame = 0
-      while rawline:
-         if rawline[:7] == 'ETITLE:':
-            infile.readline()
-            words = infile.readline().split()
-            for i, dat in enumerate(words):
-               if i == 0: continue
-               self.data[key_list[i-1]][frame] = float(dat)
-            frame += 1
-         rawline = infile.readline()
+         self.frames = timestep_frames(data.get('TS'))
+         self.data = self._select(data, keys)
+         return
+      if sidecar is None:
+         sidecar = USE_SIDECARS
+      self.output_file_name = fname
+
+      if not sidecar:
+         self.data = self._parse_text(fname, keys)
+         return
+
+      # Take the stamp before reading so a file that changes underneath us
+      # does not get a sidecar that looks current
+      stamp = _file_stamp(fname)
+      data = self._load_sidecar(fname, stamp)
+      if data is None:
+         data = self._parse_text(fname)
+         self._write_sidecar(fname, stamp, data)
+      self.frames = timestep_frames(data.get('TS'))
+      self.data = self._select(data, keys)
+
+   def _select(self, data, keys):
+      """ Returns the energies in data of only the terms in keys (if given) """
+      if keys is None:
+         return data
+      selected = {}
+      for key in keys:
+         if key not in data:
+            raise SpamNamdError("No %s energies in NAMD output file %s!" %
+                                (key, self.output_file_name))
+         selected[key] = data[key]
+      return selected
+
+   def _parse_text(self, fname, keys=None):
+      """
+      Parses the text of the output file and returns the dict of energies of
+      every term in keys (all of them if keys is None). The frames they belong
+      to are set from the TS column either way
+      """
+      infile = open(fname, 'r')
+      text = infile.read()
+      infile.close()
+
+      rematch = self._etitlere.search(text)
+      if rematch is None:
+         raise SpamNamdError("Bad NAMD output file %s!" % fname)
+      key_list = rematch.groups()[0].split()
+      if keys is None:
+         keys = key_list
+      for key in keys:
+         if key not in key_list:
+            raise SpamNamdError("No %s energies in NAMD output file %s!" %
+                                (key, fname))
+
+      records = self._energyre.findall(text)
+      ncols = len(key_list)
+      # Convert every record into a single frames x terms array, then keep
+      # only the columns we were asked for
+      energies = np.fromstring(' '.join(records), sep=' ')
+      if energies.size != len(records) * ncols:
+         raise SpamNamdError("Corrupt ENERGY: records in NAMD output " +
+                             "file %s!" % fname)
+      energies = energies.reshape((len(records), ncols))
+      self.frames = None
+      if 'TS' in key_list:
+         self.frames = timestep_frames(energies[:,key_list.index('TS')])
+      data = {}
+      for key in keys:
+         data[key] = energies[:,key_list.index(key)].copy()
+      return data
+
+   def _load_sidecar(self, fname, stamp):
+      """
+      Returns the dict of energies memory-mapped from the sidecar of fname, or
+      None if there is no sidecar or it does not match stamp (which is not
+      checked if stamp is None)
+      """
+      sidename = sidecar_name(fname)
+      if not os.path.exists(sidename):
+         return None
+      try:
+         table = np.load(sidename, mmap_mode='r')
+      except (IOError, ValueError):
+         return None
+      names = table.dtype.names
+      if names is None or '__stamp__' not in names or table.shape != (1,):
+         return None
+      if stamp is not None and tuple(table['__stamp__'][0]) != stamp:
+         return None
+      data = {}
+      for key in names:
+         if key != '__stamp__':
+            data[key] = table[key][0]
+      return data
+
+   def _write_sidecar(self, fname, stamp, data, quiet=True):
+      """
+      Writes the energies in data to the sidecar of fname. If quiet, the
+      sidecar is only a cache, so failing to write it (e.g., in a read-only
+      directory) is not an error
+      """
+      nframes = len(data.values()[0])
+      fields = [(key, np.float64, (nframes,)) for key in data]
+      fields.append(('__stamp__', np.float64, (2,)))
+      table = np.zeros(1, dtype=fields)
+      for key in data:
+         table[key][0] = data[key]
+      table['__stamp__'][0] = stamp
+      # Write to a temporary file first so no one can map a partial sidecar
+      sidename = sidecar_name(fname)
+      tmpname = '%s.%d.tmp' % (sidename, os.getpid())
+      try:
+         outfile = open(tmpname, 'wb')
+         try:
+            np.save(outfile, table)
+         finally:
+            outfile.close()
+         os.rename(tmpname, sidename)
+      except (IOError, OSError):
+         if os.path.exists(tmpname): os.remove(tmpname)
+         if not quiet: raise
    
-   def filter_output_file(self, infoobj, peaknum):
+   def filter_output_file(self, infoobj, peaknum, inplace=True):
       """ 
       This filters the data in the output file, stripping out the omitted points
-      and resizing the data arrays so that only the data we are interested in is
-      kept
+      so that only the data we are interested in is kept. If inplace is False,
+      the data dict is left alone and a new dict of the filtered data is
+      returned instead, so a single parse can be filtered for several sites.
+      The energies are matched to the frames the site includes by the frames
+      they were recorded for (see timestep_frames), so output of only some of
+      the frames (e.g., NAMD was only run on the included ones) is filtered
+      the same way, and it is an error if any included frame is missing.
+      Energies with no record of their frames must cover every frame
       """
       from spam.spaminfo import SpamInfo
       if not isinstance(infoobj, SpamInfo):
          raise SpamTypeError("Expected SpamInfo to filter_output_file!")
       if not isinstance(peaknum, int):
          raise SpamTypeError("Expected integer peak number!")
-      for i, idx in enumerate(infoobj.included_frames(peaknum)):
-         for key in self.data:
-            self.data[key][i] = self.data[key][idx]
-      # We have now moved all of the data from frames we want to include down
-      # into the first num_included_frames sections of the various arrays. Now
-      # we can simply resize all of the numpy arrays and ignore the data we're
-      # chopping off
+      included = infoobj.included_frame_indices(peaknum)
+      nframes = 0
+      if self.data:
+         nframes = len(self.data.values()[0])
+      if self.frames is None:
+         if nframes < infoobj.frames:
+            raise SpamNamdError("%s has %d frames, but there are %d frames in "
+                                "the SPAM info file, and no time steps to tell "
+                                "which ones they are!" % (self.output_file_name,
+                                nframes, infoobj.frames))
+         index = included
+      else:
+         frames = self.frames
+         index = np.searchsorted(frames, included)
+         found = index < nframes
+         found[found] = frames[index[found]] == included[found]
+         if not found.all():
+            raise SpamNamdError("%s is missing %d of the %d frames site %d "
+                                "includes, starting with frame %d!" %
+                                (self.output_file_name, (~found).sum(),
+                                len(included), peaknum, included[~found][0]))
+      data = {}
       for key in self.data:
-         self.data[key].resize(infoobj.num_included_frames(peaknum))
+         data[key] = self.data[key][index]
+      if not inplace:
+         return data
+      self.data = data
+      self.frames = included
+
+def site_output_name(namd_output, site, nsites):
+   """
+   Name of the NAMD output file of a site, with the same number of leading
+   zeroes main.run_namd gives it
+   """
+   import math
+   return '%s.%s.out' % (namd_output, str(site).zfill(int(math.log10(nsites))))
+
+# Energy archives opened by _parse_site in this process, keyed by file name.
+# Each is stored with the (mtime, size) the file had when it was opened, so a
+# rewritten archive is reopened rather than read through a stale handle
+_archives = {}
+
+def _open_archive(fname):
+   """ Returns the open EnergyArchive of fname, reopening it if it changed """
+   from spam.energyarchive import EnergyArchive
+   info = os.stat(fname)
+   stamp = (info.st_mtime, info.st_size)
+   if fname in _archives:
+      oldstamp, energy_archive = _archives[fname]
+      if oldstamp == stamp:
+         return energy_archive
+      del _archives[fname]
+      energy_archive.close()
+   energy_archive = EnergyArchive(fname)
+   _archives[fname] = (stamp, energy_archive)
+   return energy_archive
+
+def _close_archives():
+   """ Closes every energy archive _parse_site opened in this process """
+   while _archives:
+      stamp, energy_archive = _archives.popitem()[1]
+      energy_archive.close()
+
+def _parse_site(task):
+   """
+   Parses the NAMD output of a single site. task is (file name, keys, energy
+   archive, site). If the energy archive is not None, the energies of the site
+   are read from there instead of the file
+   """
+   fname, keys, archive, site = task
+   if archive is None:
+      namdout = NamdPairOutput(fname, keys)
+   else:
+      namdout = NamdPairOutput()
+      namdout.output_file_name = fname
+      data = _open_archive(archive).read_site(site)
+      namdout.frames = timestep_frames(data.get('TS'))
+      namdout.data = namdout._select(data, keys)
+   # Do not try to send memory-mapped arrays back to the parent process
+   for key in namdout.data:
+      namdout.data[key] = np.asarray(namdout.data[key]).copy()
+   return namdout
+
+def iter_site_energies(namd_output, infoobj, sites=None, keys=('TOTAL',),
+                       jobs=1, pool=None, archive=None):
+   """
+   Parses the NAMD output files of the sites in sites (every site in infoobj
+   if None) and yields (site, dict of filtered energies) for each of them, in
+   order. Only the energy terms in keys are kept. The files are parsed by a
+   pool of jobs processes (or by pool, if given) LOAD_CHUNK sites at a time,
+   so at most that many sites are held in memory. They are filtered here, so
+   the workers do not need the SpamInfo object. If archive is given, the
+   energies are read from that energy archive (see spam.energyarchive) rather
+   than the individual output files
+   """
+   if sites is None:
+      sites = range(infoobj.peaks)
+   sites = list(sites)
+   if keys is not None:
+      keys = list(keys)
+   tasks = [(site_output_name(namd_output, i, infoobj.peaks), keys, archive, i)
+            for i in sites]
+   ownpool = None
+   if pool is None and jobs > 1 and len(tasks) > 1:
+      from multiprocessing import Pool
+      pool = ownpool = Pool(min(jobs, len(tasks)))
+   try:
+      for start in range(0, len(tasks), LOAD_CHUNK):
+         chunk = tasks[start:start+LOAD_CHUNK]
+         if pool is None:
+            parsed = [_parse_site(task) for task in chunk]
+         else:
+            parsed = pool.map(_parse_site, chunk)
+         for i, namdout in zip(sites[start:start+LOAD_CHUNK], parsed):
+            yield i, namdout.filter_output_file(infoobj, i, inplace=False)
+      if ownpool is not None: ownpool.close()
+   except:
+      if ownpool is not None: ownpool.terminate()
+      raise
+   finally:
+      if ownpool is not None: ownpool.join()
+      # Workers of a shared pool check their archives on every use instead
+      if pool is None: _close_archives()
+
+def load_site_energies(namd_output, infoobj, sites=None, keys=('TOTAL',),
+                       jobs=1, pool=None, archive=None):
+   """
+   Returns a dict mapping every site in sites to its dict of filtered
+   energies. See iter_site_energies
+   """
+   return dict(iter_site_energies(namd_output, infoobj, sites, keys, jobs,
+                                  pool, archive))
 
 def test(args):
    from optparse import OptionParser, OptionGroup
@@ -0,0 +1,336 @@
+"""
+This module contains an autotuner for the PME grid spacing and pair list
+distance NAMD uses for the pair interaction energies. It runs NAMD on a few
+frames of a site with every candidate setting, times the frames, and compares
+the energies to those from the reference settings of
+namdcalc.NONBONDED_DEFAULTS. The fastest setting whose energies stay within a
+tolerance of the reference is then used for all of the sites.
+
+Shorter cutoffs can be tried as well, but they change the physics rather than
+just the speed, so only when asked for, and only checked on several sites.
+"""
+from __future__ import division
+import json
+import os
+import numpy as np
+from timeit import default_timer
+from spam.exceptions import (FileExists, InputError, SpamNamdError,
+                             SpamNamdWarning)
+
+overwrite = False
+
+# PME grid spacings (Angstroms) to try. Only used for periodic systems
+TUNE_PMEGRIDS = (1.0, 1.2, 1.5)
+# Cutoffs (Angstroms) to try, if asked to. The switching distance is always
+# SWITCH_WIDTH below the cutoff, as it is in the reference settings
+TUNE_CUTOFFS = (12.0, 10.0, 9.0)
+# Number of sites (spread over all of them) cutoffs are checked on
+TUNE_SITES = 4
+SWITCH_WIDTH = 2.0
+# Distances (Angstroms) beyond the cutoff to try for pairlistdist. Every frame
+# is a fresh 'run 0', so the pair list is rebuilt for each one anyway
+TUNE_PAIRLIST_MARGINS = (2.0, 0.5)
+# Number of frames each trial runs on
+TUNE_FRAMES = 10
+# Energy terms compared to the reference
+TUNE_KEYS = ('ELECT', 'VDW', 'TOTAL')
+# Largest difference (kcal/mol) from the reference in any frame of any of the
+# TUNE_KEYS that makes a setting acceptable
+TUNE_TOLERANCE = 0.1
+# Files NAMD writes (after outputname) at the end of each trial
+TRIAL_OUTPUTS = ('.coor', '.vel', '.xsc')
+
+class _EnergyClock(object):
+   """
+   Stands in for the log file of namdcalc._stream_energies, noting when each
+   ENERGY: record came out of NAMD
+   """
+
+   def __init__(self):
+      self.times = []
+
+   def write(self, line):
+      if line[:7] == 'ENERGY:':
+         self.times.append(default_timer())
+
+   def seconds_per_frame(self):
+      """ Wall time between the first and last frames, per frame """
+      if len(self.times) < 2:
+         return None
+      return (self.times[-1] - self.times[0]) / (len(self.times) - 1)
+
+def candidates(periodic=True, cutoffs=False):
+   """
+   Returns the list of (pmegrid, nonbonded) settings to try, starting with the
+   reference settings. Only the PME grid spacing and the pair list distance
+   are varied, since they change how fast NAMD runs rather than the energies
+   it computes, unless cutoffs is True, in which case shorter cutoffs (which
+   do change them) are tried too
+   """
+   from spam.namdcalc import NONBONDED_DEFAULTS
+   reference = (1.0, dict(NONBONDED_DEFAULTS))
+   settings = [reference]
+   for pmegrid in (TUNE_PMEGRIDS if periodic else (1.0,)):
+      for cutoff in (TUNE_CUTOFFS if cutoffs else
+                     (NONBONDED_DEFAULTS['cutoff'],)):
+         for margin in TUNE_PAIRLIST_MARGINS:
+            nonbonded = {'cutoff' : cutoff,
+                         'switchdist' : cutoff - SWITCH_WIDTH,
+                         'pairlistdist' : cutoff + margin}
+            if (pmegrid, nonbonded) != reference:
+               settings.append((pmegrid, nonbonded))
+   return settings
+
+def run_trial(pdbname, inptraj, topology, inpcrd, frames, pmegrid, nonbonded,
+              periodic=True, nproc=None, prefix='_SPAM_tune'):
+   """
+   Runs NAMD on the frames of inptraj with the given settings, and returns the
+   dict of energies of every term and the wall time per frame (not counting
+   the time NAMD takes to start up)
+   """
+   from subprocess import Popen, PIPE, STDOUT
+   from spam import namdcalc
+   from spam.checkprogs import check_progs
+   namd = check_progs()['namd']
+   if nproc is None:
+      nproc = namdcalc.get_num_procs()
+   inpname = prefix + '.inp'
+   # Each trial overwrites the input of the last one
+   namdcalc.write_input(pdbname, inptraj, topology, pmegrid, inpcrd, inpname,
+                        prefix, frames=frames, periodic=periodic,
+                        nonbonded=nonbonded)
+   clock = _EnergyClock()
+   try:
+      process = Popen([namd, '+p%d' % nproc, inpname], stdout=PIPE,
+                      stderr=STDOUT)
+      data, tail = namdcalc._stream_energies(process.stdout, clock,
+                                             len(frames))
+      if process.wait():
+         raise SpamNamdWarning("NAMD exited with non-zero status! The end " +
+                               "of its output was:\n" + ''.join(tail))
+   finally:
+      # The input and whatever NAMD wrote at the end of the run (and the backups
+      # it makes of those from the last trial). Nothing else that starts with
+      # prefix is ours, e.g. the labeled PDB main writes next to it
+      for fname in [inpname] + [prefix + suffix + backup
+                                for suffix in TRIAL_OUTPUTS
+                                for backup in ('', '.BAK')]:
+         if os.path.exists(fname): os.remove(fname)
+   if data is None or len(data.values()[0]) != len(frames):
+      raise SpamNamdError("NAMD did not print the energies of all %d frames "
+                          "of the tuning trial!" % len(frames))
+   return data, clock.seconds_per_frame()
+
+def autotune(pdbnames, inptraj, topology, inpcrd, periodic=True, nproc=None,
+             nframes=TUNE_FRAMES, tolerance=TUNE_TOLERANCE, logfile=None,
+             cutoffs=False):
+   """
+   Tries every candidate setting (see candidates) on nframes frames (spread
+   over inptraj) of the sites labeled in pdbnames (one PDB per site, or a
+   single PDB). A setting is timed on every site, and its deviation is the
+   largest from the reference on any of them. Trying shorter cutoffs
+   (cutoffs=True) needs at least 2 sites. Returns the fastest acceptable
+   setting as a dict (pmegrid, nonbonded, seconds_per_frame, deviation) and
+   the list of such dicts for all of the settings tried
+   """
+   from spam.namdcalc import dcd_frame_count
+   if isinstance(pdbnames, str):
+      pdbnames = [pdbnames]
+   if cutoffs and len(pdbnames) < 2:
+      raise InputError("Tuning the cutoff changes the energies, so it has to "
+                       "be checked on at least 2 sites! Got %d" % len(pdbnames))
+   if nframes < 2:
+      raise InputError("Autotuning needs at least 2 frames! Got %d" % nframes)
+   total = dcd_frame_count(inptraj)
+   if total < 2:
+      raise InputError("Autotuning needs at least 2 frames, but %s has %d!" %
+                       (inptraj, total))
+   frames = np.unique(np.linspace(0, total - 1, nframes).astype(int))
+
+   results = []
+   references = None
+   for pmegrid, nonbonded in candidates(periodic, cutoffs):
+      trials = [run_trial(pdbname, inptraj, topology, inpcrd, frames, pmegrid,
+                          nonbonded, periodic, nproc) for pdbname in pdbnames]
+      if references is None:
+         references = [data for data, speed in trials]
+      deviation = max([np.abs(data[key] - reference[key]).max()
+                       for (data, speed), reference in zip(trials, references)
+                       for key in TUNE_KEYS])
+      speeds = [speed for data, speed in trials]
+      speed = None
+      if None not in speeds:
+         speed = sum(speeds) / len(speeds)
+      results.append({'pmegrid' : pmegrid, 'nonbonded' : nonbonded,
+                      'seconds_per_frame' : speed, 'deviation' : deviation})
+      if logfile is not None:
+         logfile.write("NAMD tuning: PMEGridSpacing %.2f cutoff %g "
+                       "pairlistdist %g: %s s/frame, deviation %.4f "
+                       "kcal/mol\n" % (pmegrid, nonbonded['cutoff'],
+                       nonbonded['pairlistdist'], 'n/a' if speed is None else
+                       '%.4f' % speed, deviation))
+
+   # The reference is always acceptable, so fall back on it
+   best = results[0]
+   for result in results[1:]:
+      if result['deviation'] > tolerance or result['seconds_per_frame'] is None:
+         continue
+      if (best['seconds_per_frame'] is None or
+            result['seconds_per_frame'] < best['seconds_per_frame']):
+         best = result
+   return best, results
+
+def write_settings(fname, best, results=None):
+   """ Writes the chosen setting (and all of those tried) to fname as JSON """
+   global overwrite
+   if not overwrite and os.path.exists(fname):
+      raise FileExists("%s exists. Not overwriting" % fname)
+   outfile = open(fname, 'w')
+   json.dump({'best' : best, 'results' : results or []}, outfile, indent=2,
+             sort_keys=True)
+   outfile.write('\n')
+   outfile.close()
+
+def read_settings(fname):
+   """ Returns the (pmegrid, nonbonded) setting chosen in fname """
+   from spam.namdcalc import NONBONDED_DEFAULTS
+   try:
+      best = json.load(open(fname, 'r'))['best']
+      pmegrid = float(best['pmegrid'])
+      nonbonded = dict([(str(key), float(best['nonbonded'][key]))
+                        for key in NONBONDED_DEFAULTS])
+   except (ValueError, KeyError, TypeError):
+      raise InputError("%s is not a NAMD tuning file!" % fname)
+   return pmegrid, nonbonded
+
+def _test_tuner(prmtop, traj, pdb, inpcrd, nframes, delay, cutoffs=False):
+   """
+   Autotunes the NAMD stand-in (see spam.fakenamd) on the first water of the
+   system (the first two if cutoffs is True), with the labeled PDBs named as
+   main names them, and checks that every candidate ran, only the cutoffs
+   asked for were tried, the fastest acceptable one won, and only the files of
+   the trials were cleaned up. Returns True if everything checks out
+   """
+   import shutil
+   import sys
+   import tempfile
+   from spam import AmberParm, checkprogs, fakenamd
+   from spam.namdcalc import NONBONDED_DEFAULTS
+   from spam.namdpdb import read_pdb
+
+   topology = AmberParm(os.path.abspath(prmtop))
+   template = read_pdb(pdb)
+   firstwat = topology.parm_data['RESIDUE_LABEL'].index('WAT')
+   traj, inpcrd = os.path.abspath(traj), os.path.abspath(inpcrd)
+   workdir = tempfile.mkdtemp(prefix='spam_tune')
+   cwd, namd_name = os.getcwd(), checkprogs.NAMD_NAME
+   delay_env = os.getenv('FAKENAMD_DELAY')
+   try:
+      os.chdir(workdir)
+      # The same names main.tune_namd_settings gives the labeled PDBs
+      if cutoffs:
+         pdbnames = ['_SPAM_tune.%d.pdb' % i for i in range(2)]
+      else:
+         pdbnames = ['_SPAM_tune.pdb']
+      for i, pdbname in enumerate(pdbnames):
+         template.label_residue(firstwat + i)
+         template.write_to_pdb(pdbname)
+         template.unlabel()
+      checkprogs.NAMD_NAME = fakenamd.write_executable('namd2')
+      os.environ['FAKENAMD_DELAY'] = '%g' % delay
+      # Cutoffs are never checked on just one site
+      try:
+         autotune(pdbnames[0], traj, topology, inpcrd, nproc=1,
+                  nframes=nframes, cutoffs=True)
+         refused = False
+      except InputError:
+         refused = True
+      best, results = autotune(pdbnames, traj, topology, inpcrd, nproc=1,
+                               nframes=nframes, logfile=sys.stdout,
+                               cutoffs=cutoffs)
+      leftover = sorted(os.listdir('.'))
+   finally:
+      os.chdir(cwd)
+      checkprogs.NAMD_NAME = namd_name
+      if delay_env is None:
+         del os.environ['FAKENAMD_DELAY']
+      else:
+         os.environ['FAKENAMD_DELAY'] = delay_env
+      shutil.rmtree(workdir)
+
+   settings = candidates(True, cutoffs)
+   ran = len(results) == len(settings) >= 2
+   print 'All %d candidate settings ran on %d sites [%s]' % (len(settings),
+                                                          len(pdbnames), ran)
+   tried = set([result['nonbonded']['cutoff'] for result in results])
+   if cutoffs:
+      only = tried == set(TUNE_CUTOFFS)
+   else:
+      only = tried == set([NONBONDED_DEFAULTS['cutoff']])
+   print 'Only the cutoffs asked for were tried [%s]' % only
+   print 'Cutoffs were not checked on a single site [%s]' % refused
+   kept = leftover == sorted(pdbnames + ['namd2'])
+   print 'Only the trial files were removed [%s]' % kept
+   # The stand-in is quickest with the shortest pair list distance, and all
+   # of its settings are within the tolerance
+   fastest = min([nonbonded['pairlistdist'] for pmegrid, nonbonded in settings])
+   won = (best['nonbonded']['pairlistdist'] == fastest and
+          best['deviation'] <= TUNE_TOLERANCE)
+   print 'The fastest acceptable setting won [%s]' % won
+   return ran and only and refused and kept and won
+
+def test(args):
+   """ Autotunes NAMD on labeled PDBs, or tests the tuner """
+   from optparse import OptionParser, OptionGroup
+   import sys
+   from spam import AmberParm
+
+   parser = OptionParser(usage='%prog [options]')
+   parser.add_option('-p', '--prmtop', dest='prmtop', default='prmtop',
+                     metavar='FILE', help='Topology file (Default %default)')
+   parser.add_option('-y', '--traj', dest='traj', default=None,
+                     metavar='FILE', help='Reordered DCD trajectory')
+   parser.add_option('-b', '--pdb', dest='pdb', default=[], metavar='FILE',
+                     action='append', help='PDB with a site labeled for pair ' +
+                     'interactions. Give one for each site to tune on')
+   parser.add_option('-c', '--inpcrd', dest='inpcrd', default='dummy.crd',
+                     metavar='FILE', help='Dummy restart file ' +
+                     '(Default %default)')
+   parser.add_option('-f', '--frames', dest='frames', type='int',
+                     default=TUNE_FRAMES, metavar='INT', help='Frames to ' +
+                     'run each trial on (Default %default)')
+   parser.add_option('-C', '--cutoffs', dest='cutoffs', default=False,
+                     action='store_true', help='Try shorter cutoffs too, ' +
+                     'which needs at least 2 sites')
+   parser.add_option('-o', '--output', dest='output', default=None,
+                     metavar='FILE', help='JSON file to write the results to')
+   group = OptionGroup(parser, 'Tuner Test', 'Autotune a NAMD stand-in ' +
+                       '(spam.fakenamd) instead, labeling the first water (or ' +
+                       'two, with -C) of the unlabeled PDB given with -b, and ' +
+                       'check the result')
+   group.add_option('-t', '--test-tuner', dest='test_tuner', default=False,
+                    action='store_true', help='Run the tuner test')
+   group.add_option('-d', '--delay', dest='delay', type='float', default=0.02,
+                    metavar='FLOAT', help='Seconds the stand-in spends on ' +
+                    'each frame with the reference settings (Default %default)')
+   parser.add_option_group(group)
+   opt, arg = parser.parse_args(args)
+
+   if opt.traj is None or not opt.pdb:
+      parser.print_help()
+      return
+
+   if opt.test_tuner:
+      if not _test_tuner(opt.prmtop, opt.traj, opt.pdb[0], opt.inpcrd,
+                         opt.frames, opt.delay, opt.cutoffs):
+         sys.exit(1)
+      return
+
+   best, results = autotune(opt.pdb, opt.traj, AmberParm(opt.prmtop),
+                            opt.inpcrd, nframes=opt.frames, logfile=sys.stdout,
+                            cutoffs=opt.cutoffs)
+   print 'Best: PMEGridSpacing %.2f cutoff %g switchdist %g pairlistdist %g' % (
+         best['pmegrid'], best['nonbonded']['cutoff'],
+         best['nonbonded']['switchdist'], best['nonbonded']['pairlistdist'])
+   if opt.output is not None:
+      write_settings(opt.output, best, results)
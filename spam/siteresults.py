@@ -0,0 +1,119 @@
+"""
+This module contains a columnar binary store of the SPAM statistics of every
+site. Each store is a NumPy .npy file holding a structured array with one
+record per site, so the results of many runs can be memory-mapped and
+aggregated without parsing the text tables written by spam_energies.
+"""
+from __future__ import division
+import os
+import numpy as np
+from spam.exceptions import FileExists, InputError, NoFileExists
+
+overwrite = False
+
+# Names of the five statistics calc_g_wat always returns, in order
+STATS_FIELDS = ('G', 'G_std', 'H', 'H_std', 'ntds')
+
+def results_dtype(temperatures=()):
+   """
+   Returns the record type of a results store. Every site has its number, the
+   coordinates of its peak, the number of included frames, the statistics in
+   STATS_FIELDS and the number of subsamples used (0 unless adaptive). Each
+   extra temperature T adds G_T, G_std_T and ntds_T fields
+   """
+   fields = [('site', np.int32), ('x', np.float64), ('y', np.float64),
+             ('z', np.float64), ('frames', np.int32)]
+   fields.extend([(name, np.float64) for name in STATS_FIELDS])
+   fields.append(('subsamples', np.int32))
+   for temp in temperatures:
+      for name in ('G', 'G_std', 'ntds'):
+         fields.append(('%s_%g' % (name, temp), np.float64))
+   return np.dtype(fields)
+
+def make_results(stats, frames, coords=None, adaptive=False, temperatures=()):
+   """
+   Builds the results array from the list of calc_g_wat statistics of every
+   site and their numbers of included frames. coords is the list of (x, y, z)
+   of every peak (NaN if None). adaptive and temperatures must match the
+   arguments the statistics were computed with. Sites skipped by spam_energies
+   have NaN statistics
+   """
+   nsites = len(stats)
+   if len(frames) != nsites:
+      raise InputError('Need frame counts for all %d sites!' % nsites)
+   if coords is None:
+      coords = [(np.nan, np.nan, np.nan) for i in range(nsites)]
+   elif len(coords) != nsites:
+      raise InputError('Found %d peaks, but have statistics for %d sites!' %
+                       (len(coords), nsites))
+   rows = []
+   for i, site in enumerate(stats):
+      nsub = 0
+      extra = tuple(site[5:])
+      if adaptive:
+         nsub, extra = extra[0], extra[1:]
+      rows.append((i,) + tuple(coords[i]) + (frames[i],) + tuple(site[:5]) +
+                  (nsub,) + extra)
+   return np.array(rows, dtype=results_dtype(temperatures))
+
+def write_results(fname, results):
+   """ Writes the results array to fname in NumPy's .npy format """
+   global overwrite
+   if not overwrite and os.path.exists(fname):
+      raise FileExists("%s exists. Not overwriting" % fname)
+   # Pass an open file so np.save does not append a .npy extension
+   outfile = open(fname, 'wb')
+   try:
+      np.save(outfile, results)
+   finally:
+      outfile.close()
+
+def load_results(fnames, mmap=True, return_runs=False):
+   """
+   Loads one or more results files. A single file is returned as a (read-only)
+   memory map unless mmap is False. Several files are concatenated into a
+   single array, and if return_runs is True the index into fnames that every
+   record came from is returned as well
+   """
+   if isinstance(fnames, str):
+      fnames = [fnames]
+   if not fnames:
+      raise InputError('No results files to load!')
+   arrays = []
+   for fname in fnames:
+      if not os.path.exists(fname):
+         raise NoFileExists("Could not find results file %s" % fname)
+      arrays.append(np.load(fname, mmap_mode='r' if mmap else None))
+      if arrays[-1].dtype != arrays[0].dtype:
+         raise InputError('Results file %s has different fields than %s!' %
+                          (fname, fnames[0]))
+   if len(arrays) == 1:
+      results = arrays[0]
+   else:
+      results = np.concatenate(arrays)
+   if return_runs:
+      runs = np.repeat(np.arange(len(arrays)), [len(arr) for arr in arrays])
+      return results, runs
+   return results
+
+def test(args):
+   """ Summarizes one or more results files """
+   from optparse import OptionParser
+
+   parser = OptionParser(usage='%prog [options] results1 [results2 ...]')
+   parser.add_option('--no-mmap', dest='mmap', default=True,
+                     action='store_false', help='Read the whole files into ' +
+                     'memory instead of memory-mapping them')
+   opt, arg = parser.parse_args(args)
+
+   if not arg:
+      parser.print_help()
+      return
+
+   results, runs = load_results(arg, opt.mmap, return_runs=True)
+   print 'Loaded %d sites from %d runs' % (len(results), len(arg))
+   print 'Fields: %s' % ', '.join(results.dtype.names)
+   for i, fname in enumerate(arg):
+      sites = results[runs == i]
+      print '   %s: %d sites, <G> from %.4f to %.4f' % (fname, len(sites),
+            sites['G'].min(), sites['G'].max())
@@ -5,6 +5,7 @@ cpptraj prints out detailing which frames are analyzed, omitted, etc.
 from __future__ import division
 import os
 import re
+import numpy as np
 from spam.exceptions import (NoFileExists, SpamInfoError)
 
 class SpamInfo(object):
@@ -53,11 +54,32 @@ class SpamInfo(object):
       """ Returns the number of invalid frames for a given peak number """
       return len(self.sites[peaknum])
 
+   def pruned_sites(self, min_frames=0, min_occupancy=0.0):
+      """
+      Returns the sorted list of peak numbers with fewer than min_frames valid
+      frames, or valid in less than the fraction min_occupancy of the frames
+      """
+      import math
+      threshold = max(min_frames, int(math.ceil(min_occupancy * self.frames)))
+      return [i for i in range(self.peaks)
+              if self.num_included_frames(i) < threshold]
+
    def excluded_frames(self, peaknum):
       """ Generator that returns an iterable list of excluded peak numbers """
       for val in self.sites[peaknum]:
          yield val
 
+   def included_frame_mask(self, peaknum):
+      """ Boolean array that is True for every valid frame of a given peak """
+      mask = np.ones(self.frames, dtype=bool)
+      omit = np.array(self.sites[peaknum], dtype=np.intp)
+      mask[omit[omit < self.frames]] = False
+      return mask
+
+   def included_frame_indices(self, peaknum):
+      """ Array of the (sorted) valid frame numbers for a given peak """
+      return np.flatnonzero(self.included_frame_mask(peaknum))
+
    def included_frames(self, peaknum):
       """ Generator that returns an iterable list of included peak numbers """
       # This one is more difficult. For performance, we will take advantage of
@@ -119,3 +141,6 @@ def test(args):
                (len(omit) == info.num_excluded_frames(i)) and
                (thesum == range(info.frames))
                                                    )
+         print '   Do the index arrays work? [%s]' % (
+               list(info.included_frame_indices(i)) == save and
+               info.included_frame_mask(i).sum() == len(save))
@@ -5,33 +5,241 @@ each water site.
 from __future__ import division
 import numpy as np
 from scipy.stats.kde import gaussian_kde
-from spam.exceptions import SpamKdeError
-from math import log10, exp
+from spam.exceptions import InputError
+from functools import partial
+from math import log
 
 DG_BULK = -30.3 # Free energy of bulk water
 DH_BULK = -22.2 # Enthalpy of bulk water
+TEMPERATURE = 300.0 # Temperature (K) at which kT is 0.596 kcal/mol
 
-def calc_g_wat(enevec, sample_size, sample_num):
-   """ Calculate the DELTA G of an individual water site """
+ESTIMATORS = ('grid', 'analytic')
+ERROR_METHODS = ('bootstrap', 'jackknife')
+
+MAX_SUBSAMPLES = 10000 # Default cap on subsamples in adaptive mode
+
+def calc_g_wat(enevec, sample_size, sample_num, batched=False,
+               estimator='grid', seed=None, tolerance=0, max_subsamples=0,
+               error_method='bootstrap', temperatures=None):
+   """
+   Calculate the DELTA G of an individual water site. The estimator is either
+   'grid', which integrates the Boltzmann factor of the KDE numerically, or
+   'analytic', which uses the closed form of that integral (see
+   _analytic_free_energy). If batched is True, all of the subsamples are drawn
+   at once and evaluated together (see _batched_subsamples) instead of fitting
+   a separate KDE to each one, which needs the analytic estimator. If seed is given, the subsamples are drawn from
+   their own random stream seeded with it, so the result is reproducible
+   regardless of what else has used the global numpy random state.
+
+   If tolerance > 0, subsampling is adaptive: subsamples are added in batches
+   of sample_num until the standard errors of the mean DELTA G and DELTA H both
+   fall below tolerance, or max_subsamples (MAX_SUBSAMPLES if < 1) have been
+   drawn. The number of subsamples actually used is then appended to the
+   returned tuple as a sixth element.
+
+   If error_method is 'jackknife', no subsamples are drawn at all. Instead the
+   data are split into sample_num contiguous blocks (one block per point if
+   sample_num < 2) and the uncertainties come from a delete-d jackknife over
+   those blocks (see _jackknife). batched, estimator, seed, tolerance and
+   max_subsamples do not apply in that case.
+
+   temperatures is an optional list of other temperatures (K). The free energy
+   of every subsample is evaluated at all of them together with the default
+   TEMPERATURE from the same KDEs, and (<G>, Std. Dev. G, -T<S>) at each one
+   is appended to the returned tuple in order. The bulk water references at T
+   assume a constant bulk entropy, i.e. DH_BULK + (DG_BULK - DH_BULK) * T /
+   TEMPERATURE.
+   """
    global DG_BULK, DH_BULK, BW
+   if estimator not in ESTIMATORS:
+      raise InputError("Unknown free energy estimator %s. Expected one of %s" %
+                       (estimator, ', '.join(ESTIMATORS)))
+   if error_method not in ERROR_METHODS:
+      raise InputError("Unknown error method %s. Expected one of %s" %
+                       (error_method, ', '.join(ERROR_METHODS)))
+   if temperatures is None: temperatures = []
+   for temp in temperatures:
+      if temp <= 0:
+         raise InputError("Temperatures must be positive! Got %s" % temp)
+   # Each temperature relative to TEMPERATURE. kT and the prefactor of the free
+   # energy both scale with it. The first column is always TEMPERATURE itself
+   tscale = np.array([1.0] + [temp / TEMPERATURE for temp in temperatures])
+   if error_method == 'jackknife':
+      return _jackknife(enevec, sample_num, tscale)
+   if batched and estimator != 'analytic':
+      raise InputError("Batched subsamples can only be evaluated with the "
+                       "analytic estimator, not %s!" % estimator)
    kde1 = gaussian_kde(enevec)
 
    # Set up defaults
    if sample_size < 1: sample_size = len(enevec)
    sample_size = min(len(enevec), sample_size)
    sample_num = max(1, sample_num)
+   if seed is None:
+      rng = np.random
+   else:
+      rng = np.random.RandomState(seed)
+
+   if batched:
+      subsample = _batched_subsamples
+   else:
+      subsample = partial(_looped_subsamples, estimator=estimator)
+
+   if tolerance > 0:
+      # Adaptive mode. We always resample here, and need at least 2 subsamples
+      # in each batch to have a standard error to look at
+      sample_num = max(2, sample_num)
+      if max_subsamples < 1: max_subsamples = MAX_SUBSAMPLES
+      max_subsamples = max(sample_num, max_subsamples)
+      free_energy, enthalpy = subsample(kde1, enevec, sample_size, sample_num,
+                                        rng, tscale)
+      while (len(free_energy) < max_subsamples and
+             max(_std_err(free_energy[:,0]), _std_err(enthalpy)) > tolerance):
+         nmore = min(sample_num, max_subsamples - len(free_energy))
+         more_g, more_h = subsample(kde1, enevec, sample_size, nmore, rng,
+                                    tscale)
+         free_energy = np.concatenate((free_energy, more_g))
+         enthalpy = np.concatenate((enthalpy, more_h))
+      stats = _summarize(free_energy, enthalpy, tscale)
+      return stats[:5] + (len(free_energy),) + stats[5:]
+
+   # If sample_num is 1, then don't resample
+   free_energy, enthalpy = subsample(kde1, enevec, sample_size, sample_num,
+                                     rng, tscale, sample_num > 1)
+
+   return _summarize(free_energy, enthalpy, tscale)
+
+def _bulk_free_energy(tscale):
+   """ Free energy of bulk water at tscale * TEMPERATURE (constant entropy) """
+   return DH_BULK + (DG_BULK - DH_BULK) * tscale
+
+def _summarize(free_energy, enthalpy, tscale):
+   """
+   Turns the free energies (one column per temperature) and enthalpies of every
+   subsample into the (<G>, Std. Dev. G, <H>, Std. Dev. H, -T<S>) statistics
+   relative to bulk, followed by (<G>, Std. Dev. G, -T<S>) at every other
+   temperature
+   """
+   # Our subsampling is over, now find the average and standard deviation
+   dg_avg = np.sum(free_energy, axis=0) / len(free_energy) - \
+            _bulk_free_energy(tscale)
+   dg_std = free_energy.std(axis=0)
+   dh_avg = np.sum(enthalpy) / len(enthalpy) - DH_BULK
+   dh_std = enthalpy.std()
+   ntds = dg_avg - dh_avg
+
+   stats = (dg_avg[0], dg_std[0], dh_avg, dh_std, ntds[0])
+   for i in range(1, len(tscale)):
+      stats += (dg_avg[i], dg_std[i], ntds[i])
+   return stats
+
+def _jackknife(enevec, nblocks, tscale):
+   """
+   Delete-d jackknife estimate of the SPAM statistics. The data are split into
+   nblocks contiguous blocks (so correlated neighboring frames are deleted
+   together) and the analytic KDE free energy (see _analytic_free_energy) and
+   the enthalpy are recomputed with each block left out. Every leave-block-out
+   estimate only needs sums over the remaining points of the Boltzmann factors,
+   the energies and their squares (for the Scott's rule kernel width). Those
+   are the prefix sum before the block plus the suffix sum after it, so all of
+   the estimates together cost O(N), and the Boltzmann sums never subtract
+   large numbers from each other. The averages are the full-data estimates and
+   the standard deviations are the jackknife standard errors. tscale are the
+   temperatures relative to TEMPERATURE, as in _summarize
+   """
+   enevec = np.asarray(enevec, dtype=np.float64).ravel()
+   npts = len(enevec)
+   if nblocks < 2: nblocks = npts
+   nblocks = min(nblocks, npts)
+   # Block boundaries. Block i holds points edges[i] through edges[i+1]-1
+   edges = np.arange(nblocks + 1) * npts // nblocks
+   start, end = edges[:-1], edges[1:]
+   # Boltzmann factors relative to the lowest energy, so they are all <= 1, and
+   # energies relative to their mean to keep the sums of squares accurate
+   # (one row of Boltzmann factors per temperature)
+   tscale = tscale.reshape((len(tscale), 1))
+   emin = enevec.min()
+   center = enevec.mean()
+   boltz = np.exp(-(enevec - emin) / (0.596 * tscale))
+   shifted = enevec - center
+
+   def leave_out(values):
+      """ Sums of values over all points outside of each block """
+      prefix = np.cumsum(values, axis=-1)
+      suffix = np.cumsum(values[...,::-1], axis=-1)[...,::-1]
+      zero = np.zeros(values.shape[:-1] + (1,))
+      prefix = np.concatenate((zero, prefix), axis=-1)
+      suffix = np.concatenate((suffix, zero), axis=-1)
+      return prefix[...,start] + suffix[...,end]
+
+   def estimates(nkeep, sboltz, sener, sener2):
+      """ Free energy and enthalpy from the sums over nkeep points """
+      mean = sener / nkeep
+      var = (sener2 - nkeep * mean ** 2) / (nkeep - 1)
+      kwidth2 = nkeep ** (-2 / 5) * var
+      ktemp = 0.596 * tscale
+      lnboltz = np.log(sboltz / nkeep) - emin / ktemp + \
+                kwidth2 / (2 * ktemp ** 2)
+      return -1.373 * tscale * lnboltz / log(10), mean + center
 
+   g_full, h_full = estimates(npts, boltz.sum(axis=1).reshape(tscale.shape),
+                              shifted.sum(), (shifted ** 2).sum())
+   g_jack, h_jack = estimates(npts - (end - start), leave_out(boltz),
+                              leave_out(shifted), leave_out(shifted ** 2))
+   # Jackknife standard errors
+   factor = (nblocks - 1) / nblocks
+   dg_std = np.sqrt(factor * np.sum((g_jack - g_jack.mean(axis=1).reshape(
+                    tscale.shape)) ** 2, axis=1))
+   dh_std = np.sqrt(factor * np.sum((h_jack - h_jack.mean()) ** 2))
+   tscale = tscale.ravel()
+   dg_avg = g_full.ravel() - _bulk_free_energy(tscale)
+   dh_avg = h_full - DH_BULK
+   ntds = dg_avg - dh_avg
+
+   stats = (dg_avg[0], dg_std[0], dh_avg, dh_std, ntds[0])
+   for i in range(1, len(tscale)):
+      stats += (dg_avg[i], dg_std[i], ntds[i])
+   return stats
+
+def _std_err(values):
+   """ Standard error of the mean of a series of subsample results """
+   return values.std() / np.sqrt(len(values))
+
+def _draw_subsamples(kde1, enevec, sample_size, sample_num, rng):
+   """
+   Draws sample_num subsamples of sample_size points from kde1 as the rows of
+   one array. This is what gaussian_kde.resample does: pick data points with
+   replacement and displace them by the kernel of the full data set
+   """
+   enevec = np.asarray(enevec, dtype=np.float64)
+   idx = rng.randint(0, len(enevec), size=(sample_num, sample_size))
+   return enevec[idx] + rng.normal(0, np.sqrt(kde1.covariance[0,0]),
+                                   size=idx.shape)
+
+def _looped_subsamples(kde1, enevec, sample_size, sample_num, rng, tscale,
+                       resample=True, estimator='grid'):
+   """
+   Builds a new KDE for each subsample and integrates its Boltzmann factor at
+   each temperature (tscale * TEMPERATURE). Returns the free energies (one
+   column per temperature) and enthalpies of every subsample. If resample is
+   False, the data set itself is used instead of a subsample
+   """
    enthalpy = np.zeros(sample_num)
-   free_energy = np.zeros(sample_num)
+   free_energy = np.zeros((sample_num, len(tscale)))
    # We want to do "sample_num" subsamples with "sample_size" elements in each
    # subsample.  Loop over those now
    for ii in range(sample_num):
-      # If sample_num is 1, then don't resample
-      if sample_num == 1:
+      if not resample:
          skde = gaussian_kde(enevec)
       else:
          # Generate the subsample kernel
-         skde = gaussian_kde(kde1.resample(sample_size))
+         skde = gaussian_kde(_draw_subsamples(kde1, enevec, sample_size, 1,
+                                              rng))
+      enthalpy[ii] = np.sum(skde.dataset) / sample_size
+      if estimator == 'analytic':
+         free_energy[ii] = _analytic_free_energy(skde.dataset,
+                                   np.sqrt(skde.covariance[0,0]), tscale)[0]
+         continue
       # Determine the widths of the bins from the covariance factor method
       binwidth = skde.covariance_factor()
       # Determine the number of bins over the range of the data set
@@ -42,19 +250,129 @@ def calc_g_wat(enevec, sample_size, sample_num):
       for i in range(nbins): pts[i] = skde.dataset.min() + (i-50) * binwidth
       # Evaluate the KDE at all of those points
       kdevals = skde.evaluate(pts)
-      # Get the enthalpy and free energy
-      enthalpy[ii] = np.sum(skde.dataset) / sample_size
-      free_energy[ii] = -1.373 * log10(binwidth * 
-                                      np.sum(kdevals * np.exp(-pts / 0.596)))
+      # Get the free energy at every temperature
+      boltz = np.exp(-np.outer(pts, 1 / tscale) / 0.596)
+      free_energy[ii] = -1.373 * tscale * np.log10(binwidth *
+                                                   np.dot(kdevals, boltz))
 
-   # Our subsampling is over, now find the average and standard deviation
-   dg_avg = np.sum(free_energy) / sample_num - DG_BULK
-   dg_std = free_energy.std()
-   dh_avg = np.sum(enthalpy) / sample_num - DH_BULK
-   dh_std = enthalpy.std()
-   ntds = dg_avg - dh_avg
+   return free_energy, enthalpy
+
+def _batched_subsamples(kde1, enevec, sample_size, sample_num, rng, tscale,
+                        resample=True):
+   """
+   Vectorized equivalent of _looped_subsamples with the analytic estimator.
+   All subsample indices are drawn as one (sample_num x sample_size) matrix,
+   and the Boltzmann factor of the KDE of every row is integrated exactly (see
+   _analytic_free_energy). There is no batched grid estimator: a grid cannot
+   do this in double precision for wide kernels, since the Boltzmann factor
+   blows up any round-off in the KDE far below the data by exp(distance / kT).
+
+   The looped grid estimator samples the KDE one covariance-factor width
+   apart, so its free energies only agree with these (and with the analytic
+   estimator) when the kernel is not much narrower than that spacing. For a
+   site with an energy standard deviation of 0.5 kcal/mol or more (a kernel
+   at least half the spacing), any given subsample agrees to within
+   ~5e-3 kcal/mol, and to ~1e-3 kcal/mol with 100 or more frames. Narrower
+   distributions are under-resolved by the looped grid: at 0.2 kcal/mol it is
+   off by up to ~0.07 kcal/mol, and at 0.1 kcal/mol by up to ~0.3 kcal/mol.
+   The random draws themselves also differ between the two modes
+   """
+   if not resample:
+      samples = np.asarray(enevec, dtype=np.float64).reshape((1, len(enevec)))
+   else:
+      samples = _draw_subsamples(kde1, enevec, sample_size, sample_num, rng)
+   nrows, npts = samples.shape
+
+   # Scott's factor, which is what gaussian_kde.covariance_factor returns,
+   # times the spread of each row is the standard deviation of its kernel
+   kwidth = npts ** (-1 / 5) * samples.std(axis=1, ddof=1)
+   enthalpy = samples.mean(axis=1)
+   return _analytic_free_energy(samples, kwidth, tscale), enthalpy
+
+def _analytic_free_energy(samples, kwidth, tscale):
+   """
+   Closed-form free energy of a Gaussian KDE. Every kernel integrates against
+   the Boltzmann factor exactly,
+
+      int N(E; x, h**2) exp(-E/kT) dE = exp(-x/kT + h**2 / (2 kT**2))
+
+   so the integral the grid estimator approximates is the mean of those terms
+   over the data points. The log of that sum is taken with the log-sum-exp
+   trick so strongly negative energies cannot overflow. samples holds one data
+   set per row and kwidth the kernel standard deviation of each row. Returns
+   the free energy of each row (rows) at each temperature tscale * TEMPERATURE
+   (columns)
+   """
+   samples = np.atleast_2d(samples)
+   nrows, npts = samples.shape
+   kwidth = np.asarray(kwidth).reshape(nrows)
+   free_energy = np.zeros((nrows, len(tscale)))
+   for i, scale in enumerate(tscale):
+      ktemp = 0.596 * scale
+      expon = -samples / ktemp
+      top = expon.max(axis=1)
+      lnsum = top + np.log(np.sum(np.exp(expon - top.reshape((nrows, 1))),
+                                  axis=1))
+      lnboltz = lnsum - log(npts) + kwidth ** 2 / (2 * ktemp ** 2)
+      free_energy[:,i] = -1.373 * scale * lnboltz / log(10)
+   return free_energy
+
+def statistical_inefficiency(series):
+   """
+   Statistical inefficiency g of a time series, so that len(series) / g is the
+   number of effectively uncorrelated samples in it. The normalized
+   autocorrelation function is computed at every lag at once with an FFT and
+   integrated up to its first zero crossing
+   """
+   series = np.asarray(series, dtype=np.float64).ravel()
+   npts = len(series)
+   delta = series - series.mean()
+   if npts < 2 or not np.any(delta): return 1.0
+   # Zero-pad to at least twice the length so the correlation is not circular
+   nfft = 1
+   while nfft < 2 * npts: nfft *= 2
+   trans = np.fft.rfft(delta, nfft)
+   acf = np.fft.irfft(trans.real ** 2 + trans.imag ** 2, nfft)[:npts]
+   # Average over the number of pairs at each lag, then normalize
+   acf /= np.arange(npts, 0, -1)
+   acf /= acf[0]
+   # Integrate up to (not including) the first lag with no correlation
+   nonpos = np.nonzero(acf[1:] <= 0)[0]
+   if len(nonpos) > 0:
+      cut = nonpos[0]
+   else:
+      cut = npts - 1
+   lags = np.arange(1, cut + 1)
+   ineff = 1 + 2 * np.sum((1 - lags / npts) * acf[1:cut+1])
+   return max(1.0, ineff)
 
-   return (dg_avg, dg_std, dh_avg, dh_std, ntds)
+def sampling_analysis(enevec, target_error):
+   """
+   Estimates how many of the frames in an energy series are needed. Returns
+   (statistical inefficiency, effective number of samples, estimated error in
+   DELTA G using every frame, stride). The DELTA G error is the propagated
+   error of -kT ln <exp(-E/kT)> over the effective number of samples. The
+   stride is the largest frame stride that still gives a DELTA G error no
+   larger than target_error. Striding by up to the statistical inefficiency
+   loses nothing, and past that the error grows with the square root of the
+   stride. A stride of 0 means target_error cannot be reached even with every
+   frame.
+   """
+   enevec = np.asarray(enevec, dtype=np.float64).ravel()
+   npts = len(enevec)
+   ineff = statistical_inefficiency(enevec)
+   neff = npts / ineff
+   # Error in DELTA G from a single independent sample
+   boltz = np.exp(-(enevec - enevec.min()) / 0.596)
+   sample_err = 0.596 * boltz.std() / boltz.mean()
+   dg_err = sample_err / np.sqrt(neff)
+   if sample_err == 0:
+      return ineff, neff, dg_err, npts
+   # The error is sample_err * sqrt(max(stride, ineff) / npts)
+   stride = int(npts * (target_error / sample_err) ** 2)
+   if stride < ineff:
+      stride = 0
+   return ineff, neff, dg_err, min(stride, npts)
 
 def test(args):
    """ Sets up a test for calculating the spam statistics """
@@ -79,6 +397,13 @@ def test(args):
    group.add_option('--size-subsample', dest='subsize', type='int',
                     metavar='INT', default=0, help='How many points to ' +
                     'include in each subsample.  (Default %default)')
+   group.add_option('--batched', dest='batched', default=False,
+                    action='store_true', help='Evaluate all subsamples at ' +
+                    'once rather than one KDE at a time. Needs the analytic ' +
+                    'estimator')
+   group.add_option('--estimator', dest='estimator', default='grid',
+                    metavar='GRID|ANALYTIC', help='How to integrate the ' +
+                    'Boltzmann factor of the KDE. (Default %default)')
    parser.add_option_group(group)
 
    opt, arg = parser.parse_args(args)
@@ -89,11 +414,12 @@ def test(args):
          sys.exit(1)
       print 'I am analyzing the %d-th site with the NAMD output ' % opt.site
       print 'file %s and SPAM info file %s\n' % (opt.namdout, opt.info)
-      namdout = NamdPairOutput(opt.namdout)
+      namdout = NamdPairOutput(opt.namdout, ['TOTAL'])
       namdout.filter_output_file(SpamInfo(opt.info), opt.site)
       print len(namdout.data['TOTAL'])
       for val in namdout.data['TOTAL']: print val
-      retvals = calc_g_wat(namdout.data['TOTAL'], opt.subsize, opt.subsamples)
+      retvals = calc_g_wat(namdout.data['TOTAL'], opt.subsize, opt.subsamples,
+                           opt.batched, opt.estimator.lower())
       print '%14s |%14s |%14s |%14s | %14s' % ('<G>', 'Std. Dev. G.',
                                                '<H>', 'Std. Dev. H.', '-TS')
       print '-' * (80)
@@ -0,0 +1,148 @@
+"""
+This module contains a persistent cache of the SPAM statistics of every site,
+so re-running the statistics on unchanged NAMD output with the same parameters
+does not have to recompute them.
+"""
+from __future__ import division
+import os
+try:
+   import cPickle as pickle
+except ImportError:
+   import pickle
+from collections import OrderedDict
+from hashlib import md5
+from spam.exceptions import InputError, NoFileExists
+
+# Default number of sites whose statistics are kept in the cache
+MAX_ENTRIES = 10000
+# Bump this whenever the layout of the cached statistics changes
+CACHE_VERSION = 1
+
+class StatsCache(object):
+   """
+   Cache of per-site statistics stored in a single file. Entries are keyed by
+   the fingerprint returned from site_key, and the least recently used entries
+   are dropped once there are more than max_entries of them
+   """
+
+   def __init__(self, fname, max_entries=MAX_ENTRIES):
+      """ Constructor -- loads the cache file if it exists """
+      if max_entries < 1:
+         raise InputError("Stats cache must hold at least 1 entry! Got %d" %
+                          max_entries)
+      self.fname = fname
+      self.max_entries = max_entries
+      self.entries = OrderedDict()
+      self.modified = False
+      if os.path.exists(fname):
+         self.load()
+
+   def __len__(self):
+      return len(self.entries)
+
+   def load(self):
+      """
+      Loads the entries from the cache file. An unreadable cache (or one from
+      a different CACHE_VERSION) is simply treated as empty
+      """
+      try:
+         cachefile = open(self.fname, 'rb')
+         try:
+            version, entries = pickle.load(cachefile)
+         finally:
+            cachefile.close()
+      except Exception:
+         return
+      if version != CACHE_VERSION:
+         return
+      self.entries = entries
+      self._prune()
+
+   def save(self):
+      """ Writes the cache file if anything changed since it was loaded """
+      if not self.modified:
+         return
+      # Write a temporary file and move it over the old one so an interrupted
+      # save cannot leave a truncated cache behind
+      tmpname = self.fname + '.tmp'
+      cachefile = open(tmpname, 'wb')
+      try:
+         pickle.dump((CACHE_VERSION, self.entries), cachefile,
+                     pickle.HIGHEST_PROTOCOL)
+      finally:
+         cachefile.close()
+      os.rename(tmpname, self.fname)
+      self.modified = False
+
+   def get(self, key):
+      """ Returns the statistics stored for key, or None if there are none """
+      try:
+         value = self.entries.pop(key)
+      except KeyError:
+         return None
+      # Re-insert it as the most recently used entry. That alone is not worth
+      # rewriting the cache for, so the new order is only saved along with the
+      # next put or eviction
+      self.entries[key] = value
+      return value
+
+   def put(self, key, value):
+      """ Stores the statistics for key, dropping the oldest entries """
+      self.entries.pop(key, None)
+      self.entries[key] = value
+      self.modified = True
+      self._prune()
+
+   def _prune(self):
+      """ Drops the least recently used entries beyond max_entries """
+      while len(self.entries) > self.max_entries:
+         self.entries.popitem(last=False)
+         self.modified = True
+
+def site_key(fname, excluded, params, seed, content=None):
+   """
+   Fingerprint of the statistics of a single site: the contents of its NAMD
+   output file fname, the frames excluded from that site, the dict of
+   statistics parameters and the random seed of the site. If content is given,
+   it stands in for the contents of the file (e.g., a checksum of the energies
+   in an energy archive)
+   """
+   hasher = md5()
+   hasher.update(repr(sorted(params.items())))
+   hasher.update(repr(seed))
+   hasher.update(repr(list(excluded)))
+   if content is not None:
+      hasher.update(content)
+      return hasher.hexdigest()
+   if not os.path.exists(fname):
+      raise NoFileExists("Cannot find NAMD output file %s" % fname)
+   namdfile = open(fname, 'rb')
+   try:
+      chunk = namdfile.read(1 << 20)
+      while chunk:
+         hasher.update(chunk)
+         chunk = namdfile.read(1 << 20)
+   finally:
+      namdfile.close()
+   return hasher.hexdigest()
+
+def test(args):
+   """ Prints out a summary of a statistics cache file """
+   from optparse import OptionParser, OptionGroup
+
+   parser = OptionParser()
+   group = OptionGroup(parser, 'Stats Cache', 'Options to inspect a cache')
+   group.add_option('-c', '--cache', dest='cache', default=None,
+                    metavar='FILE', help='Statistics cache file to inspect')
+   parser.add_option_group(group)
+
+   opt, arg = parser.parse_args(args)
+
+   if opt.cache is None:
+      parser.print_help()
+      return
+
+   cache = StatsCache(opt.cache)
+   print 'Statistics cache [%s] has %d entries:' % (opt.cache, len(cache))
+   for key, value in cache.entries.items():
+      print '   %s : %s' % (key, ' '.join(['%.4f' % val for val in value]))
@@ -0,0 +1,300 @@
+"""
+This module contains code that trims the reordered system down to the region
+around the SPAM sites, so the pair interaction energies can be computed by NAMD
+on a much smaller system in the same periodic box. Only residues that come
+within the cutoff (plus a margin) of a site, or of one of its periodic images,
+in some frame are kept, and the trimmed energies can be checked against those
+of the full system on sample frames.
+"""
+from __future__ import division
+import itertools
+import os
+import sys
+import numpy as np
+from spam import AmberParm
+from spam.exceptions import (ExternalProgramError, FileExists, InputError,
+                             InternalError)
+
+overwrite = False
+
+# Default cutoff (Angstroms) of the nonbonded interactions in namdcalc
+# (NONBONDED_DEFAULTS)
+CUTOFF = 12.0
+# Extra room (Angstroms) kept beyond the cutoff around each site, since the
+# water in a site is not always right on its peak
+TRIM_MARGIN = 4.0
+# Edge (Angstroms) of the voxels used to find the atoms near the sites
+VOXEL_SIZE = 1.0
+# Frames of the trajectory examined at once when finding the kept residues
+FRAME_CHUNK = 100
+# Number of sites and frames on which validate_trimmed compares energies
+VALIDATION_SITES = 5
+VALIDATION_FRAMES = 10
+# Energy terms compared by validate_trimmed
+VALIDATION_KEYS = ('ELECT', 'VDW', 'TOTAL')
+# Largest difference (kcal/mol) in the TOTAL energy deemed acceptable
+VALIDATION_TOLERANCE = 0.5
+
+def _region_grid(centers, radius, voxel):
+   """
+   Returns the origin of a grid of voxels around the centers and a boolean grid
+   that is True for every voxel that may hold a point within radius of a center
+   """
+   lo = centers.min(axis=0) - radius - voxel
+   hi = centers.max(axis=0) + radius + voxel
+   shape = np.ceil((hi - lo) / voxel).astype(int)
+   region = np.zeros(shape, dtype=bool)
+   # Any point within radius of a center is in a voxel whose center is within
+   # radius plus half a voxel diagonal of that center
+   reach = radius + voxel * np.sqrt(3) / 2
+   for center in centers:
+      first = np.maximum(np.floor((center - reach - lo) / voxel).astype(int), 0)
+      last = np.minimum(np.ceil((center + reach - lo) / voxel).astype(int) + 1,
+                        shape)
+      axes = [lo[i] + (np.arange(first[i], last[i]) + 0.5) * voxel - center[i]
+              for i in range(3)]
+      dist2 = (axes[0][:,None,None] ** 2 + axes[1][None,:,None] ** 2 +
+               axes[2][None,None,:] ** 2)
+      region[first[0]:last[0],first[1]:last[1],first[2]:last[2]] |= (
+            dist2 <= reach * reach)
+   return lo, region
+
+def _frame_boxes(block, topology):
+   """
+   Returns the box lengths (one row per frame) of a block of frames from
+   namdcalc.read_dcd, taken from their unit cells if they have them and from
+   the BOX_DIMENSIONS of topology otherwise, or None if there is no box. Like
+   namdcalc.write_input, this takes the box to be orthorhombic
+   """
+   if 'cell' in block.dtype.names:
+      # CHARMM and NAMD store the unit cell as A, gamma, B, beta, alpha, C
+      boxes = block['cell'][:,[0,2,5]].astype(np.float64)
+      if np.all(boxes > 0):
+         return boxes
+   if not topology.ptr('ifbox'):
+      return None
+   box = np.array(topology.parm_data['BOX_DIMENSIONS'][1:4], dtype=np.float64)
+   return np.tile(box, (len(block), 1))
+
+def region_residues(inptraj, topology, centers, radius, voxel=VOXEL_SIZE,
+                    periodic=True):
+   """
+   Returns the sorted numbers (from 0) of the residues of topology with an atom
+   within radius of one of the centers (an N x 3 array) in any frame of the
+   DCD trajectory inptraj. If periodic is True and the system has a box (see
+   _frame_boxes), the periodic images of every atom are considered too, so
+   residues that only reach a site through the box boundary are kept. A few
+   residues just beyond radius may be included as well
+   """
+   from spam.namdcalc import read_dcd
+   frames = read_dcd(inptraj)
+   natom = topology.ptr('natom')
+   if frames.dtype['x'].shape[0] != natom:
+      raise InputError("%s has %d atoms, but %s has %d!" % (inptraj,
+                       frames.dtype['x'].shape[0], topology, natom))
+   lo, region = _region_grid(np.asarray(centers, dtype=float), radius, voxel)
+   shape = np.array(region.shape)
+   middle = lo + shape * voxel / 2
+
+   near = np.zeros(natom, dtype=bool)
+   for start in range(0, len(frames), FRAME_CHUNK):
+      block = frames[start:start+FRAME_CHUNK]
+      xyz = np.dstack((block['x'], block['y'], block['z']))
+      boxes = None
+      if periodic:
+         boxes = _frame_boxes(block, topology)
+      if boxes is None:
+         images = [np.zeros((len(block), 1, 3))]
+      else:
+         # Wrap every atom into the box centered on the region, then also try
+         # each whole-box shift that can still land in the region (only 0
+         # unless the region is wider than the box)
+         box = boxes[:,None,:]
+         xyz = xyz - box * np.floor((xyz - middle) / box + 0.5)
+         reach = np.maximum(np.ceil((shape * voxel / boxes.min(axis=0) - 1) /
+                                    2).astype(int), 0)
+         images = [box * np.array(shift) for shift in
+                   itertools.product(*[range(-k, k + 1) for k in reach])]
+      for image in images:
+         cells = np.floor((xyz + image - lo) / voxel).astype(np.intp)
+         inside = np.all((cells >= 0) & (cells < shape), axis=-1)
+         hits = np.zeros(inside.shape, dtype=bool)
+         cells = cells[inside]
+         hits[inside] = region[cells[:,0], cells[:,1], cells[:,2]]
+         near |= hits.any(axis=0)
+
+   # Keep whole residues
+   resptr = np.array(topology.parm_data['RESIDUE_POINTER']) - 1
+   resnum = np.repeat(np.arange(len(resptr)),
+                      np.diff(np.append(resptr, natom)))
+   return np.unique(resnum[near])
+
+def residue_mask(residues):
+   """ Amber mask selecting the residues (numbered from 0) in a sorted list """
+   ranges = []
+   for res in residues:
+      if ranges and res == ranges[-1][1] + 1:
+         ranges[-1][1] = res
+      else:
+         ranges.append([res, res])
+   words = []
+   for first, last in ranges:
+      if first == last:
+         words.append('%d' % (first + 1))
+      else:
+         words.append('%d-%d' % (first + 1, last + 1))
+   return ':' + ','.join(words)
+
+def trim_system(inptraj, topology, peakfile, firstwat, cpptraj, prmout,
+                trajout, pdbout, crdout, cutoff=CUTOFF, margin=TRIM_MARGIN,
+                logfile=None):
+   """
+   Writes the topology prmout, DCD trajectory trajout, template PDB pdbout and
+   dummy restart crdout of the part of the system in inptraj (with topology)
+   within cutoff plus margin of the peaks in peakfile. The waters in the sites
+   (residues firstwat to firstwat + the number of peaks, from 0) are always
+   kept. Returns the sorted numbers of the residues that were kept
+   """
+   from subprocess import Popen, PIPE
+   from spam.xyzpeaks import read_xyz_peaks
+   global overwrite
+
+   if cpptraj is None:
+      raise InternalError("trim_system: Missing cpptraj!")
+   if not isinstance(topology, AmberParm):
+      raise TypeError("trim_system: topology must be of type AmberParm!")
+   if cutoff <= 0 or margin < 0:
+      raise InputError("Bad trimming cutoff (%f) or margin (%f)!" %
+                       (cutoff, margin))
+   if not overwrite:
+      for fname in (prmout, trajout, pdbout, crdout):
+         if os.path.exists(fname):
+            raise FileExists("%s exists. Not overwriting" % fname)
+
+   peaks = read_xyz_peaks(peakfile)
+   centers = np.array([(pk.x, pk.y, pk.z) for pk in peaks])
+   residues = region_residues(inptraj, topology, centers, cutoff + margin)
+   residues = np.union1d(residues, np.arange(firstwat, firstwat + len(peaks)))
+
+   cpptraj_call = ('trajin %s\n' % inptraj +
+                   'strip "!(%s)" parmout %s\n' % (residue_mask(residues),
+                                                   prmout) +
+                   'trajout %s dcd\n' % trajout +
+                   'trajout %s pdb onlyframes 1\n' % pdbout +
+                   'trajout %s restart onlyframes 1\n' % crdout)
+
+   if logfile is None:
+      output = sys.stdout
+   else:
+      output = logfile
+   process = Popen([cpptraj, str(topology)], stdin=PIPE, stdout=PIPE,
+                   stderr=PIPE)
+   out, err = process.communicate(cpptraj_call)
+   output.write('\n'.join((out, err)))
+   if process.wait():
+      raise ExternalProgramError("cpptraj failed trimming the system!")
+   return residues
+
+def validate_trimmed(pdbname, inptraj, topology, inpcrd, trim_pdbname,
+                     trim_traj, trim_topology, trim_inpcrd, nsites, report,
+                     pmegrid=1.0, sites=VALIDATION_SITES,
+                     frames=VALIDATION_FRAMES, prefix='_SPAM_trimcheck'):
+   """
+   Computes the energies of a few sites (out of nsites) on a few frames with
+   both the full system and the trimmed one, and writes a report comparing
+   them to report (file name or open file). Returns the largest difference in
+   the TOTAL energy
+   """
+   from spam import namdcalc, namdpdb
+   global overwrite
+
+   nframes = namdcalc.dcd_frame_count(inptraj)
+   if namdcalc.dcd_frame_count(trim_traj) != nframes:
+      raise InputError("%s and %s have different numbers of frames!" %
+                       (inptraj, trim_traj))
+   frame_list = np.unique(np.linspace(0, nframes - 1, frames).astype(int))
+   site_list = np.unique(np.linspace(0, nsites - 1, sites).astype(int))
+
+   systems = []
+   for pdb, traj, top, crd in (
+         (pdbname, inptraj, topology, inpcrd),
+         (trim_pdbname, trim_traj, trim_topology, trim_inpcrd)):
+      firstwat = top.parm_data['RESIDUE_LABEL'].index('WAT')
+      systems.append((namdpdb.read_pdb(pdb), firstwat, traj, top, crd))
+
+   energies = []
+   for site in site_list:
+      site_energies = []
+      for i, (template, firstwat, traj, top, crd) in enumerate(systems):
+         tmppdbname = '%s.%d.pdb' % (prefix, i)
+         tmpinpname = '%s.%d.inp' % (prefix, i)
+         tmpoutname = '%s.%d' % (prefix, i)
+         template.label_residue(firstwat + site)
+         template.write_to_pdb(tmppdbname)
+         template.unlabel()
+         namdcalc.run_namd(tmppdbname, traj, top, pmegrid, crd, tmpinpname,
+                           tmpoutname, frames=frame_list)
+         namdout = namdcalc.NamdPairOutput(tmpoutname + '.out',
+                                           VALIDATION_KEYS, sidecar=False)
+         site_energies.append(namdout.data)
+         for fname in (tmppdbname, tmpinpname, tmpoutname + '.out'):
+            if os.path.exists(fname): os.remove(fname)
+      energies.append(site_energies)
+
+   if hasattr(report, 'write'):
+      outfile = report
+   else:
+      if not overwrite and os.path.exists(report):
+         raise FileExists("%s exists. Not overwriting" % report)
+      outfile = open(report, 'w')
+   outfile.write('# Trimmed vs. full system energies of %d sites on %d '
+                 'frames (kcal/mol)\n' % (len(site_list), len(frame_list)))
+   outfile.write('# Frames: %s\n' % ' '.join(['%d' % fr for fr in frame_list]))
+   outfile.write('#%5s %-8s %12s %12s %12s %12s\n' % ('Site', 'Term',
+                 '<Full>', '<Trimmed>', '<|Diff|>', 'Max |Diff|'))
+   worst = 0.0
+   for site, (full, trimmed) in zip(site_list, energies):
+      for key in VALIDATION_KEYS:
+         diff = np.abs(trimmed[key] - full[key])
+         outfile.write(' %5d %-8s %12.4f %12.4f %12.4f %12.4f\n' % (site, key,
+                       full[key].mean(), trimmed[key].mean(), diff.mean(),
+                       diff.max()))
+         if key == 'TOTAL':
+            worst = max(worst, diff.max())
+   outfile.write('# Largest TOTAL difference is %.4f kcal/mol (%s)\n' % (worst,
+                 'OK' if worst <= VALIDATION_TOLERANCE else
+                 'above the %.2f kcal/mol tolerance' % VALIDATION_TOLERANCE))
+   if outfile is not report: outfile.close()
+   return worst
+
+def test(args):
+   """ Prints the residues that would be kept in a trimmed system """
+   from optparse import OptionParser
+   from spam.xyzpeaks import read_xyz_peaks
+
+   parser = OptionParser(usage='%prog [options]')
+   parser.add_option('-p', '--prmtop', dest='prmtop', default='prmtop',
+                     metavar='FILE', help='Topology file (Default %default)')
+   parser.add_option('-y', '--traj', dest='traj', default=None,
+                     metavar='FILE', help='Reordered DCD trajectory')
+   parser.add_option('-x', '--peaks', dest='peaks', default=None,
+                     metavar='FILE', help='XYZ peak file')
+   parser.add_option('-c', '--cutoff', dest='cutoff', type='float',
+                     default=CUTOFF, metavar='FLOAT', help='Cutoff in ' +
+                     'Angstroms (Default %default)')
+   parser.add_option('-m', '--margin', dest='margin', type='float',
+                     default=TRIM_MARGIN, metavar='FLOAT', help='Margin ' +
+                     'beyond the cutoff in Angstroms (Default %default)')
+   opt, arg = parser.parse_args(args)
+
+   if opt.traj is None or opt.peaks is None:
+      parser.print_help()
+      return
+
+   parm = AmberParm(opt.prmtop)
+   peaks = read_xyz_peaks(opt.peaks)
+   centers = np.array([(pk.x, pk.y, pk.z) for pk in peaks])
+   residues = region_residues(opt.traj, parm, centers, opt.cutoff + opt.margin)
+   print 'Keeping %d of %d residues:' % (len(residues),
+         len(parm.parm_data['RESIDUE_POINTER']))
+   print residue_mask(residues)
@@ -0,0 +1,551 @@
+"""
+This module contains a small TCP work queue that spreads the NAMD runs of the
+sites over several hosts. A coordinator serves one job per site (the labeled
+PDB and NAMD input of that site), and workers started on any host pull jobs,
+run NAMD on them and send the energies back. Every message is a JSON object
+preceded by its length as a 4-byte big-endian integer.
+
+The trajectory, topology and dummy coordinates are not sent. Workers run NAMD
+in the directory of the coordinator, so they must see the same files at the
+same paths (e.g., through a shared file system).
+
+Workers prove they belong to the run with a key shared with the coordinator.
+The key is sent as plain text, so it only keeps out workers that do not know
+it, not anyone who can watch or tamper with the network. The coordinator only
+listens on this host by default, and refuses to listen anywhere else without
+a key.
+
+Every job handed out is leased to its worker for a limited time. A site whose
+energies do not come back before the lease runs out (because its worker or
+host hung or died) is handed out again, and the worker kills a NAMD run that
+outlasts its lease.
+"""
+from __future__ import division
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+try:
+   import SocketServer as socketserver
+except ImportError:
+   import socketserver
+from spam.exceptions import InputError, SpamNamdError, SpamNamdWarning
+
+# Default address and port the coordinator listens on
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 47017
+# Largest message (bytes) either side accepts
+MAX_MESSAGE = 1 << 30
+# Number of times a site is handed out before it is given up on
+MAX_ATTEMPTS = 3
+# Default seconds a worker has to send back the energies of a site before the
+# site is handed out again (0 for no limit)
+LEASE_TIMEOUT = 6 * 3600.0
+# Seconds a worker waits before asking again when every job is handed out
+POLL_INTERVAL = 1.0
+# Seconds a worker keeps trying to reach the coordinator
+CONNECT_TIMEOUT = 60.0
+# Stand-ins for the worker's own file names in the NAMD input of a job
+PDB_TOKEN = '@SPAM_PDB@'
+OUTPUT_TOKEN = '@SPAM_OUTPUT@'
+
+def parse_address(address):
+   """ Splits HOST:PORT (or just HOST) into a (host, port) tuple """
+   host, sep, port = address.rpartition(':')
+   if not sep:
+      return address, DEFAULT_PORT
+   try:
+      return host, int(port)
+   except ValueError:
+      raise InputError("Bad port in address %s" % address)
+
+def is_loopback(host):
+   """
+   Whether host (a name or address) is only reachable from this host. An
+   empty host means every interface, so it is not
+   """
+   if not host:
+      return False
+   try:
+      addresses = [info[4][0] for info in socket.getaddrinfo(host, None)]
+   except socket.error:
+      return False
+   for address in addresses:
+      if not (address.startswith('127.') or address == '::1'):
+         return False
+   return True
+
+def send_message(sock, message):
+   """ Sends the dict message over sock """
+   data = json.dumps(message).encode('utf-8')
+   sock.sendall(struct.pack('>I', len(data)) + data)
+
+def recv_message(sock):
+   """ Returns the next message from sock, or None if it was closed """
+   header = _recv_exactly(sock, 4)
+   if header is None:
+      return None
+   length = struct.unpack('>I', header)[0]
+   if length > MAX_MESSAGE:
+      raise InputError("Message of %d bytes is too large!" % length)
+   data = _recv_exactly(sock, length)
+   if data is None:
+      return None
+   return json.loads(data.decode('utf-8'))
+
+def _recv_exactly(sock, nbytes):
+   """ Reads nbytes from sock, or returns None if it is closed before then """
+   pieces = []
+   while nbytes > 0:
+      piece = sock.recv(min(nbytes, 1 << 20))
+      if not piece:
+         return None
+      pieces.append(piece)
+      nbytes -= len(piece)
+   return b''.join(pieces)
+
+class _WorkerHandler(socketserver.BaseRequestHandler):
+   """ Serves the jobs of the coordinator to a single connected worker """
+
+   def handle(self):
+      coordinator = self.server.coordinator
+      hello = recv_message(self.request)
+      if (hello is None or hello.get('type') != 'hello' or
+            hello.get('key') != coordinator.key):
+         send_message(self.request, {'type' : 'refused'})
+         return
+      worker = hello.get('name', str(self.client_address))
+      coordinator.log('Worker %s connected\n' % worker)
+      site = token = None
+      try:
+         while True:
+            message = recv_message(self.request)
+            if message is None:
+               break
+            if message['type'] == 'result':
+               coordinator.finish(site, message, token)
+               site = token = None
+            elif message['type'] == 'request':
+               site, job = coordinator.next_job()
+               token = job.get('token')
+               send_message(self.request, job)
+               if job['type'] == 'done':
+                  break
+      finally:
+         # A job the worker never finished goes back in the queue
+         if site is not None:
+            coordinator.finish(site, {'type' : 'result', 'site' : site,
+                               'error' : 'worker %s disconnected' % worker},
+                               token)
+         coordinator.log('Worker %s disconnected\n' % worker)
+
+class _Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+   allow_reuse_address = True
+   daemon_threads = True
+
+class Coordinator(object):
+   """
+   Hands out the jobs of every site to the workers that connect, and passes
+   the energies that come back to store_result(site, data)
+   """
+
+   def __init__(self, jobs, store_result, host=DEFAULT_HOST, port=DEFAULT_PORT,
+                key='', logfile=None, progress=None, lease=LEASE_TIMEOUT):
+      """
+      jobs is a dict of the job of every site, made by make_job. progress (a
+      ProgressBar, if given) is updated as every site is finished. A site is
+      handed out again if its energies are not back lease seconds after it
+      was handed out (never, if lease is 0). Listening on any host but this
+      one (see is_loopback) needs a key
+      """
+      if not key and not is_loopback(host):
+         raise InputError("Refusing to serve NAMD jobs on %s without a key! "
+                          "Anyone who can reach it could take jobs or send "
+                          "back false energies" % (host or 'every interface'))
+      self.jobs = jobs
+      self.store_result = store_result
+      self.key = key
+      self.logfile = logfile
+      self.progress = progress
+      self.lease = lease
+      self.pending = sorted(jobs)
+      # The token of the current hand-out of every running site, and when its
+      # lease runs out. Results carrying an older token are ignored
+      self.running = {}
+      self.deadlines = {}
+      self.tokens = 0
+      self.attempts = dict([(site, 0) for site in jobs])
+      self.failed = {}
+      self.errors = []
+      self.lock = threading.Condition()
+      self.server = _Server((host, port), _WorkerHandler)
+      self.server.coordinator = self
+
+   @property
+   def address(self):
+      """ (host, port) the coordinator is listening on """
+      return self.server.server_address
+
+   def log(self, message):
+      if self.logfile is not None:
+         with self.lock:
+            self.logfile.write(message)
+
+   def next_job(self):
+      """ Returns the next (site, job) to hand out, or (None, wait/done) """
+      with self.lock:
+         if self.pending:
+            site = self.pending.pop(0)
+            self.tokens += 1
+            self.running[site] = self.tokens
+            if self.lease > 0:
+               self.deadlines[site] = time.time() + self.lease
+            self.attempts[site] += 1
+            job = dict(self.jobs[site])
+            job['token'], job['lease'] = self.tokens, self.lease
+            return site, job
+         if self.running:
+            return None, {'type' : 'wait', 'delay' : POLL_INTERVAL}
+         return None, {'type' : 'done'}
+
+   def finish(self, site, message, token=None):
+      """
+      Stores the energies of site, or puts it back in the queue. token is the
+      one site was handed out with, and the message is ignored if site has
+      been handed out again since (e.g., because its lease ran out)
+      """
+      if site is None or message.get('site') != site:
+         return
+      with self.lock:
+         if site not in self.running or self.running[site] != token:
+            return
+         # Nothing can hand it out again while its energies are stored
+         self.deadlines.pop(site, None)
+      error = message.get('error')
+      if error is None:
+         data = message['energies']
+         nframes = len(data.values()[0]) if data else 0
+         if nframes != self.jobs[site]['frames']:
+            error = 'got %d frames instead of %d' % (nframes,
+                                                    self.jobs[site]['frames'])
+      if error is None:
+         try:
+            self.store_result(site, data)
+         except Exception, err:
+            # Save it so the coordinator can raise it
+            with self.lock:
+               self.errors.append(err)
+               del self.running[site]
+               self.lock.notify_all()
+            return
+      with self.lock:
+         del self.running[site]
+         if error is None:
+            if self.progress is not None: self.progress.update()
+         else:
+            self._retry(site, error)
+         self.lock.notify_all()
+
+   def _retry(self, site, error):
+      """
+      Puts site back in the queue after error, unless it has been tried
+      MAX_ATTEMPTS times. Must be called with the lock held
+      """
+      if self.attempts[site] < MAX_ATTEMPTS:
+         self.pending.append(site)
+      else:
+         self.failed[site] = error
+      if self.logfile is not None:
+         self.logfile.write('Site %d failed (%s)\n' % (site, error))
+
+   def expire_leases(self):
+      """ Hands out again every running site whose lease has run out """
+      now = time.time()
+      with self.lock:
+         for site, deadline in self.deadlines.items():
+            if deadline <= now:
+               del self.deadlines[site]
+               del self.running[site]
+               self._retry(site, 'no energies within the %g second lease' %
+                           self.lease)
+
+   def run(self):
+      """
+      Serves jobs until every site is done (or given up on), then returns the
+      dict of the sites that failed and their last errors
+      """
+      thread = threading.Thread(target=self.server.serve_forever)
+      thread.daemon = True
+      thread.start()
+      try:
+         with self.lock:
+            while (self.pending or self.running) and not self.errors:
+               # Waiting with a timeout keeps the main thread interruptible
+               self.lock.wait(1.0)
+               self.expire_leases()
+            if self.errors:
+               raise self.errors[0]
+      finally:
+         self.server.shutdown()
+         self.server.server_close()
+      return self.failed
+
+def make_job(site, pdbtemplate, residue, inptraj, topology, inpcrd, nframes,
+             frames=None, periodic=True, pmegrid=1.0, nonbonded=None):
+   """
+   Makes the job of a site: the PDB with residue (from 0) of pdbtemplate
+   labeled, and the NAMD input for it (see namdcalc.write_input). nframes is
+   the number of frames of energies the worker must return
+   """
+   from StringIO import StringIO
+   from spam.namdcalc import write_input
+   pdbfile = StringIO()
+   pdbtemplate.label_residue(residue)
+   pdbtemplate.write_to_pdb(pdbfile)
+   pdbtemplate.unlabel()
+   inpfile = StringIO()
+   write_input(PDB_TOKEN, inptraj, topology, pmegrid, incrd_name=inpcrd,
+               input_name=inpfile, namd_output=OUTPUT_TOKEN, frames=frames,
+               periodic=periodic, nonbonded=nonbonded)
+   return {'type' : 'job', 'site' : site, 'pdb' : pdbfile.getvalue(),
+           'input' : inpfile.getvalue(), 'cwd' : os.getcwd(),
+           'frames' : nframes}
+
+def run_job(job, namd, nproc, workdir):
+   """
+   Runs NAMD on a job in its directory, with the PDB and input written to
+   workdir, and returns the dict of energies of every term. NAMD is killed if
+   it runs past the lease of the job
+   """
+   from subprocess import Popen, PIPE, STDOUT
+   from spam.namdcalc import _stream_energies
+   base = os.path.join(os.path.abspath(workdir), 'site%d' % job['site'])
+   pdbname, inpname = base + '.pdb', base + '.namd'
+   pdbfile = open(pdbname, 'w')
+   pdbfile.write(job['pdb'])
+   pdbfile.close()
+   inpfile = open(inpname, 'w')
+   inpfile.write(job['input'].replace(PDB_TOKEN, pdbname).replace(
+                 OUTPUT_TOKEN, base))
+   inpfile.close()
+   cwd = job['cwd'] if os.path.isdir(job['cwd']) else workdir
+   timer = None
+   expired = []
+   try:
+      process = Popen([namd, '+p%d' % nproc, inpname], stdout=PIPE,
+                      stderr=STDOUT, cwd=cwd)
+
+      def expire():
+         """ Kills NAMD once the lease of the job has run out """
+         expired.append(True)
+         try:
+            process.kill()
+         except OSError:
+            pass
+
+      if job.get('lease', 0) > 0:
+         timer = threading.Timer(job['lease'], expire)
+         timer.daemon = True
+         timer.start()
+      data, tail = _stream_energies(process.stdout, None, job['frames'])
+      if process.wait():
+         if expired:
+            raise SpamNamdWarning("NAMD was killed after running past the "
+                                  "%g second lease of site %d" %
+                                  (job['lease'], job['site']))
+         raise SpamNamdWarning("NAMD exited with non-zero status! The end " +
+                               "of its output was:\n" + ''.join(tail))
+      if data is None:
+         raise SpamNamdError("NAMD printed no energies for site %d!" %
+                             job['site'])
+   finally:
+      if timer is not None: timer.cancel()
+      for fname in (pdbname, inpname):
+         if os.path.exists(fname): os.remove(fname)
+   return data
+
+def run_worker(host, port=DEFAULT_PORT, key='', nproc=None, workdir='.',
+               logfile=sys.stdout, name=None):
+   """
+   Pulls jobs from the coordinator at host:port and runs NAMD (on nproc
+   processors, get_num_procs() if None) on them until there are none left.
+   Returns the number of jobs that were run
+   """
+   from spam.checkprogs import check_progs
+   from spam.namdcalc import get_num_procs
+   namd = check_progs(False, True)['namd']
+   if nproc is None:
+      nproc = get_num_procs()
+   if name is None:
+      name = '%s:%d' % (socket.gethostname(), os.getpid())
+
+   # The coordinator may not be up yet
+   start = time.time()
+   while True:
+      try:
+         sock = socket.create_connection((host, port))
+         break
+      except socket.error:
+         if time.time() - start > CONNECT_TIMEOUT:
+            raise
+         time.sleep(POLL_INTERVAL)
+
+   njobs = 0
+   try:
+      send_message(sock, {'type' : 'hello', 'key' : key, 'name' : name})
+      while True:
+         send_message(sock, {'type' : 'request'})
+         job = recv_message(sock)
+         if job is None or job['type'] == 'refused':
+            raise InputError("Coordinator at %s:%d refused this worker!" %
+                             (host, port))
+         if job['type'] == 'done':
+            break
+         if job['type'] == 'wait':
+            time.sleep(job['delay'])
+            continue
+         logfile.write("Running site %d\n" % job['site'])
+         result = {'type' : 'result', 'site' : job['site']}
+         try:
+            data = run_job(job, namd, nproc, workdir)
+            result['energies'] = dict([(key, data[key].tolist())
+                                       for key in data])
+         except (SpamNamdError, SpamNamdWarning, OSError), err:
+            logfile.write("Site %d failed: %s\n" % (job['site'], err))
+            result['error'] = '%s: %s' % (type(err).__name__, err)
+         send_message(sock, result)
+         njobs += 1
+   finally:
+      sock.close()
+   return njobs
+
+def _test_queue(prmtop, traj, pdb, inpcrd, nsites, nworkers, lease):
+   """
+   Serves nsites sites of a system to nworkers worker processes that run the
+   NAMD stand-in (see spam.fakenamd), and checks the energies that come back.
+   The first run of the second site hangs, so it has to be handed out again
+   once its lease runs out. Returns True if everything checks out
+   """
+   import shutil
+   import tempfile
+   import numpy as np
+   from subprocess import Popen
+   from spam import AmberParm, fakenamd
+   from spam.namdcalc import dcd_frame_count
+   from spam.namdpdb import read_pdb
+
+   topology = AmberParm(prmtop)
+   firstwat = topology.parm_data['RESIDUE_LABEL'].index('WAT')
+   template = read_pdb(pdb)
+   nframes = dcd_frame_count(traj)
+   jobs = dict([(i, make_job(i, template, firstwat + i, traj, topology, inpcrd,
+                             nframes)) for i in range(nsites)])
+   hung = min(1, nsites - 1)
+   results = {}
+
+   def store_result(site, data):
+      results[site] = data
+
+   workdir = tempfile.mkdtemp(prefix='spam_queue')
+   workers = []
+   try:
+      namd = fakenamd.write_executable(os.path.join(workdir, 'namd2'))
+      env = dict(os.environ)
+      env['FAKENAMD_HANG'] = '%d:%s' % (fakenamd.labeled_residue(
+            jobs[hung]['pdb'].splitlines()), os.path.join(workdir, 'hung'))
+      coordinator = Coordinator(jobs, store_result, 'localhost', 0, 'test',
+                                sys.stdout, lease=lease)
+      package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+      script = ('import sys\n'
+                'sys.path.insert(0, %r)\n'
+                'from spam import checkprogs, workqueue\n'
+                'checkprogs.NAMD_NAME = %r\n'
+                'workqueue.run_worker("localhost", %d, "test", 1, sys.argv[1], '
+                'name="worker" + sys.argv[2])\n' % (package, namd,
+                coordinator.address[1]))
+      for i in range(nworkers):
+         workerdir = os.path.join(workdir, 'worker%d' % i)
+         os.mkdir(workerdir)
+         workers.append(Popen([sys.executable, '-c', script, workerdir,
+                               str(i)], env=env))
+      failed = coordinator.run()
+   finally:
+      # A worker stuck on the hung site only stops once its own lease of that
+      # site runs out and it kills the stand-in
+      for worker in workers:
+         worker.wait()
+      shutil.rmtree(workdir)
+
+   passed = not failed and sorted(results) == range(nsites)
+   print 'All %d sites came back from %d workers [%s]' % (nsites, nworkers,
+                                                          passed)
+   match = True
+   for site in results:
+      expected = fakenamd.site_energies(fakenamd.labeled_residue(
+                                        jobs[site]['pdb'].splitlines()),
+                                        range(nframes))
+      for key in expected:
+         match = match and np.allclose(results[site][key], expected[key],
+                                       atol=1e-4)
+   print 'Energies match the NAMD stand-in [%s]' % match
+   requeued = coordinator.attempts[hung] > 1
+   print 'Hung site %d was handed out again after its lease [%s]' % (hung,
+                                                                   requeued)
+   return passed and match and requeued
+
+def test(args):
+   """ Runs a worker, or tests a coordinator and workers on one host """
+   from optparse import OptionParser, OptionGroup
+
+   parser = OptionParser(usage='%prog [options] HOST[:PORT]')
+   parser.add_option('-k', '--key', dest='key', default='', metavar='STRING',
+                     help='Key shared with the coordinator (sent as plain ' +
+                     'text)')
+   parser.add_option('-n', '--nproc', dest='nproc', default=None, type='int',
+                     metavar='INT', help='Processors for each NAMD run')
+   parser.add_option('-d', '--workdir', dest='workdir', default='.',
+                     metavar='DIR', help='Where to write the job files')
+   group = OptionGroup(parser, 'Queue Test', 'Serve a few sites to local ' +
+                       'workers that run a NAMD stand-in (spam.fakenamd), ' +
+                       'then check their energies. No HOST is needed.')
+   group.add_option('-t', '--test-queue', dest='test_queue', default=False,
+                    action='store_true', help='Run the queue test')
+   group.add_option('-p', '--prmtop', dest='prmtop', default='prmtop',
+                    metavar='FILE', help='Topology file (Default %default)')
+   group.add_option('-y', '--traj', dest='traj', default=None,
+                    metavar='FILE', help='Reordered DCD trajectory')
+   group.add_option('-b', '--pdb', dest='pdb', default=None, metavar='FILE',
+                    help='Template PDB of the system')
+   group.add_option('-c', '--inpcrd', dest='inpcrd', default='dummy.crd',
+                    metavar='FILE', help='Dummy restart file ' +
+                    '(Default %default)')
+   group.add_option('-s', '--sites', dest='sites', type='int', default=4,
+                    metavar='INT', help='Number of sites (Default %default)')
+   group.add_option('-w', '--workers', dest='workers', type='int', default=2,
+                    metavar='INT', help='Number of worker processes ' +
+                    '(Default %default)')
+   group.add_option('-l', '--lease', dest='lease', type='float', default=5.0,
+                    metavar='SECONDS', help='Lease of every site ' +
+                    '(Default %default)')
+   parser.add_option_group(group)
+   opt, arg = parser.parse_args(args)
+
+   if opt.test_queue:
+      if opt.traj is None or opt.pdb is None:
+         parser.print_help()
+         return
+      if not _test_queue(opt.prmtop, opt.traj, opt.pdb, opt.inpcrd, opt.sites,
+                         opt.workers, opt.lease):
+         sys.exit(1)
+      return
+
+   if len(arg) != 1:
+      parser.print_help()
+      return
+
+   host, port = parse_address(arg[0])
+   print 'Ran %d jobs' % run_worker(host, port, opt.key, opt.nproc,
+                                    opt.workdir)